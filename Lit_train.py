@@ -3,10 +3,14 @@ import pytorch_lightning as pl
 from pytorch_lightning.callbacks import ModelCheckpoint, EarlyStopping, LearningRateLogger
 from argparse import ArgumentParser
 from lit_unet import Lightning_Unet
+from utils.checkpoint import AsyncModelCheckpoint, StepCheckpoint, find_latest_checkpoint
+from utils.launcher import configure_launch, get_env_int, ScalingEfficiency
+from utils.effective_batch import plan_effective_batch
 from pathlib import Path
 from data.const import COMPUTECANADA
 import pickle
 import pathlib
+import shutil
 import os
 import torch
 import random
@@ -28,25 +32,44 @@ def main(hparams):
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
+    # the nodes / GPUs come from the SLURM job, and the batch size / learning rate are scaled with the world size
+    launch_kwargs = configure_launch(hparams)
     model = Lightning_Unet(hparams)
+    # simulate a larger batch size for gradient descent to provide a good estimate, the micro batch is the largest
+    # one which fits in the GPU memory, see utils/effective_batch.py
+    accumulate_grad_batches = 1
+    if hparams.effective_batch_size is not None:
+        hparams.batch_size, accumulate_grad_batches = plan_effective_batch(model.unet, hparams)
+        model.hparams.batch_size = hparams.batch_size
     if COMPUTECANADA:
         cur_path = Path(__file__).resolve().parent
         default_root_dir = cur_path
         checkpoint_file = Path(__file__).resolve().parent / "checkpoint/{epoch}-{val_dice:.5f}"
-        if not os.path.exists(Path(__file__).resolve().parent / "checkpoint"):
-            os.mkdir(Path(__file__).resolve().parent / "checkpoint")
+        # every task of `srun` runs this at the same time
+        os.makedirs(Path(__file__).resolve().parent / "checkpoint", exist_ok=True)
     else:
         default_root_dir = "./log"
-        if not os.path.exists(default_root_dir):
-            os.mkdir(default_root_dir)
         checkpoint_file = "./log/checkpoint"
-        if not os.path.exists(checkpoint_file):
-            os.mkdir(checkpoint_file)
+        os.makedirs(checkpoint_file, exist_ok=True)
         checkpoint_file = Path(checkpoint_file) / "{epoch}-{val_dice:.2f}"
 
+    checkpoint_dir = Path(checkpoint_file).parent
+    # resume from the given checkpoint, else from the latest one, so a preempted job just needs to be resubmitted
+    if hparams.checkpoint_file is not None:
+        resume_from_checkpoint = str(checkpoint_dir / hparams.checkpoint_file)
+    elif not hparams.no_auto_resume:
+        resume_from_checkpoint = find_latest_checkpoint(checkpoint_dir)
+    else:
+        resume_from_checkpoint = None
+
+    # keep the landmarks next to the checkpoints, the model only works with the same histogram standardization
+    if hparams.landmarks is not None and get_env_int("SLURM_PROCID", "RANK", default=0) == 0:
+        shutil.copy(hparams.landmarks, Path(checkpoint_file).parent)
+
     # After training finishes, use best_model_path to retrieve the path to the best
     # checkpoint file and best_model_score to retrieve its score.
-    checkpoint_callback = ModelCheckpoint(
+    # the checkpoints are copied to CPU and written in a background thread, see utils/checkpoint.py
+    checkpoint_callback = AsyncModelCheckpoint(
         filepath=checkpoint_file,
         save_top_k=3,
         verbose=True,
@@ -70,9 +93,7 @@ def main(hparams):
     tb_logger = loggers.TensorBoardLogger(hparams.TensorBoardLogger)
 
     trainer = Trainer(
-        gpus=hparams.gpus,
-        num_nodes=hparams.nodes,
-        distributed_backend='ddp',
+        **launch_kwargs,
         # the next two can be combined to use, in a straight way
         val_check_interval=0.5,
         # check_val_every_n_epoch=3,
@@ -82,18 +103,22 @@ def main(hparams):
         log_save_interval=10,
         checkpoint_callback=checkpoint_callback,
         early_stop_callback=early_stop_callback,
-        callbacks=[LearningRateLogger()],
+        callbacks=[LearningRateLogger(),
+                   StepCheckpoint(checkpoint_dir, every_n_steps=hparams.checkpoint_every_n_steps),
+                   ScalingEfficiency(hparams.batch_size, hparams.world_size, hparams.scaling_reference)],
         # runs 1 train, val, test  batch and program ends
         fast_dev_run=hparams.fast_dev_run,
         default_root_dir=default_root_dir,
         logger=tb_logger,
         max_epochs=10000,
         # this need to be string
-        # resume_from_checkpoint=str(Path(__file__).resolve().parent / "checkpoint" / hparams.checkpoint_file),
+        resume_from_checkpoint=resume_from_checkpoint,
         profiler=True,
         auto_lr_find=False,
-        # simulate a larger batch size for gradient descent to provide a good estimate
-        # accumulate_grad_batches=4,
+        accumulate_grad_batches=accumulate_grad_batches,
+        # the loaders are built again every epoch, so the epoch resumed from a checkpoint written in the middle of
+        # an epoch only skips its own batches (see `Lightning_Unet.train_dataloader`)
+        reload_dataloaders_every_epoch=True,
     )
 
     # if COMPUTECANADA:
@@ -122,11 +147,30 @@ if __name__ == "__main__":
     parser = ArgumentParser(description='Trainer args', add_help=False)
     parser.add_argument("--gpus", type=int, default=1, help='how many gpus')
     parser.add_argument("--nodes", type=int, default=1, help='how many nodes')
+    parser.add_argument("--num_processes", type=int, default=1,
+                        help='number of processes with --gpus 0, they use gloo (ddp_cpu)')
+    parser.add_argument("--global_batch_size", type=int, default=None,
+                        help='the batch size of all the processes together, split between them')
+    parser.add_argument("--lr_reference_batch_size", type=int, default=None,
+                        help='scale the learning rate linearly, `learning_rate` is the one of this global batch size')
+    parser.add_argument("--effective_batch_size", type=int, default=None,
+                        help='the batch size of one optimizer step over all the processes, reached with the largest '
+                             'micro batch which fits in memory and gradient accumulation')
+    parser.add_argument("--memory_budget_gb", type=float, default=None,
+                        help='memory for the activations, defaults to 90%% of the GPU without the parameters')
+    parser.add_argument("--sample_memory_gb", type=float, default=None,
+                        help='memory of one patch, measured with the layer profiler if not given')
+    parser.add_argument("--scaling_reference", type=str, default=None,
+                        help='json with the step time of a single process run, written by a run with one process')
     parser.add_argument("--TensorBoardLogger", dest='TensorBoardLogger', default='/home/jq/Desktop/log',
                         help='TensorBoardLogger dir')
     parser.add_argument("--name", dest='name', default="using cropped data")
     parser.add_argument("--checkpoint_file", type=str,
                         help="resume_from_checkpoint_file")
+    parser.add_argument("--no_auto_resume", action="store_true",
+                        help='do not resume from the latest checkpoint of the checkpoint folder')
+    parser.add_argument("--checkpoint_every_n_steps", type=int, default=500,
+                        help='write last.ckpt every n steps to resume a preempted job, 0 to disable it')
     parser.add_argument("--fast_dev_run", action="store_true",
                         help='whether to run 1 train, val, test  batch and program ends')
     parser = Lightning_Unet.add_model_specific_args(parser)
@@ -30,7 +30,8 @@ from time import ctime
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from data.get_path import get_path
-from sklearn.cluster import KMeans, MiniBatchKMeans
+from data.labels import get_label_image
+from data.foreground import crop_to_nonzero
 from data.const import (COMPUTECANADA,
                         DATA_ROOT,
                         ADNI_DATASET_DIR_1,
@@ -39,75 +40,6 @@ from data.const import (COMPUTECANADA,
                         cropped_img_folder,
                         cropped_label_folder)
 
-# have similar outcome to the kmeans, but kmeans have dramtically better result on some images
-def create_nonzero_mask_percentile_80(data):
-    from scipy.ndimage import binary_fill_holes
-    assert len(data.shape) == 4 or len(data.shape) == 3, "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
-    nonzero_mask = np.zeros(data.shape, dtype=bool)
-    this_mask = (data > np.percentile(data, 70))
-    nonzero_mask = nonzero_mask | this_mask
-    nonzero_mask = binary_fill_holes(nonzero_mask)
-    return nonzero_mask
-
-
-def create_nonzero_mask_kmeans(data):
-    from scipy.ndimage import binary_fill_holes
-    assert len(data.shape) == 4 or len(data.shape) == 3, "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
-    nonzero_mask = np.zeros(data.shape, dtype=bool)
-    flat = data.ravel()  # Return a contiguous flattened array.
-
-    # using 1 dimension kMeans here to compute the thresholds
-    # using code from
-    # https://github.com/DM-Berger/autocrop/blob/dec40a194f3ace2d024fd24d8faa503945821015/test/test_masking.py#L19-L25
-    # n_job=The number of OpenMP threads to use for the computation.
-    # batch_size controls the number of randomly selected observations in each batch.
-    # The larger the the size of the batch, the more computationally costly the training process.
-    # Increasing the batch size may also help avoid reassignment triggering by some clusters becoming to small
-    # just from sampling variation.
-    km = MiniBatchKMeans(n_clusters=4, batch_size=1000).fit(flat.reshape(-1, 1))
-    # km = KMeans(n_clusters=4, n_jobs=1).fit(flat.reshape(-1, 1))  # more slowly
-    gs = [km.labels_ == i for i in range(4)]
-    maxs = sorted([np.max(flat[g]) for g in gs])  # choose the max value in the min group
-    thresh = maxs[0]
-
-    this_mask = (data > thresh)
-    nonzero_mask = nonzero_mask | this_mask
-    nonzero_mask = binary_fill_holes(nonzero_mask)
-    return nonzero_mask
-
-
-def get_bbox_from_mask(mask, outside_value=0):
-    mask_voxel_coords = np.where(mask != outside_value)
-    minzidx = int(np.min(mask_voxel_coords[0]))
-    maxzidx = int(np.max(mask_voxel_coords[0])) + 1
-    minxidx = int(np.min(mask_voxel_coords[1]))
-    maxxidx = int(np.max(mask_voxel_coords[1])) + 1
-    minyidx = int(np.min(mask_voxel_coords[2]))
-    maxyidx = int(np.max(mask_voxel_coords[2])) + 1
-    return [[minzidx, maxzidx], [minxidx, maxxidx], [minyidx, maxyidx]]
-
-
-def crop_to_bbox(image, bbox):
-    assert len(image.shape) == 3, "only supports 3d images"
-    resizer = (slice(bbox[0][0], bbox[0][1]), slice(bbox[1][0], bbox[1][1]), slice(bbox[2][0], bbox[2][1]))
-    return image[resizer]
-
-
-def crop_to_nonzero(data, seg):
-    """
-    :param data:
-    :param seg: label image
-    :return:
-    """
-    # nonzero_mask_percentile_80 = create_nonzero_mask_percentile_80(data)
-    nonzero_mask_kmeans = create_nonzero_mask_kmeans(data)
-    # bbox_percentile_80 = get_bbox_from_mask(nonzero_mask_percentile_80, 0)
-    bbox_kmeans = get_bbox_from_mask(nonzero_mask_kmeans, 0)
-
-    data = crop_to_bbox(data, bbox_kmeans)
-    seg = crop_to_bbox(seg, bbox_kmeans)
-    return data, seg
-
 
 def crop_from_file(img_path, label_path):
     img, label = nib.load(img_path, mmap=False), nib.load(label_path, mmap=False)
@@ -162,7 +94,7 @@ def run_crop(img_path, label_path, img_folder, label_folder):
     cropped_img, cropped_label = crop_to_nonzero(img, label)
     cropped_img_file = nib.Nifti1Image(cropped_img, img_affine)
     nib.save(cropped_img_file, img_folder / Path(f"{filename}.nii"))
-    cropped_label_file = nib.Nifti1Image(cropped_label, label_affine)
+    cropped_label_file = get_label_image(cropped_label, label_affine)
     nib.save(cropped_label_file, label_folder / Path(f"{filename}.nii.gz"))
     print(f"{ctime()}: Successfully save file {filename} file!")
 
@@ -7,10 +7,12 @@ import nibabel as nib
 
 
 class MRI:
-    def __init__(self, dataset, file_name):
+    def __init__(self, dataset, file_name, check_exists=True):
         """
         :param dataset: dataset name
         :param file_name: every instance
+        :param check_exists: whether to check that the image and label file exist,
+                             not needed when the paths come from a directory listing
         """
         self.dataset = dataset
         self.file_name = file_name
@@ -18,6 +20,7 @@ class MRI:
         self.label_path = ""
         self.val_data = random.random()
         self.flag = True  # in case some file are not NIFTI file
+        self.check_exists = check_exists
         self.get_path()
 
     def get_path(self):
@@ -28,12 +31,20 @@ class MRI:
         self.img_path = self.file_name
         label_file_name = str("MALPEM-" + self.file_name.name + '.gz')
         self.label_path = os.path.join(ADNI_LABEL, label_file_name)
-        if not (os.path.exists(self.img_path) and os.path.exists(self.label_path)):
+        if self.check_exists and not (os.path.exists(self.img_path) and os.path.exists(self.label_path)):
             self.flag = False
 
+    def get_header_shape(self):
+        """
+        the shape of the image and the label from their headers, without loading the voxels
+        :return: (image shape, label shape), "" if the file can not be read
+        """
+        from .metadata import read_header_metadata
+        return read_header_metadata(self.img_path)['shape'], read_header_metadata(self.label_path)['shape']
+
     def show_image_shape(self):
         """
-        print the shape of the MRI
+        print the shape of the MRI, this loads the whole volumes, use `get_header_shape` to only compare the shapes
         :return: None
         """
         img = []
@@ -0,0 +1,307 @@
+"""
+a chunked volume format, so a patch only decompresses the chunks it touches
+
+A training patch is a 96^3 region, but a gzip NIfTI has to be decoded entirely to read it. Here the volume is cut
+in 32^3 chunks which are compressed one by one (zlib, or lz4 when it is installed), and a region is read by
+decompressing only the chunks it overlaps. One file is:
+    b"CHUNKVOL", the length of the header (uint64), the json header, the compressed chunks
+the header has the shape, dtype, affine, chunk size, codec and the offset / length of every chunk (in C order).
+
+Convert the cropped and resampled folders, and compare the patch reads with decoding the whole NIfTI files:
+    python -m data.chunked_volume --convert
+    python -m data.chunked_volume --benchmark
+"""
+import json
+import os
+import struct
+import zlib
+from argparse import ArgumentParser
+from itertools import product
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime, perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import torch
+import torchio
+from torchio import DATA, AFFINE, PATH
+
+from .const import (cropped_resample_img_folder, cropped_resample_label_folder,
+                    chunked_img_folder, chunked_label_folder)
+from .labels import to_label_array
+from .subject_index import get_paired_paths
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+MAGIC = b"CHUNKVOL"
+CHUNKED_SUFFIX = ".cvol"
+CHUNK_SIZE = 32
+ZLIB_LEVEL = 1
+
+
+def get_default_codec() -> str:
+    return "lz4" if lz4_frame is not None else "zlib"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "lz4":
+        return lz4_frame.compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "lz4":
+        if lz4_frame is None:
+            raise ImportError("the volume is compressed with lz4, install it with `pip install lz4`")
+        return lz4_frame.decompress(data)
+    return zlib.decompress(data)
+
+
+def get_chunk_grid(shape: Sequence[int], chunk_size: int) -> Tuple[int, ...]:
+    return tuple(-(-dim // chunk_size) for dim in shape)
+
+
+def get_region_affine(affine: np.ndarray, start: Sequence[int]) -> np.ndarray:
+    """the affine of a region which starts at the voxel `start`"""
+    region_affine = np.array(affine, dtype=np.float64, copy=True)
+    region_affine[:3, 3] = affine[:3, :3] @ np.asarray(start, dtype=np.float64) + affine[:3, 3]
+    return region_affine
+
+
+def write_chunked(data: np.ndarray, affine: np.ndarray, path: Union[str, Path],
+                  chunk_size: int = CHUNK_SIZE, codec: Optional[str] = None) -> int:
+    """
+    write the 3D volume `data` as a chunked volume
+    :return: the size of the file
+    """
+    codec = get_default_codec() if codec is None else codec
+    data = np.ascontiguousarray(data)
+    chunks, offsets, lengths = [], [], []
+    offset = 0
+    for index in product(*(range(n) for n in get_chunk_grid(data.shape, chunk_size))):
+        region = tuple(slice(i * chunk_size, (i + 1) * chunk_size) for i in index)
+        chunk = compress(np.ascontiguousarray(data[region]).tobytes(), codec)
+        chunks.append(chunk)
+        offsets.append(offset)
+        lengths.append(len(chunk))
+        offset += len(chunk)
+    header = json.dumps({
+        'shape': list(data.shape),
+        'dtype': data.dtype.str,
+        'affine': np.asarray(affine, dtype=np.float64).tolist(),
+        'chunk_size': chunk_size,
+        'codec': codec,
+        'offsets': offsets,
+        'lengths': lengths,
+    }).encode()
+
+    path = Path(path)
+    tmp_path = path.parent / f".tmp-{path.name}"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+    return len(MAGIC) + 8 + len(header) + offset
+
+
+class ChunkedVolume:
+    """read a chunked volume region by region, the file is opened again in every process (e.g. loader workers)"""
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a chunked volume")
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+        self.data_start = len(MAGIC) + 8 + header_length
+        self.shape: Tuple[int, ...] = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.affine = np.array(header['affine'])
+        self.chunk_size: int = header['chunk_size']
+        self.codec: str = header['codec']
+        self.offsets: List[int] = header['offsets']
+        self.lengths: List[int] = header['lengths']
+        self.grid = get_chunk_grid(self.shape, self.chunk_size)
+        self._fd = None
+        self._pid = None
+
+    def get_fd(self) -> int:
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(str(self.path), os.O_RDONLY)
+            self._pid = os.getpid()
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def read_chunk(self, index: Tuple[int, ...]) -> np.ndarray:
+        flat_index = int(np.ravel_multi_index(index, self.grid))
+        # `pread` does not move a shared file position, so the chunks can be read from several threads
+        data = os.pread(self.get_fd(), self.lengths[flat_index], self.data_start + self.offsets[flat_index])
+        chunk_shape = tuple(min(self.chunk_size, dim - i * self.chunk_size) for i, dim in zip(index, self.shape))
+        return np.frombuffer(decompress(data, self.codec), dtype=self.dtype).reshape(chunk_shape)
+
+    def read_region(self, start: Sequence[int], size: Sequence[int]) -> np.ndarray:
+        """the region [start, start + size) of the volume, only the chunks it overlaps are decompressed"""
+        start = [int(i) for i in start]
+        stop = [i + int(n) for i, n in zip(start, size)]
+        if any(i < 0 for i in start) or any(i > dim for i, dim in zip(stop, self.shape)):
+            raise ValueError(f"the region {start} - {stop} is out of the volume {self.shape} of {self.path}")
+        region = np.empty([j - i for i, j in zip(start, stop)], dtype=self.dtype)
+        chunk_ranges = [range(i // self.chunk_size, -(-j // self.chunk_size)) for i, j in zip(start, stop)]
+        for index in product(*chunk_ranges):
+            chunk = self.read_chunk(index)
+            chunk_start = [i * self.chunk_size for i in index]
+            low = [max(a, c) for a, c in zip(start, chunk_start)]
+            high = [min(b, c + n) for b, c, n in zip(stop, chunk_start, chunk.shape)]
+            region[tuple(slice(lo - a, hi - a) for lo, hi, a in zip(low, high, start))] = \
+                chunk[tuple(slice(lo - c, hi - c) for lo, hi, c in zip(low, high, chunk_start))]
+        return region
+
+    def read(self) -> np.ndarray:
+        return self.read_region((0, 0, 0), self.shape)
+
+
+class ChunkedImage(torchio.Image):
+    """
+    `torchio.Image` of a chunked volume, `load` reads the whole volume like any other image,
+    and `read_region` only reads the chunks of a patch, without loading the image
+    """
+    def __init__(self, path: Union[str, Path], type: str = torchio.INTENSITY, **kwargs):
+        self._volume = None
+        super().__init__(path=path, type=type, **kwargs)
+
+    @property
+    def volume(self) -> ChunkedVolume:
+        if self._volume is None:
+            self._volume = ChunkedVolume(self[PATH])
+        return self._volume
+
+    @property
+    def spatial_shape(self) -> Tuple[int, ...]:
+        """from the header while the image is not loaded"""
+        if self._loaded:
+            return tuple(self[DATA].shape[1:])
+        return self.volume.shape
+
+    def load(self) -> None:
+        if self._loaded:
+            return
+        self[DATA] = torch.from_numpy(self.volume.read()).unsqueeze(0)
+        self[AFFINE] = self.volume.affine
+        self._loaded = True
+
+    def read_region(self, start: Sequence[int], size: Sequence[int]) -> Tuple[torch.Tensor, np.ndarray]:
+        """:return: the region with a channel dimension, and its affine"""
+        data = torch.from_numpy(self.volume.read_region(start, size)).unsqueeze(0)
+        return data, get_region_affine(self.volume.affine, start)
+
+    def __getstate__(self):
+        # the open file descriptor is not sent to the loader workers
+        state = self.__dict__.copy()
+        state['_volume'] = None
+        return state
+
+
+def get_chunked_path(path: Union[str, Path], src_folder: Union[str, Path], dst_folder: Union[str, Path]) -> Path:
+    """the chunked volume in `dst_folder` of the NIfTI file `path` in `src_folder`"""
+    relative = Path(path).relative_to(src_folder)
+    name = relative.name
+    for suffix in (".nii.gz", ".nii"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return Path(dst_folder) / relative.parent / f"{name}{CHUNKED_SUFFIX}"
+
+
+def convert_file(path: Union[str, Path], chunked_path: Union[str, Path], is_label: bool,
+                 chunk_size: int = CHUNK_SIZE, codec: Optional[str] = None) -> Dict[str, Union[str, int]]:
+    img = nib.load(str(path))
+    data = np.asarray(img.dataobj)
+    data = to_label_array(data) if is_label else data.astype(np.float32, copy=False)
+    os.makedirs(Path(chunked_path).parent, exist_ok=True)
+    size = write_chunked(data, img.affine, chunked_path, chunk_size, codec)
+    return {'path': str(path), 'chunked_path': str(chunked_path),
+            'nifti_size': os.path.getsize(path), 'chunked_size': size}
+
+
+def convert_folders(num_workers: int = 8, chunk_size: int = CHUNK_SIZE, codec: Optional[str] = None) -> pd.DataFrame:
+    """convert the cropped and resampled image / label pairs to chunked volumes"""
+    img_paths, label_paths = get_paired_paths(cropped_resample_img_folder, cropped_resample_label_folder)
+    jobs = [(path, get_chunked_path(path, cropped_resample_img_folder, chunked_img_folder), False, chunk_size, codec)
+            for path in img_paths]
+    jobs += [(path, get_chunked_path(path, cropped_resample_label_folder, chunked_label_folder), True, chunk_size,
+              codec) for path in label_paths]
+    print(f"{ctime()}: converting {len(jobs)} files to {chunk_size}^3 chunks ({codec or get_default_codec()}) ...")
+    with Pool(num_workers) as pool:
+        rows = pool.starmap(convert_file, jobs, chunksize=4)
+    df = pd.DataFrame(rows)
+    print(f"{ctime()}: {df['nifti_size'].sum() / 1024 ** 3:.2f}GB of NIfTI -> "
+          f"{df['chunked_size'].sum() / 1024 ** 3:.2f}GB of chunked volumes")
+    return df
+
+
+def benchmark(num_subjects: int = 20, patch_size: int = 96, patches_per_subject: int = 8,
+              seed: int = 0) -> pd.DataFrame:
+    """the time to decode the whole NIfTI file, against the time to read one random patch of the chunked volume"""
+    rng = np.random.RandomState(seed)
+    img_paths, _ = get_paired_paths(cropped_resample_img_folder, cropped_resample_label_folder)
+    rows = []
+    for path in img_paths[:num_subjects]:
+        chunked_path = get_chunked_path(path, cropped_resample_img_folder, chunked_img_folder)
+        if not chunked_path.exists():
+            continue
+        start = perf_counter()
+        np.asarray(nib.load(str(path)).dataobj)
+        rows.append({'subject': path.name, 'method': 'nifti_whole_volume', 'seconds': perf_counter() - start})
+
+        volume = ChunkedVolume(chunked_path)
+        size = [min(patch_size, dim) for dim in volume.shape]
+        for _ in range(patches_per_subject):
+            index_ini = [rng.randint(0, dim - n + 1) for dim, n in zip(volume.shape, size)]
+            start = perf_counter()
+            volume.read_region(index_ini, size)
+            rows.append({'subject': path.name, 'method': 'chunked_patch', 'seconds': perf_counter() - start})
+        start = perf_counter()
+        volume.read()
+        rows.append({'subject': path.name, 'method': 'chunked_whole_volume', 'seconds': perf_counter() - start})
+        volume.close()
+    df = pd.DataFrame(rows)
+    if len(df):
+        summary = df.groupby('method')['seconds'].describe(percentiles=[0.5, 0.95])[['count', 'mean', '50%', '95%']]
+        print(f"{ctime()}: patch size {patch_size}, the read latency in seconds:\n{summary}")
+    else:
+        print(f"{ctime()}: no chunked volume found, run with --convert first")
+    return df
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='convert the volumes to chunked volumes, and benchmark the patch reads')
+    parser.add_argument("--convert", action="store_true")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--codec", type=str, default=None, choices=["zlib", "lz4"],
+                        help='lz4 if it is installed, else zlib')
+    parser.add_argument("--num_subjects", type=int, default=20, help='the number of subjects of the benchmark')
+    parser.add_argument("--patch_size", type=int, default=96)
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    args = parser.parse_args()
+
+    if args.convert:
+        convert_folders(args.num_workers, args.chunk_size, args.codec)
+    if args.benchmark:
+        benchmark(args.num_subjects, args.patch_size)
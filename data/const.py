@@ -58,6 +58,21 @@ CC359_LABEL_DIR = DATA_ROOT / "CalgaryCampinas359/Skull-stripping-masks/STAPLE"
 CC359_MANUAL_LABEL_DIR = DATA_ROOT / "CalgaryCampinas359/Skull-stripping-masks/Manual"
 NFBS_DATASET_DIR = DATA_ROOT / "NFBS/NFBS_Dataset"
 
+# the cropped and resampled volumes in 32^3 compressed chunks, see data/chunked_volume.py
+chunked_img_folder = DATA_ROOT / "chunked_img"
+chunked_label_folder = DATA_ROOT / "chunked_label"
+# uncompressed copies of the preprocessed images and labels, which can be memory mapped, see data/lazy_patches.py
+memmap_folder = DATA_ROOT / "memmap"
+# the 2x / 4x / 8x downsampled images and labels of every preprocessed subject, see data/pyramid.py
+pyramid_folder = DATA_ROOT / "pyramid"
+# records which of the preprocessed volumes had NaN / infinite voxels repaired, see data/sanitize.py
+nan_manifest_file = DATA_ROOT / "nan_manifest.csv"
+# the subject index is kept next to the code, because DATA_ROOT is extracted again to SLURM_TMPDIR in every job
+subject_index_folder = Path(__file__).resolve().parent.parent.parent / "subject_index"
+# header metadata cache and outlier report, see data/metadata.py
+metadata_cache_file = subject_index_folder / "metadata.csv"
+metadata_outlier_file = subject_index_folder / "metadata_outliers.csv"
+
 ADNI_DATASET_DIR_1 = DATA_ROOT / "ADNI"
 ADNI_DATASET_DIR_2 = DATA_ROOT / "ADNI/ADNI"
 
@@ -2,10 +2,13 @@ import torch
 import numpy as np
 import nibabel as nib
 from torchio.data.subject import Subject
-from torchio import DATA, AFFINE
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from torchio import DATA, AFFINE, PATH, LABEL, TYPE
 from torchio.transforms import Transform
 import torch.nn.functional as F
 from .const import SIZE
+from .subject_index import get_subject_id
 
 
 class ToSqueeze(Transform):
@@ -18,6 +21,17 @@ class ToSqueeze(Transform):
         return sample
 
 
+class ToLabelDtype(Transform):
+    """Keep the label images as uint8, torchio reads them as float32 and the spatial transforms interpolate them.
+    The loss and the metrics index the classes with the uint8 labels directly.
+    """
+    def apply_transform(self, sample: Subject) -> dict:
+        for image_dict in sample.get_images(intensity_only=False):
+            if image_dict[TYPE] == LABEL and image_dict[DATA].dtype != torch.uint8:
+                image_dict[DATA] = image_dict[DATA].round().to(torch.uint8)
+        return sample
+
+
 class ToResize(Transform):
     """Resize the image
     """
@@ -36,3 +50,84 @@ class ToResize_only_image(Transform):
             image_dict[DATA] = F.interpolate(image_dict[DATA].unsqueeze(0), size=(SIZE, SIZE, SIZE))
             image_dict[DATA] = image_dict[DATA].squeeze(0)
         return sample
+
+
+class CachedZNormalization(Transform):
+    """The same as `ZNormalization(masking_method=ZNormalization.mean)`, but the foreground mean / std of every subject
+    are read from the fingerprint (data/fingerprint.py) instead of computed for every sample.
+    The subject is found by its `subject_id`, or by the file name of the image,
+    the statistics are computed like `ZNormalization` when the subject is not in the fingerprint.
+    """
+    def __init__(self, fingerprint: Optional[Dict] = None):
+        super().__init__()
+        self.subject_stats = fingerprint['subjects'] if fingerprint is not None else {}
+
+    def get_stats(self, sample: Subject, image_dict: dict) -> Tuple[float, float]:
+        subject_id = sample.get('subject_id')
+        if subject_id is None and image_dict.get(PATH):
+            subject_id = get_subject_id(Path(image_dict[PATH]).name)
+        stats = self.subject_stats.get(subject_id)
+        if stats is not None:
+            return stats['mean'], stats['std']
+        data = image_dict[DATA]
+        foreground = data[data > data.mean()]
+        return foreground.mean().item(), foreground.std().item()
+
+    def apply_transform(self, sample: Subject) -> dict:
+        for image_dict in sample.get_images(intensity_only=True):
+            mean, std = self.get_stats(sample, image_dict)
+            if std == 0:
+                print(f"the std of {image_dict.get(PATH)} is 0, skip the normalization")
+                continue
+            image_dict[DATA] = (image_dict[DATA] - mean) / std
+        return sample
+
+
+class CachedHistogramStandardization(Transform):
+    """The piecewise linear mapping of `HistogramStandardization`, with the landmarks of data/landmarks.py.
+    The percentiles of the subject are read from the landmarks file instead of computed for every sample, and the
+    result is z-normalized with the foreground mean / std of the standard histogram, so the foreground has a std of
+    about 1 like after `ZNormalization` and the intensity augmentations keep the same strength.
+    """
+    def __init__(self, landmarks: Dict):
+        super().__init__()
+        self.percentiles = np.array(landmarks['percentiles'])
+        self.landmarks = [float(value) for value in landmarks['landmarks']]
+        self.subject_percentiles = landmarks['subjects']
+        self.mean, self.std = self.get_landmark_stats(self.percentiles, self.landmarks)
+
+    @staticmethod
+    def get_landmark_stats(percentiles: np.ndarray, landmarks: List[float]) -> Tuple[float, float]:
+        """
+        the mean and std of the standardized foreground, which is uniform between two consecutive landmarks
+        with the mass of their percentiles (the voxels outside of the cutoff percentiles are left out)
+        """
+        low, high = np.array(landmarks[:-1]), np.array(landmarks[1:])
+        weights = np.diff(percentiles) / (percentiles[-1] - percentiles[0])
+        mean = float(weights.dot((low + high) / 2))
+        second_moment = float(weights.dot((low ** 2 + low * high + high ** 2) / 3))
+        return mean, max(second_moment - mean ** 2, 0.) ** 0.5
+
+    def get_percentiles(self, sample: Subject, image_dict: dict) -> np.ndarray:
+        subject_id = sample.get('subject_id')
+        if subject_id is None and image_dict.get(PATH):
+            subject_id = get_subject_id(Path(image_dict[PATH]).name)
+        if subject_id in self.subject_percentiles:
+            return np.array(self.subject_percentiles[subject_id])
+        data = image_dict[DATA]
+        foreground = data[data > data.mean()].cpu().numpy()
+        return np.percentile(foreground, self.percentiles)
+
+    def apply_transform(self, sample: Subject) -> dict:
+        for image_dict in sample.get_images(intensity_only=True):
+            subject_percentiles = self.get_percentiles(sample, image_dict)
+            data = image_dict[DATA]
+            # linear between two percentiles, and extrapolated with the first / last slope outside of them
+            output = None
+            for i in range(len(subject_percentiles) - 1):
+                low, high = float(subject_percentiles[i]), float(subject_percentiles[i + 1])
+                slope = (self.landmarks[i + 1] - self.landmarks[i]) / (high - low) if high > low else 0.
+                segment = self.landmarks[i] + (data - low) * slope
+                output = segment if output is None else torch.where(data >= low, segment, output)
+            image_dict[DATA] = (output - self.mean) / self.std
+        return sample
@@ -0,0 +1,136 @@
+"""
+dataset fingerprint: the intensity statistics of every subject, computed once
+
+`ZNormalization(masking_method=ZNormalization.mean)` computes a mask (voxels above the mean) and the mean / std of
+the foreground for every sample, in every epoch. The same statistics are computed here once per subject and saved in
+a json file, `CachedZNormalization` (data/custom_trans_class.py) then only reads them.
+The global percentiles of the foreground are also saved, from a random subsample of the foreground voxels of every
+subject, so they can be used by an intensity standardization later.
+
+Run it after `python -m data.sanitize` (the statistics must be computed on the repaired volumes) with:
+    python -m data.fingerprint [--use_resampled_img]
+"""
+import json
+import os
+import zlib
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime
+from typing import Dict, Optional, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+
+from .const import cropped_img_folder, cropped_resample_img_folder, subject_index_folder
+from .subject_index import get_subject_id, scan_nifti
+
+GLOBAL_PERCENTILES = (0.5, 1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99, 99.5)
+
+
+def get_fingerprint_path(img_folder: Union[str, Path]) -> Path:
+    """one fingerprint per image folder, because resampling changes the statistics"""
+    return Path(subject_index_folder) / f"fingerprint_{Path(img_folder).name}.json"
+
+
+def get_foreground_stats(data: np.ndarray) -> Tuple[np.ndarray, Dict[str, float]]:
+    """
+    the same foreground as `ZNormalization.mean`: the voxels above the mean of the volume
+    :return: the foreground voxels, and their statistics
+    """
+    data = data.astype(np.float32, copy=False)
+    foreground = data[data > data.mean()]
+    if foreground.size < 2:
+        foreground = data.ravel()
+    low, high = np.percentile(foreground, (0.5, 99.5))
+    stats = {
+        'mean': float(foreground.mean(dtype=np.float64)),
+        # unbiased, like `torch.Tensor.std`
+        'std': float(foreground.std(dtype=np.float64, ddof=1)),
+        'num_foreground': int(foreground.size),
+        'percentile_00_5': float(low),
+        'percentile_99_5': float(high),
+    }
+    return foreground, stats
+
+
+def compute_subject_fingerprint(img_path: Union[str, Path],
+                                num_samples: int = 2000) -> Tuple[str, Dict[str, float], np.ndarray]:
+    """
+    :return: subject id, the foreground statistics, and a seeded random subsample of the foreground voxels
+    """
+    img_path = Path(img_path)
+    subject_id = get_subject_id(img_path.name)
+    data = np.asarray(nib.load(str(img_path)).dataobj, dtype=np.float32).squeeze()
+    foreground, stats = get_foreground_stats(data)
+    rng = np.random.RandomState(zlib.crc32(subject_id.encode()))
+    samples = rng.choice(foreground, size=min(num_samples, foreground.size), replace=False)
+    return subject_id, stats, samples
+
+
+def run_fingerprint(img_folder: Union[str, Path],
+                    output_path: Optional[Union[str, Path]] = None,
+                    num_workers: int = 8,
+                    num_samples: int = 2000) -> Dict:
+    img_folder = Path(img_folder)
+    output_path = get_fingerprint_path(img_folder) if output_path is None else Path(output_path)
+    img_paths = sorted(img_folder / path for path, _, _ in scan_nifti(img_folder))
+    print(f"{ctime()}: computing the fingerprint of {len(img_paths)} imgs ...")
+
+    with Pool(num_workers) as pool:
+        results = pool.starmap(compute_subject_fingerprint, [(path, num_samples) for path in img_paths], chunksize=4)
+
+    samples = np.concatenate([result[2] for result in results])
+    fingerprint = {
+        'img_folder': img_folder.name,
+        'subjects': {subject_id: stats for subject_id, stats, _ in results},
+        'global': {
+            'mean': float(samples.mean()),
+            'std': float(samples.std()),
+            'percentiles': {str(p): float(v) for p, v in zip(GLOBAL_PERCENTILES,
+                                                             np.percentile(samples, GLOBAL_PERCENTILES))},
+        },
+    }
+    save_fingerprint(fingerprint, output_path)
+    print(f"{ctime()}: save the fingerprint to {output_path}")
+    return fingerprint
+
+
+def save_fingerprint(fingerprint: Dict, output_path: Union[str, Path]) -> None:
+    output_path = Path(output_path)
+    os.makedirs(output_path.parent, exist_ok=True)
+    tmp_path = output_path.parent / f".tmp-{output_path.name}"
+    with open(tmp_path, "w") as f:
+        json.dump(fingerprint, f, indent=1)
+    os.replace(tmp_path, output_path)
+
+
+def load_fingerprint(path: Union[str, Path]) -> Optional[Dict]:
+    """:return: the fingerprint, None if it does not exist"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_fingerprint(use_cropped_resampled_data: bool, path: Optional[str] = None) -> Optional[Dict]:
+    """the fingerprint of the folder used by `get_subjects`, or the one in `path`"""
+    if path is None:
+        path = get_fingerprint_path(cropped_resample_img_folder if use_cropped_resampled_data else cropped_img_folder)
+    fingerprint = load_fingerprint(path)
+    if fingerprint is None:
+        print(f"{ctime()}: no fingerprint in {path}, the normalization statistics are computed for every sample")
+    return fingerprint
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='compute the intensity statistics of every subject once')
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    parser.add_argument("--num_samples", type=int, default=2000,
+                        help='number of foreground voxels of every subject used for the global percentiles')
+    args = parser.parse_args()
+
+    run_fingerprint(cropped_resample_img_folder if args.use_resampled_img else cropped_img_folder,
+                    num_workers=args.num_workers, num_samples=args.num_samples)
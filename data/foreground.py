@@ -0,0 +1,167 @@
+"""
+the foreground (brain) bounding box, shared by the cropping of the preprocessing and by the inference
+
+The preprocessing (cropping.py, utils/cropping_resample.py) crops to the k-means mask of the image, united with the
+labelled voxels so that no label is ever cropped away. The inference computes a cheap bounding box of the brain on a
+downsampled copy of the preprocessed image, runs the grid sampler only inside it, and pads the prediction back
+to the full volume with the background label. Inside the box, the tiles without any foreground voxel (even within a
+safety margin) are not inferred at all, they are filled with the background label.
+Some code are from https://github.com/MIC-DKFZ/nnUNet/blob/master/nnunet/preprocessing/cropping.py
+"""
+from typing import List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchio
+from torchio import DATA, TYPE
+
+Bbox = List[List[int]]
+
+
+# have similar outcome to the kmeans, but kmeans have dramtically better result on some images
+def create_nonzero_mask_percentile_80(data):
+    from scipy.ndimage import binary_fill_holes
+    assert len(data.shape) == 4 or len(data.shape) == 3, "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
+    nonzero_mask = np.zeros(data.shape, dtype=bool)
+    this_mask = (data > np.percentile(data, 70))
+    nonzero_mask = nonzero_mask | this_mask
+    nonzero_mask = binary_fill_holes(nonzero_mask)
+    return nonzero_mask
+
+
+def create_nonzero_mask_kmeans(data):
+    from scipy.ndimage import binary_fill_holes
+    from sklearn.cluster import MiniBatchKMeans
+    assert len(data.shape) == 4 or len(data.shape) == 3, "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
+    nonzero_mask = np.zeros(data.shape, dtype=bool)
+    flat = data.ravel()  # Return a contiguous flattened array.
+
+    # using 1 dimension kMeans here to compute the thresholds
+    # using code from
+    # https://github.com/DM-Berger/autocrop/blob/dec40a194f3ace2d024fd24d8faa503945821015/test/test_masking.py#L19-L25
+    # batch_size controls the number of randomly selected observations in each batch.
+    km = MiniBatchKMeans(n_clusters=4, batch_size=1000).fit(flat.reshape(-1, 1))
+    gs = [km.labels_ == i for i in range(4)]
+    maxs = sorted([np.max(flat[g]) for g in gs])  # choose the max value in the min group
+    thresh = maxs[0]
+
+    this_mask = (data > thresh)
+    nonzero_mask = nonzero_mask | this_mask
+    nonzero_mask = binary_fill_holes(nonzero_mask)
+    return nonzero_mask
+
+
+def get_bbox_from_mask(mask, outside_value=0) -> Bbox:
+    mask_voxel_coords = np.where(mask != outside_value)
+    minzidx = int(np.min(mask_voxel_coords[0]))
+    maxzidx = int(np.max(mask_voxel_coords[0])) + 1
+    minxidx = int(np.min(mask_voxel_coords[1]))
+    maxxidx = int(np.max(mask_voxel_coords[1])) + 1
+    minyidx = int(np.min(mask_voxel_coords[2]))
+    maxyidx = int(np.max(mask_voxel_coords[2])) + 1
+    return [[minzidx, maxzidx], [minxidx, maxxidx], [minyidx, maxyidx]]
+
+
+def union_bbox(bbox_a: Bbox, bbox_b: Bbox) -> Bbox:
+    return [[min(a[0], b[0]), max(a[1], b[1])] for a, b in zip(bbox_a, bbox_b)]
+
+
+def crop_to_bbox(image, bbox):
+    assert len(image.shape) == 3, "only supports 3d images"
+    resizer = (slice(bbox[0][0], bbox[0][1]), slice(bbox[1][0], bbox[1][1]), slice(bbox[2][0], bbox[2][1]))
+    return image[resizer]
+
+
+def crop_to_nonzero(data, seg):
+    """
+    :param data:
+    :param seg: label image
+    :return: the image and label cropped to the k-means mask of the image, extended to every labelled voxel
+    """
+    nonzero_mask_kmeans = create_nonzero_mask_kmeans(data)
+    bbox = get_bbox_from_mask(nonzero_mask_kmeans, 0)
+    # a structure labelled outside of the intensity mask (e.g. a dark ventricle at the border) is kept
+    if np.any(seg > 0):
+        bbox = union_bbox(bbox, get_bbox_from_mask(seg > 0, 0))
+
+    data = crop_to_bbox(data, bbox)
+    seg = crop_to_bbox(seg, bbox)
+    return data, seg
+
+
+def get_brain_bbox(img: torch.Tensor, downsample: int = 4, margin: int = 8,
+                   small: Optional[torch.Tensor] = None) -> Bbox:
+    """
+    the bounding box of the brain in the preprocessed image (1, X, Y, Z), from the mean mask of a `downsample` times
+    smaller copy (like `ZNormalization.mean`), extended by `margin` voxels and clipped to the volume.
+    `small` is that copy (1, x, y, z) when it is already stored (data/pyramid.py). The mean mask does not change
+    under an affine normalization (z-normalization), so the level of the raw image gives the same box, but it does
+    under the piecewise linear histogram standardization, so do not pass the raw level with landmarks
+    """
+    spatial_shape = img.shape[1:]
+    if small is None:
+        small = F.avg_pool3d(img.detach().float().unsqueeze(0), kernel_size=downsample, ceil_mode=True)[0]
+    small = small[0].float()
+    mask = (small > small.mean()).cpu().numpy()
+    if not mask.any():
+        return [[0, dim] for dim in spatial_shape]
+    bbox = get_bbox_from_mask(mask, 0)
+    return [[max(0, low * downsample - margin), min(dim, high * downsample + margin)]
+            for (low, high), dim in zip(bbox, spatial_shape)]
+
+
+def fit_bbox_to_patch(bbox: Bbox, spatial_shape: Sequence[int], patch_size: int) -> Bbox:
+    """grow the box to at least one patch, the grid sampler needs a volume as large as the patch"""
+    fitted = []
+    for (low, high), dim in zip(bbox, spatial_shape):
+        missing = min(patch_size, dim) - (high - low)
+        if missing > 0:
+            low = max(0, low - missing // 2)
+            high = min(dim, low + min(patch_size, dim))
+            low = high - min(patch_size, dim)
+        fitted.append([low, high])
+    return fitted
+
+
+def crop_subject_to_bbox(subject: torchio.Subject, bbox: Bbox) -> torchio.Subject:
+    """a subject with the images of `subject` cropped to `bbox`, the other keys are kept"""
+    slicer = (slice(None),) + tuple(slice(low, high) for low, high in bbox)
+    cropped = {}
+    for key, value in subject.items():
+        if isinstance(value, torchio.Image):
+            cropped[key] = torchio.Image(tensor=value[DATA][slicer], type=value[TYPE])
+        else:
+            cropped[key] = value
+    return torchio.Subject(**cropped)
+
+
+def pad_from_bbox(tensor: torch.Tensor, bbox: Bbox, spatial_shape: Sequence[int], fill_value: int = 0) -> torch.Tensor:
+    """put the prediction of the box (C, x, y, z) back in a volume of `spatial_shape` filled with the background"""
+    output = torch.full((tensor.shape[0], *spatial_shape), fill_value, dtype=tensor.dtype, device=tensor.device)
+    output[(slice(None),) + tuple(slice(low, high) for low, high in bbox)] = tensor
+    return output
+
+
+def get_foreground_blocks(img: torch.Tensor, threshold: Optional[float] = None, margin: int = 8,
+                          block_size: int = 4) -> torch.Tensor:
+    """
+    whether each `block_size`^3 block of the image (1, X, Y, Z) has a voxel above `threshold` (the mean of the
+    image by default, like `ZNormalization.mean`), dilated by `margin` voxels so the boundary tiles are kept
+    """
+    data = img.detach().float()
+    threshold = data.mean() if threshold is None else threshold
+    blocks = F.max_pool3d((data > threshold).float().unsqueeze(0), kernel_size=block_size, ceil_mode=True)
+    radius = -(-margin // block_size)
+    if radius > 0:
+        blocks = F.max_pool3d(blocks, kernel_size=2 * radius + 1, stride=1, padding=radius)
+    return blocks[0, 0] > 0
+
+
+def is_empty_tile(foreground_blocks: torch.Tensor, location: Sequence[int], block_size: int = 4) -> bool:
+    """whether the tile at `location` (i0, j0, k0, i1, j1, k1) of the grid sampler has no foreground block"""
+    i0, j0, k0, i1, j1, k1 = [int(i) for i in location]
+    region = foreground_blocks[i0 // block_size:-(-i1 // block_size),
+                               j0 // block_size:-(-j1 // block_size),
+                               k0 // block_size:-(-k1 // block_size)]
+    return not bool(region.any())
@@ -0,0 +1,212 @@
+"""
+the affine and elastic augmentations resampled in one pass with `grid_sample`, instead of SimpleITK
+
+`RandomAffine` and `RandomElasticDeformation` resample every image of the subject with SimpleITK, one image at a
+time and the label with a B-spline / linear interpolation that is rounded afterwards. `RandomAffineElastic` composes
+the affine matrix and the elastic displacement field into a single sampling grid, and resamples all the images of
+the subject with it: trilinear for the intensity images, nearest for the labels, so the labels stay valid classes.
+The elastic field is the cubic B-spline of the coarse control points like SimpleITK, evaluated separably (one 1D
+basis matrix per axis). The grid is built and applied one slab of the volume at a time to bound the memory, and
+when the transform is applied to the patches (`--volume_format memmap / chunked`) it runs at patch scale.
+
+Compare it with the torchio transforms on the first subjects:
+    python -m data.fused_spatial --num_subjects 5
+"""
+import math
+from argparse import ArgumentParser
+from time import ctime, perf_counter
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchio import DATA, AFFINE, LABEL, TYPE
+from torchio.data.subject import Subject
+from torchio.transforms import RandomTransform
+
+Range = Union[float, Tuple[float, float]]
+
+SPLINE_ORDER = 3
+# the number of output voxels along the first axis resampled at once
+SLAB_SIZE = 32
+
+
+def parse_range(value: Range, around: float = 0) -> Tuple[float, float]:
+    """`v` is (around - v, around + v), like the torchio transforms"""
+    if isinstance(value, (int, float)):
+        return around - value, around + value
+    low, high = value
+    return float(low), float(high)
+
+
+def sample_uniform(low: float, high: float, size: int = 3) -> torch.Tensor:
+    return low + (high - low) * torch.rand(size, dtype=torch.float64)
+
+
+def get_spacing(affine: np.ndarray) -> torch.Tensor:
+    return torch.from_numpy(np.sqrt((np.asarray(affine, dtype=np.float64)[:3, :3] ** 2).sum(axis=0)))
+
+
+def get_rotation_matrix(radians: torch.Tensor) -> torch.Tensor:
+    """the rotation around the first, then the second, then the third axis"""
+    matrices = []
+    for axis, angle in enumerate(radians.tolist()):
+        cos, sin = math.cos(angle), math.sin(angle)
+        i, j = [k for k in range(3) if k != axis]
+        matrix = torch.eye(3, dtype=torch.float64)
+        matrix[i, i], matrix[i, j], matrix[j, i], matrix[j, j] = cos, -sin, sin, cos
+        matrices.append(matrix)
+    return matrices[2] @ matrices[1] @ matrices[0]
+
+
+def get_bspline_weights(num_points: int, num_control_points: int) -> torch.Tensor:
+    """
+    the cubic B-spline basis (num_points, num_control_points) of one axis, the control grid extends one control
+    point spacing beyond the volume like the SimpleITK `BSplineTransform` of `RandomElasticDeformation`
+    """
+    mesh_size = num_control_points - SPLINE_ORDER
+    spacing = max(num_points - 1, 1) / mesh_size
+    u = torch.arange(num_points, dtype=torch.float64)[:, None] / spacing + 1
+    t = (u - torch.arange(num_control_points, dtype=torch.float64)[None]).abs()
+    return torch.where(t < 1, 2 / 3 - t ** 2 + t ** 3 / 2, torch.where(t < 2, (2 - t) ** 3 / 6, torch.zeros_like(t)))
+
+
+class RandomAffineElastic(RandomTransform):
+    """
+    a random affine transform and / or a random elastic deformation, resampled in one pass.
+    The parameters are the ones of `RandomAffine` and `RandomElasticDeformation`, in mm, `max_displacement=0`
+    is only the affine transform and the default affine parameters are the identity.
+    The border of the intensity images is filled with their minimum, the one of the labels with the background
+    """
+    def __init__(self, scales: Range = 0, degrees: Range = 0, translation: Range = 0, num_control_points: int = 7,
+                 max_displacement: float = 0, locked_borders: int = 2, p: float = 1, seed: Optional[int] = None):
+        super().__init__(p=p, seed=seed)
+        if num_control_points <= SPLINE_ORDER:
+            raise ValueError(f"num_control_points should be larger than {SPLINE_ORDER}, got {num_control_points}")
+        self.scales = parse_range(scales, around=1)
+        self.degrees = parse_range(degrees)
+        self.translation = parse_range(translation)
+        self.num_control_points = num_control_points
+        self.max_displacement = max_displacement
+        self.locked_borders = locked_borders
+
+    def get_params(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        scales = sample_uniform(*self.scales)
+        radians = torch.deg2rad(sample_uniform(*self.degrees))
+        translation = sample_uniform(*self.translation)
+        coarse_field = None
+        if self.max_displacement > 0:
+            shape = (3,) + (self.num_control_points,) * 3
+            coarse_field = (2 * torch.rand(shape, dtype=torch.float64) - 1) * self.max_displacement
+            for border in range(self.locked_borders):
+                for dim in range(1, 4):
+                    coarse_field.index_fill_(dim, torch.tensor([border, self.num_control_points - 1 - border]), 0)
+        return scales, radians, translation, coarse_field
+
+    @staticmethod
+    def get_voxel_transform(affine: np.ndarray, scales: torch.Tensor, radians: torch.Tensor,
+                            translation: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """the matrix and the translation of the sampling in voxels, the physical transform is in mm"""
+        spacing = get_spacing(affine)
+        matrix = get_rotation_matrix(radians) @ torch.diag(1 / scales)
+        matrix = torch.diag(1 / spacing) @ matrix @ torch.diag(spacing)
+        return matrix, translation / spacing
+
+    def get_grid(self, spatial_shape: Sequence[int], start: int, stop: int, matrix: torch.Tensor,
+                 translation: torch.Tensor, field: Optional[Tuple[torch.Tensor, ...]]) -> torch.Tensor:
+        """the `grid_sample` grid (1, stop - start, Y, Z, 3) of the output slab start ... stop - 1 of the first axis"""
+        centre = (torch.tensor(spatial_shape, dtype=torch.float64) - 1) / 2
+        axes = [torch.arange(start, stop, dtype=torch.float64)] + [torch.arange(n, dtype=torch.float64)
+                                                                    for n in spatial_shape[1:]]
+        points = torch.stack(torch.meshgrid(*axes), dim=-1) - centre
+        points = points @ matrix.T + centre + translation
+        if field is not None:
+            coarse_field, weights = field
+            # the separable B-spline: one basis matrix per axis
+            displacement = torch.einsum('cijk,xi,yj,zk->xyzc', coarse_field, weights[0][start:stop], weights[1],
+                                        weights[2])
+            points = points + displacement
+        # grid_sample takes (z, y, x) normalized to [-1, 1] for an input (N, C, X, Y, Z)
+        normalized = 2 * points / (torch.tensor(spatial_shape, dtype=torch.float64) - 1).clamp(min=1) - 1
+        return normalized.flip(-1).float().unsqueeze(0)
+
+    def apply_transform(self, sample: Subject) -> dict:
+        scales, radians, translation, coarse_field = self.get_params()
+        images = list(sample.get_images(intensity_only=False))
+        first = images[0]
+        spatial_shape = tuple(first[DATA].shape[1:])
+        matrix, voxel_translation = self.get_voxel_transform(first[AFFINE], scales, radians, translation)
+        field = None
+        if coarse_field is not None:
+            spacing = get_spacing(first[AFFINE])
+            weights = [get_bspline_weights(n, self.num_control_points) for n in spatial_shape]
+            field = (coarse_field / spacing[:, None, None, None], weights)
+
+        outputs = [torch.empty(image_dict[DATA].shape, dtype=image_dict[DATA].dtype) for image_dict in images]
+        inputs = []
+        for image_dict in images:
+            data = image_dict[DATA].float().unsqueeze(0)
+            # the intensity images are shifted so their minimum is the 0 padding of `grid_sample`
+            minimum = 0 if image_dict[TYPE] == LABEL else float(data.min())
+            inputs.append((data - minimum, minimum, 'nearest' if image_dict[TYPE] == LABEL else 'bilinear'))
+        for start in range(0, spatial_shape[0], SLAB_SIZE):
+            stop = min(start + SLAB_SIZE, spatial_shape[0])
+            grid = self.get_grid(spatial_shape, start, stop, matrix, voxel_translation, field)
+            for output, (data, minimum, mode) in zip(outputs, inputs):
+                resampled = F.grid_sample(data, grid, mode=mode, padding_mode='zeros', align_corners=True)[0]
+                resampled = resampled + minimum
+                if not output.is_floating_point():
+                    resampled = resampled.round()
+                output[:, start:stop] = resampled.to(output.dtype)
+        for image_dict, output in zip(images, outputs):
+            image_dict[DATA] = output
+
+        if hasattr(sample, 'add_transform'):
+            sample.add_transform(self, {
+                'scales': scales.tolist(),
+                'degrees': torch.rad2deg(radians).tolist(),
+                'translation': translation.tolist(),
+                'max_displacement': self.max_displacement if coarse_field is not None else 0,
+            })
+        return sample
+
+
+def benchmark(num_subjects: int = 5, repeats: int = 3, use_cropped_resampled_data: bool = True):
+    """the time per subject of the torchio `OneOf` transforms and of `RandomAffineElastic` with the same parameters"""
+    import pandas as pd
+    import torchio
+    from torchio.transforms import RandomAffine, RandomElasticDeformation
+    from .get_subjects import get_subjects
+
+    subjects, _, _ = get_subjects(use_cropped_resampled_data=use_cropped_resampled_data)
+    transforms = {
+        'torchio_affine': RandomAffine(scales=(0.9, 1.1), degrees=10, translation=5),
+        'fused_affine': RandomAffineElastic(scales=(0.9, 1.1), degrees=10, translation=5),
+        'torchio_elastic': RandomElasticDeformation(num_control_points=7, max_displacement=7.5),
+        'fused_elastic': RandomAffineElastic(num_control_points=7, max_displacement=7.5),
+    }
+    rows = []
+    for subject in subjects[:num_subjects]:
+        sample = torchio.ImagesDataset([subject])[0]
+        for name, transform in transforms.items():
+            for _ in range(repeats):
+                start = perf_counter()
+                transform(sample)
+                rows.append({'subject_id': subject.get('subject_id'), 'transform': name,
+                             'seconds': perf_counter() - start})
+    df = pd.DataFrame(rows)
+    summary = df.groupby('transform')['seconds'].mean()
+    print(f"{ctime()}: seconds per subject:\n{summary}")
+    print(f"{ctime()}: speedup affine {summary['torchio_affine'] / summary['fused_affine']:.1f}x, "
+          f"elastic {summary['torchio_elastic'] / summary['fused_elastic']:.1f}x")
+    return df
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='benchmark the fused spatial transform against the torchio transforms')
+    parser.add_argument("--num_subjects", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    args = parser.parse_args()
+
+    benchmark(args.num_subjects, args.repeats, args.use_resampled_img)
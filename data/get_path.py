@@ -1,5 +1,6 @@
 from .const import ADNI_DATASET_DIR_1, ADNI_DATASET_DIR_2, ADNI_LABEL
 from .MRI import MRI
+from .subject_index import scan_nifti
 import os
 from pathlib import Path
 import pandas as pd
@@ -7,52 +8,58 @@ import random
 import re
 
 
-def get_path(dataset):
-    brain_label = ADNI_LABEL
-    originals = list(Path(ADNI_DATASET_DIR_1).glob("**/*.nii"))
-    originals.extend(list(Path(ADNI_DATASET_DIR_2).glob("**/*.nii")))
-    # print(f"len originals: {len(originals)}")
+def is_inside(path, folder) -> bool:
+    try:
+        Path(path).relative_to(folder)
+        return True
+    except ValueError:
+        return False
+
 
+def get_originals_with_label():
+    """
+    list the originals and the labels with one scandir walk of the ADNI folders,
+    then keep the originals which have a label
+    """
+    # ADNI_DATASET_DIR_2 (and the seg138 labels) are inside ADNI_DATASET_DIR_1, so its walk already lists them
+    roots = [Path(ADNI_DATASET_DIR_1)]
+    if not is_inside(ADNI_DATASET_DIR_2, ADNI_DATASET_DIR_1):
+        roots.append(Path(ADNI_DATASET_DIR_2))
+    listing = [root / path for root in roots for path, _, _ in scan_nifti(root)]
+    originals = [path for path in listing if path.name.endswith(".nii")]
     print(f"get {len(originals)} of imgs")
-    regex = re.compile(r"MALPEM-ADNI_(.*?).nii.gz")
-    brain_label_set = set(label for label in os.listdir(brain_label) if regex.match(label))
 
+    regex = re.compile(r"MALPEM-ADNI_(.*?).nii.gz")
+    if any(is_inside(ADNI_LABEL, root) for root in roots):
+        labels = [path.name for path in listing if path.parent == Path(ADNI_LABEL)]
+    else:
+        labels = os.listdir(ADNI_LABEL)
+    brain_label_set = set(label for label in labels if regex.match(label))
     for original in originals:
-        cur = Path(original)
-
-        # print("stem:", cur.stem)  # without suffix
-        # print("name:", cur.name)  # with suffix
-        label_file = "MALPEM-" + cur.name + ".gz"
+        label_file = "MALPEM-" + original.name + ".gz"
         if label_file in brain_label_set:
-            mri = MRI(dataset, original)
-            if mri.flag:
-                yield mri
+            yield original
 
 
-def get_1069_path(dataset):
-    brain_label = ADNI_LABEL
-    originals = list(Path(ADNI_DATASET_DIR_1).glob("**/*.nii"))
-    originals.extend(list(Path(ADNI_DATASET_DIR_2).glob("**/*.nii")))
-    # print(f"len originals: {len(originals)}")
+def get_path(dataset):
+    for original in get_originals_with_label():
+        # both files come from a directory listing, no need to check that they exist again
+        mri = MRI(dataset, original, check_exists=False)
+        if mri.flag:
+            yield mri
+
 
+def get_1069_path(dataset):
     fine_tune_set_file = Path(__file__).resolve().parent.parent.parent / "ADNI_MALPEM_baseline_1069.csv"
     file_df = pd.read_csv(fine_tune_set_file, sep=',')
     images_baseline_set = set(file_df['filename'])
 
-    regex = re.compile(r"MALPEM-ADNI_(.*?).nii.gz")
-    brain_label_set = set(label for label in os.listdir(brain_label) if regex.match(label))
-
     random.seed(42)
-    images_baseline_set = random.sample(images_baseline_set, 150)
+    images_baseline_set = set(random.sample(images_baseline_set, 150))
 
-    for original in originals:
-        cur = Path(original)
-
-        # print("stem:", cur.stem)  # without suffix
-        # print("name:", cur.name)  # with suffix
-        label_file = "MALPEM-" + cur.name + ".gz"
-        baseline_set_name = cur.name + ".gz"
-        if label_file in brain_label_set and baseline_set_name in images_baseline_set:
-            mri = MRI(dataset, original)
+    for original in get_originals_with_label():
+        baseline_set_name = original.name + ".gz"
+        if baseline_set_name in images_baseline_set:
+            mri = MRI(dataset, original, check_exists=False)
             if mri.flag:
-                yield mri
\ No newline at end of file
+                yield mri
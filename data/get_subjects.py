@@ -6,6 +6,8 @@ from .const import *
 import torchio as tio
 from time import ctime
 from .get_path import get_path, get_1069_path
+from .subject_index import get_paired_paths, get_subject_id
+from .metadata import filter_valid_pairs
 from .const import cropped_img_folder, cropped_label_folder, cropped_resample_img_folder, \
     cropped_resample_label_folder, COMPUTECANADA
 from glob import glob
@@ -23,13 +25,19 @@ def get_original_subjects():
     else:
         datasets = [ADNI_DATASET_DIR_1]
 
+    mri_list = list(get_path(datasets))
+    # reject the pairs whose shape / spacing / orientation do not match from their headers,
+    # before `utils/resample.py` decodes any voxel
+    img_path_list, label_path_list = filter_valid_pairs([mri.img_path for mri in mri_list],
+                                                        [mri.label_path for mri in mri_list])
+
     subjects = [
         tio.Subject(
-                img=tio.Image(path=mri.img_path, type=tio.INTENSITY),
-                label=tio.Image(path=mri.label_path, type=tio.LABEL),
+                img=tio.Image(path=img_path, type=tio.INTENSITY),
+                label=tio.Image(path=label_path, type=tio.LABEL),
                 # store the dataset name to help plot the image later
                 # dataset=mri.dataset
-            ) for mri in get_path(datasets)
+            ) for img_path, label_path in zip(img_path_list, label_path_list)
     ]
 
     visual_img_path_list = []
@@ -64,21 +72,13 @@ def get_original_subjects():
 def get_subjects(
         use_cropped_resampled_data: True
 ):
+    # the pairs come from the persisted subject index (see subject_index.py) instead of two recursive globs,
+    # and the images are paired with the labels by subject id
     if use_cropped_resampled_data:
         # using in the cropping folder
-        img_path_list = sorted([
-            Path(f) for f in sorted(glob(f"{str(cropped_resample_img_folder)}/**/*.nii*", recursive=True))
-        ])
-        label_path_list = sorted([
-            Path(f) for f in sorted(glob(f"{str(cropped_resample_label_folder)}/**/*.nii.gz", recursive=True))
-        ])
+        img_path_list, label_path_list = get_paired_paths(cropped_resample_img_folder, cropped_resample_label_folder)
     else:
-        img_path_list = sorted([
-            Path(f) for f in sorted(glob(f"{str(cropped_img_folder)}/**/*.nii*", recursive=True))
-        ])
-        label_path_list = sorted([
-            Path(f) for f in sorted(glob(f"{str(cropped_label_folder)}/**/*.nii.gz", recursive=True))
-        ])
+        img_path_list, label_path_list = get_paired_paths(cropped_img_folder, cropped_label_folder)
 
     # # the length is equal
     # print(f"get {len(img_path_list)} of img")
@@ -88,6 +88,8 @@ def get_subjects(
         tio.Subject(
             img=tio.Image(path=img_path, type=tio.INTENSITY),
             label=tio.Image(path=label_path, type=tio.LABEL),
+            # used to look up the cached statistics of the subject, see data/fingerprint.py
+            subject_id=get_subject_id(img_path.name),
             # store the dataset name to help plot the image later
             # dataset=mri.dataset
         ) for img_path, label_path in zip(img_path_list, label_path_list)
@@ -115,4 +117,15 @@ def get_subjects(
 
     print(f"{ctime()}: getting number of subjects {len(subjects)}")
     print(f"{ctime()}: getting number of path for visualizationg {len(visual_img_path_list)}")
-    return subjects, visual_img_path_list, visual_label_path_list
\ No newline at end of file
+    return subjects, visual_img_path_list, visual_label_path_list
+
+
+def split_subjects(subjects, train_ratio=0.9):
+    """
+    shuffle with a fixed seed and split to the training and validation subjects,
+    also used by data/landmarks.py so the landmarks are only trained on the training subjects
+    """
+    random.seed(42)
+    random.shuffle(subjects)  # shuffle it (in place) to pick the val set
+    num_training_subjects = int(len(subjects) * train_ratio)
+    return subjects[:num_training_subjects], subjects[num_training_subjects:]
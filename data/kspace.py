@@ -0,0 +1,279 @@
+"""
+the k-space artifacts (motion, spike, ghosting) with a single FFT and inverse FFT
+
+`RandomMotion`, `RandomSpike` and `RandomGhosting` each go in and out of k-space, and `RandomMotion` also resamples
+the whole image once per motion state with SimpleITK before its FFTs. `RandomKSpaceArtifacts` samples the three
+artifacts with their own probability and parameter ranges, and when at least one of them fires it takes one FFT of
+the image and corrupts the spectrum:
+    motion: every motion state gives a part of the lines of the last axis, like `RandomMotion`; its spectrum is the
+            spectrum of the still image rotated (interpolated on the lines it gives only) with the phase ramp of the
+            translation, so the moved images are never resampled
+    spike: the spectrum at a random position set to its maximum times the intensity, like `RandomSpike`
+    ghosting: every `num_ghosts`-th plane along an axis attenuated by the intensity, the centre of k-space restored
+then takes one inverse FFT. The spectrum is the one of the image with its centre voxel moved to the origin
+(`ifftshift` before the FFT), so it is smooth and can be interpolated, and rotating it about k = 0 rotates the image
+about its centre like `RandomMotion`. This only changes the phase of the spike and commutes with the ghosting.
+`benchmark` also replays the motion of `RandomMotion` (the moved images resampled, one FFT each) with the same
+parameters and reports how close the fused motion is.
+
+Compare it with the torchio transforms (all the artifacts forced) on the first subjects:
+    python -m data.kspace --num_subjects 5
+"""
+from argparse import ArgumentParser
+from time import ctime, perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.fft
+import torch
+from scipy.ndimage import affine_transform
+from torchio import DATA, AFFINE
+from torchio.data.subject import Subject
+from torchio.transforms import RandomTransform
+
+from .fused_spatial import Range, parse_range, sample_uniform, get_rotation_matrix, get_spacing
+
+
+def fourier_transform(array: np.ndarray) -> np.ndarray:
+    """the centred spectrum of the image centred on its voxel shape // 2, in single precision"""
+    return scipy.fft.fftshift(scipy.fft.fftn(scipy.fft.ifftshift(array.astype(np.float32, copy=False))))
+
+
+def inv_fourier_transform(spectrum: np.ndarray) -> np.ndarray:
+    return np.real(scipy.fft.fftshift(scipy.fft.ifftn(scipy.fft.ifftshift(spectrum)))).astype(np.float32)
+
+
+def get_motion_spectrum(spectrum: np.ndarray, spacing: np.ndarray, rotation: np.ndarray, translation: np.ndarray,
+                        start: int, stop: int) -> np.ndarray:
+    """
+    the lines start ... stop - 1 of the last axis of the spectrum of the image rotated (about its centre) and
+    translated in mm: F'(k) = F(R^T k) exp(-2 pi i k . t), the image is centred by `fourier_transform`
+    """
+    shape = np.array(spectrum.shape)
+    centre = shape // 2
+    # the rotation of the frequencies in the voxels of the spectrum, the voxels of the image may not be isotropic
+    scale = shape * spacing
+    matrix = np.diag(scale) @ rotation.T @ np.diag(1 / scale)
+    output_shape = (shape[0], shape[1], stop - start)
+    offset = centre - matrix @ centre + matrix @ np.array([0, 0, start])
+    moved = np.empty(output_shape, dtype=spectrum.dtype)
+    moved.real = affine_transform(spectrum.real, matrix, offset, output_shape, order=1)
+    moved.imag = affine_transform(spectrum.imag, matrix, offset, output_shape, order=1)
+
+    voxel_translation = translation / spacing
+    frequencies = [(np.arange(n) - c) / n for n, c in zip(shape, centre)]
+    phase = (frequencies[0][:, None, None] * voxel_translation[0]
+             + frequencies[1][None, :, None] * voxel_translation[1]
+             + frequencies[2][None, None, start:stop] * voxel_translation[2])
+    return moved * np.exp(-2j * np.pi * phase).astype(spectrum.dtype)
+
+
+class RandomKSpaceArtifacts(RandomTransform):
+    """
+    `RandomMotion`, `RandomSpike` and `RandomGhosting` in one transform, with their parameters and probabilities.
+    The artifacts are applied in the order of `get_train_transforms`: motion, spike, ghosting
+    """
+    def __init__(self,
+                 motion_degrees: Range = 10, motion_translation: Range = 10, motion_num_transforms: int = 2,
+                 motion_p: float = 0.2,
+                 spike_num_spikes: int = 1, spike_intensity: Range = (1, 3), spike_p: float = 0.2,
+                 ghosting_num_ghosts: Tuple[int, int] = (2, 10), ghosting_intensity: Range = (0.5, 1),
+                 ghosting_axes: Sequence[int] = (0, 1, 2), ghosting_restore: float = 0.02, ghosting_p: float = 0.01,
+                 p: float = 1, seed: Optional[int] = None):
+        super().__init__(p=p, seed=seed)
+        self.motion_degrees = parse_range(motion_degrees)
+        self.motion_translation = parse_range(motion_translation)
+        self.motion_num_transforms = motion_num_transforms
+        self.motion_p = motion_p
+        self.spike_num_spikes = spike_num_spikes
+        self.spike_intensity = parse_range(spike_intensity)
+        self.spike_p = spike_p
+        self.ghosting_num_ghosts = ghosting_num_ghosts
+        self.ghosting_intensity = parse_range(ghosting_intensity)
+        self.ghosting_axes = tuple(ghosting_axes)
+        self.ghosting_restore = ghosting_restore
+        self.ghosting_p = ghosting_p
+
+    def get_motion_params(self) -> Tuple[List[np.ndarray], List[np.ndarray], np.ndarray]:
+        """the rotation and translation of every motion state, the still one first, and the times they start"""
+        rotations, translations = [np.eye(3)], [np.zeros(3)]
+        for _ in range(self.motion_num_transforms):
+            rotations.append(get_rotation_matrix(torch.deg2rad(sample_uniform(*self.motion_degrees))).numpy())
+            translations.append(sample_uniform(*self.motion_translation).numpy())
+        # like `RandomMotion`, evenly spaced with a noise of 0.3 step
+        step = 1 / (self.motion_num_transforms + 1)
+        times = np.arange(1, self.motion_num_transforms + 1) * step
+        times = times + sample_uniform(-0.3 * step, 0.3 * step, self.motion_num_transforms).numpy()
+        return rotations, translations, times
+
+    def get_params(self) -> Dict:
+        params = {}
+        if torch.rand(1).item() < self.motion_p:
+            params['motion'] = self.get_motion_params()
+        if torch.rand(1).item() < self.spike_p:
+            params['spike'] = (torch.rand(self.spike_num_spikes, 3).numpy(),
+                               sample_uniform(*self.spike_intensity, size=1).item())
+        if torch.rand(1).item() < self.ghosting_p:
+            low, high = self.ghosting_num_ghosts
+            params['ghosting'] = (int(torch.randint(low, high + 1, (1,)).item()),
+                                  self.ghosting_axes[int(torch.randint(len(self.ghosting_axes), (1,)).item())],
+                                  sample_uniform(*self.ghosting_intensity, size=1).item())
+        return params
+
+    @staticmethod
+    def add_motion(spectrum: np.ndarray, spacing: np.ndarray, rotations: List[np.ndarray],
+                   translations: List[np.ndarray], times: np.ndarray) -> np.ndarray:
+        # the still image gives the lines of the centre of k-space, like the `sort_spectra` of `RandomMotion`
+        index = int(np.where(times > 0.5)[0].min()) if np.any(times > 0.5) else len(times)
+        order = list(range(len(rotations)))
+        order[0], order[index] = order[index], order[0]
+        last_index = spectrum.shape[2]
+        indices = (last_index * times).astype(int).tolist() + [last_index]
+        result = np.empty_like(spectrum)
+        start = 0
+        for state, stop in zip(order, indices):
+            if stop <= start:
+                continue
+            if state == 0:
+                result[..., start:stop] = spectrum[..., start:stop]
+            else:
+                result[..., start:stop] = get_motion_spectrum(spectrum, spacing, rotations[state],
+                                                              translations[state], start, stop)
+            start = stop
+        return result
+
+    @staticmethod
+    def add_spikes(spectrum: np.ndarray, positions: np.ndarray, intensity: float) -> np.ndarray:
+        """like `RandomSpike`, the spectrum is set (not added) to its maximum times the intensity"""
+        for i, j, k in np.floor(positions * np.array(spectrum.shape)).astype(int):
+            spectrum[i, j, k] = spectrum.max() * intensity
+        return spectrum
+
+    def add_ghosting(self, spectrum: np.ndarray, num_ghosts: int, axis: int, intensity: float) -> np.ndarray:
+        size = spectrum.shape[axis]
+        # the planes of the centre are kept, otherwise the ghosts are too strong
+        num_restored = max(1, int(round(self.ghosting_restore * size)))
+        low = size // 2 - num_restored // 2
+        centre = np.take(spectrum, range(low, low + num_restored), axis=axis)
+        planes = [slice(None)] * 3
+        planes[axis] = slice(None, None, num_ghosts)
+        spectrum[tuple(planes)] *= 1 - intensity
+        planes[axis] = slice(low, low + num_restored)
+        spectrum[tuple(planes)] = centre
+        return spectrum
+
+    def apply_transform(self, sample: Subject) -> dict:
+        params = self.get_params()
+        if not params:
+            return sample
+        for image_dict in sample.get_images(intensity_only=True):
+            data = image_dict[DATA]
+            spacing = get_spacing(image_dict[AFFINE]).numpy()
+            for channel in range(data.shape[0]):
+                spectrum = fourier_transform(data[channel].numpy())
+                if 'motion' in params:
+                    spectrum = self.add_motion(spectrum, spacing, *params['motion'])
+                if 'spike' in params:
+                    spectrum = self.add_spikes(spectrum, *params['spike'])
+                if 'ghosting' in params:
+                    spectrum = self.add_ghosting(spectrum, *params['ghosting'])
+                data[channel] = torch.from_numpy(inv_fourier_transform(spectrum))
+            image_dict[DATA] = data
+
+        if hasattr(sample, 'add_transform'):
+            sample.add_transform(self, {name: repr(value) for name, value in params.items()})
+        return sample
+
+
+def resample_motion(array: np.ndarray, spacing: np.ndarray, rotations: List[np.ndarray],
+                    translations: List[np.ndarray], times: np.ndarray) -> np.ndarray:
+    """
+    the motion of `RandomMotion` with the given parameters: every moved image resampled in the image space (about
+    the centre of the volume), one FFT each, their lines composed like `add_motion`, one inverse FFT
+    """
+    centre = np.array(array.shape) // 2
+    spectra = []
+    for rotation, translation in zip(rotations, translations):
+        matrix = np.diag(1 / spacing) @ rotation @ np.diag(spacing)
+        inverse = np.linalg.inv(matrix)
+        offset = centre - inverse @ (centre + translation / spacing)
+        moved = affine_transform(array.astype(np.float32, copy=False), inverse, offset, order=1, mode='nearest')
+        spectra.append(fourier_transform(moved))
+    # `add_motion` takes the lines of the moved spectra from the ones computed here
+    index = int(np.where(times > 0.5)[0].min()) if np.any(times > 0.5) else len(times)
+    order = list(range(len(rotations)))
+    order[0], order[index] = order[index], order[0]
+    last_index = array.shape[2]
+    indices = (last_index * times).astype(int).tolist() + [last_index]
+    result = np.empty_like(spectra[0])
+    start = 0
+    for state, stop in zip(order, indices):
+        result[..., start:stop] = spectra[state][..., start:stop]
+        start = max(start, stop)
+    return inv_fourier_transform(result)
+
+
+def check_motion_parity(array: np.ndarray, spacing: np.ndarray,
+                        transform: RandomKSpaceArtifacts) -> Dict[str, float]:
+    """the fused motion against `resample_motion` with the same sampled parameters"""
+    params = transform.get_motion_params()
+    fused = inv_fourier_transform(RandomKSpaceArtifacts.add_motion(fourier_transform(array), spacing, *params))
+    reference = resample_motion(array, spacing, *params)
+    error = fused - reference
+    return {
+        'motion_nrmse': float(np.sqrt((error ** 2).mean()) / (reference.std() + 1e-8)),
+        'motion_correlation': float(np.corrcoef(fused.ravel(), reference.ravel())[0, 1]),
+    }
+
+
+def benchmark(num_subjects: int = 5, repeats: int = 3, use_cropped_resampled_data: bool = True):
+    """
+    the time per subject of the three torchio transforms and of `RandomKSpaceArtifacts`, all forced to fire,
+    and the parity of the fused motion with the resampled motion of `RandomMotion`
+    """
+    import pandas as pd
+    import torchio
+    from torchio.transforms import Compose, RandomMotion, RandomSpike, RandomGhosting
+    from .get_subjects import get_subjects
+
+    subjects, _, _ = get_subjects(use_cropped_resampled_data=use_cropped_resampled_data)
+    transforms = {
+        'torchio': Compose([
+            RandomMotion(degrees=10, translation=10, num_transforms=2),
+            RandomSpike(num_spikes=1, intensity=(1, 3)),
+            RandomGhosting(num_ghosts=(2, 10), intensity=(0.5, 1)),
+        ]),
+        'fused': RandomKSpaceArtifacts(motion_p=1, spike_p=1, ghosting_p=1),
+    }
+    rows, parity = [], []
+    for subject in subjects[:num_subjects]:
+        sample = torchio.ImagesDataset([subject])[0]
+        for name, transform in transforms.items():
+            for _ in range(repeats):
+                start = perf_counter()
+                transform(sample)
+                rows.append({'subject_id': subject.get('subject_id'), 'transform': name,
+                             'seconds': perf_counter() - start})
+        array = sample['img'][DATA][0].numpy()
+        spacing = get_spacing(sample['img'][AFFINE]).numpy()
+        for _ in range(repeats):
+            parity.append({'subject_id': subject.get('subject_id'),
+                           **check_motion_parity(array, spacing, transforms['fused'])})
+    df = pd.DataFrame(rows)
+    summary = df.groupby('transform')['seconds'].mean()
+    parity = pd.DataFrame(parity)
+    print(f"{ctime()}: seconds per subject:\n{summary}")
+    print(f"{ctime()}: speedup {summary['torchio'] / summary['fused']:.1f}x")
+    print(f"{ctime()}: motion against the resampled motion, nrmse {parity['motion_nrmse'].mean():.4f}, "
+          f"correlation {parity['motion_correlation'].mean():.4f}")
+    return df.merge(parity.groupby('subject_id').mean().reset_index(), on='subject_id')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='benchmark the fused k-space artifacts against the torchio transforms')
+    parser.add_argument("--num_subjects", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    args = parser.parse_args()
+
+    benchmark(args.num_subjects, args.repeats, args.use_resampled_img)
@@ -0,0 +1,75 @@
+"""
+the labels (0 - 138) are stored as uint8, on disk and in memory
+
+The preprocessing writers save the label volumes with `to_label_array`, `ToLabelDtype` keeps the loaded labels uint8
+after the transforms, and the loss and metrics index the classes with them directly. The label folders which were
+written before with the float32 dtype of `get_data()` are converted in place with:
+    python -m data.labels
+"""
+import os
+from argparse import ArgumentParser
+from glob import glob
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime
+from typing import List, Union
+
+import nibabel as nib
+import numpy as np
+
+from .const import cropped_resample_label_folder
+
+NUM_CLASSES = 139
+LABEL_DTYPE = np.uint8
+
+
+def to_label_array(label: np.ndarray) -> np.ndarray:
+    """the label volume as uint8, the interpolated float labels are rounded to the nearest class"""
+    if label.dtype == LABEL_DTYPE:
+        return label
+    if np.issubdtype(label.dtype, np.floating):
+        label = np.rint(label)
+    if label.size and (label.min() < 0 or label.max() >= NUM_CLASSES):
+        raise ValueError(f"the labels should be in [0, {NUM_CLASSES - 1}], got [{label.min()}, {label.max()}]")
+    return label.astype(LABEL_DTYPE)
+
+
+def get_label_image(label: np.ndarray, affine: np.ndarray) -> nib.Nifti1Image:
+    """the NIfTI image of a label volume, with the uint8 dtype in its header"""
+    label_img = nib.Nifti1Image(to_label_array(label), affine)
+    label_img.set_data_dtype(LABEL_DTYPE)
+    return label_img
+
+
+def convert_label_file(path: Union[str, Path]) -> bool:
+    """rewrite one label file as uint8 in place, :return: whether it needed to be converted"""
+    path = Path(path)
+    img = nib.load(str(path))
+    if img.get_data_dtype() == LABEL_DTYPE:
+        return False
+    label_img = get_label_image(np.asarray(img.dataobj), img.affine)
+    # keep the suffix so that nibabel still knows whether to gzip it
+    tmp_path = path.parent / f".tmp-{path.name}"
+    nib.save(label_img, str(tmp_path))
+    os.replace(tmp_path, path)
+    return True
+
+
+def convert_label_folders(folders: List[Union[str, Path]], num_workers: int = 8) -> int:
+    paths = []
+    for folder in folders:
+        paths.extend(sorted(glob(f"{str(folder)}/**/*.nii*", recursive=True)))
+    print(f"{ctime()}: checking {len(paths)} label files ...")
+    with Pool(num_workers) as pool:
+        converted = sum(pool.map(convert_label_file, paths, chunksize=16))
+    print(f"{ctime()}: converted {converted} of {len(paths)} label files to uint8")
+    return converted
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='convert the label volumes to uint8 in place')
+    parser.add_argument("--folders", type=str, nargs="+", default=[str(cropped_resample_label_folder)])
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    args = parser.parse_args()
+
+    convert_label_folders(args.folders, num_workers=args.num_workers)
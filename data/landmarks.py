@@ -0,0 +1,120 @@
+"""
+train the `HistogramStandardization` landmarks of the training subjects
+
+This is the same algorithm as `torchio.transforms.HistogramStandardization.train`, but the percentiles of every
+subject are computed in a process pool and only the percentiles are kept, so the memory is bounded by one volume per
+worker. The percentiles of every subject are saved with the landmarks, `CachedHistogramStandardization`
+(data/custom_trans_class.py) then maps a sample without computing its percentiles again.
+
+Run it after `python -m data.sanitize` with:
+    python -m data.landmarks [--use_resampled_img]
+"""
+import json
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+
+from .const import cropped_img_folder, cropped_label_folder, cropped_resample_img_folder, \
+    cropped_resample_label_folder, subject_index_folder
+from .subject_index import get_paired_paths, get_subject_id
+
+# the same as torchio: the cutoff percentiles, the quartiles and the deciles
+CUTOFF = (1, 99)
+PERCENTILES = np.array(sorted(set(list(CUTOFF) + list(range(25, 100, 25)) + list(range(10, 100, 10)))))
+STANDARD_RANGE = (0, 100)
+
+
+def get_landmarks_path(img_folder: Union[str, Path]) -> Path:
+    return Path(subject_index_folder) / f"landmarks_{Path(img_folder).name}.json"
+
+
+def get_foreground_percentiles(data: np.ndarray) -> np.ndarray:
+    """the percentiles of the voxels above the mean, the same mask as `ZNormalization.mean`"""
+    data = data.astype(np.float32, copy=False)
+    foreground = data[data > data.mean()]
+    if foreground.size == 0:
+        foreground = data.ravel()
+    return np.percentile(foreground, PERCENTILES)
+
+
+def get_subject_percentiles(img_path: Union[str, Path]) -> Tuple[str, np.ndarray]:
+    img_path = Path(img_path)
+    data = np.asarray(nib.load(str(img_path)).dataobj, dtype=np.float32)
+    return get_subject_id(img_path.name), get_foreground_percentiles(data)
+
+
+def get_average_mapping(percentiles_database: np.ndarray) -> np.ndarray:
+    """map the cutoff percentiles of every subject to `STANDARD_RANGE`, and average the mapped percentiles"""
+    pc1, pc2 = percentiles_database[:, 0], percentiles_database[:, -1]
+    s1, s2 = STANDARD_RANGE
+    slopes = np.nan_to_num((s2 - s1) / (pc2 - pc1))
+    intercepts = np.mean(s1 - slopes * pc1)
+    return slopes.dot(percentiles_database) / len(percentiles_database) + intercepts
+
+
+def compute_percentiles(img_paths: Sequence[Union[str, Path]], num_workers: int = 8) -> Dict[str, np.ndarray]:
+    """:return: the foreground percentiles of every subject"""
+    print(f"{ctime()}: computing the percentiles of {len(img_paths)} imgs ...")
+    with Pool(num_workers) as pool:
+        # imap keeps only the percentiles of the finished subjects in memory, not their volumes
+        return dict(pool.imap(get_subject_percentiles, img_paths, chunksize=4))
+
+
+def train_landmarks(subject_percentiles: Dict[str, np.ndarray], subject_ids: Sequence[str]) -> np.ndarray:
+    """the landmarks of the `subject_ids` subjects, e.g. only the training subjects"""
+    return get_average_mapping(np.vstack([subject_percentiles[subject_id] for subject_id in subject_ids]))
+
+
+def save_landmarks(landmarks: np.ndarray, subject_percentiles: Dict[str, np.ndarray],
+                   output_path: Union[str, Path]) -> None:
+    output_path = Path(output_path)
+    os.makedirs(output_path.parent, exist_ok=True)
+    tmp_path = output_path.parent / f".tmp-{output_path.name}"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            'percentiles': PERCENTILES.tolist(),
+            'landmarks': landmarks.tolist(),
+            'subjects': {subject_id: values.tolist() for subject_id, values in subject_percentiles.items()},
+        }, f, indent=1)
+    os.replace(tmp_path, output_path)
+
+
+def load_landmarks(path: Optional[Union[str, Path]]) -> Optional[Dict]:
+    """:return: the landmarks, None if `path` is None"""
+    if path is None:
+        return None
+    with open(path) as f:
+        landmarks = json.load(f)
+    print(f"{ctime()}: using the histogram standardization landmarks {path}")
+    return landmarks
+
+
+if __name__ == "__main__":
+    from .get_subjects import split_subjects
+
+    parser = ArgumentParser(description='train the histogram standardization landmarks on the training subjects')
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    parser.add_argument("--output", type=str, default=None, help='defaults to the one of the image folder')
+    args = parser.parse_args()
+
+    if args.use_resampled_img:
+        img_folder, label_folder = cropped_resample_img_folder, cropped_resample_label_folder
+    else:
+        img_folder, label_folder = cropped_img_folder, cropped_label_folder
+    img_path_list, _ = get_paired_paths(img_folder, label_folder)
+    # the percentiles of all the subjects are cached, because the validation subjects are standardized too,
+    # but the landmarks are only trained on the training subjects, the same split as `Lightning_Unet.setup`
+    subject_percentiles = compute_percentiles(img_path_list, args.num_workers)
+    training_img_paths, _ = split_subjects(img_path_list)
+    landmarks = train_landmarks(subject_percentiles, [get_subject_id(path.name) for path in training_img_paths])
+
+    output_path = get_landmarks_path(img_folder) if args.output is None else args.output
+    save_landmarks(landmarks, subject_percentiles, output_path)
+    print(f"{ctime()}: landmarks {np.round(landmarks, 2).tolist()}, save them to {output_path}")
@@ -0,0 +1,248 @@
+"""
+lazy patch extraction, the patches are read from the files without loading the whole volumes
+
+The `torchio.Queue` loads and augments every subject entirely before it samples the patches, so the memory of a
+worker grows with the subjects in flight. `LazyPatchDataset` picks the patch location first and only reads that
+region, from a memory mapped NIfTI (`MemmapImage`, only the pages the patch touches are read) or from a chunked
+volume (`data/chunked_volume.ChunkedImage`, only the chunks it touches are decompressed), then augments the patch.
+It is selected with `--volume_format memmap` or `--volume_format chunked`.
+
+A gzip NIfTI cannot be mapped, every region read decompresses the file up to the region again, so the memmap format
+reads uncompressed copies of the preprocessed images and labels, written once with:
+    python -m data.lazy_patches --convert [--use_resampled_img]
+
+The patches are normalized with the statistics of the whole subject, so give a fingerprint (data/fingerprint.py) or
+landmarks (data/landmarks.py), otherwise the z-normalization only sees the patch. The region read is the patch with
+a margin on every side (half of the patch by default), the augmentation is applied to it and the patch is cropped
+from its centre, so the rotated corners are not filled with padding, the elastic field is about as coarse as on the
+whole volumes and the k-space artifacts see more than the patch.
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime
+from typing import List, Optional, Sequence, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchio
+from torch.utils.data import Dataset
+from torchio import DATA, AFFINE, PATH, TYPE
+
+from .chunked_volume import ChunkedImage, get_chunked_path, get_region_affine
+from .const import (cropped_img_folder, cropped_label_folder, cropped_resample_img_folder,
+                    cropped_resample_label_folder, chunked_img_folder, chunked_label_folder, memmap_folder)
+from .labels import get_label_image
+from .seeded import DEFAULT_SEED, get_sample_seed, seeded_rng
+from .subject_index import get_paired_paths
+
+VOLUME_FORMATS = ("nifti", "memmap", "chunked")
+# the preprocessed folders which have an uncompressed copy in `memmap_folder`
+MEMMAP_SOURCE_FOLDERS = (cropped_img_folder, cropped_label_folder,
+                         cropped_resample_img_folder, cropped_resample_label_folder)
+
+
+class MemmapImage(torchio.Image):
+    """
+    `torchio.Image` of a NIfTI file opened with `mmap`, `read_region` slices the mapped data block,
+    so only the pages of the region are read. An uncompressed `.nii` is needed to map it (see `get_memmap_path`),
+    the regions of a `.nii.gz` would be decompressed up to their last voxel for every patch
+    """
+    def __init__(self, path: Union[str, Path], type: str = torchio.INTENSITY, **kwargs):
+        self._nifti = None
+        super().__init__(path=path, type=type, **kwargs)
+
+    @property
+    def nifti(self) -> nib.Nifti1Image:
+        if self._nifti is None:
+            self._nifti = nib.load(str(self[PATH]), mmap=True)
+        return self._nifti
+
+    @property
+    def spatial_shape(self) -> Tuple[int, ...]:
+        """from the header while the image is not loaded"""
+        if self._loaded:
+            return tuple(self[DATA].shape[1:])
+        return tuple(self.nifti.shape[:3])
+
+    def load(self) -> None:
+        if self._loaded:
+            return
+        data = np.array(self.nifti.dataobj)
+        self[DATA] = torch.from_numpy(data.reshape(data.shape[:3])).unsqueeze(0)
+        self[AFFINE] = self.nifti.affine
+        self._loaded = True
+
+    def read_region(self, start: Sequence[int], size: Sequence[int]) -> Tuple[torch.Tensor, np.ndarray]:
+        """:return: the region with a channel dimension, and its affine"""
+        slicer = tuple(slice(int(i), int(i) + int(n)) for i, n in zip(start, size))
+        # the slice of the array proxy only reads the region, `np.array` copies it out of the mapping
+        data = np.array(self.nifti.dataobj[slicer])
+        return torch.from_numpy(data.reshape(data.shape[:3])).unsqueeze(0), get_region_affine(self.nifti.affine, start)
+
+    def __getstate__(self):
+        # the mapping is opened again in every loader worker
+        state = self.__dict__.copy()
+        state['_nifti'] = None
+        return state
+
+
+def get_memmap_path(path: Union[str, Path]) -> Path:
+    """the uncompressed copy of the preprocessed volume `path`, in `memmap_folder/<folder name>/<relative path>`"""
+    path = Path(path)
+    for folder in MEMMAP_SOURCE_FOLDERS:
+        try:
+            relative = path.relative_to(folder)
+        except ValueError:
+            continue
+        name = relative.name[:-len(".gz")] if relative.name.endswith(".gz") else relative.name
+        return Path(memmap_folder) / Path(folder).name / relative.parent / name
+    raise ValueError(f"{path} is not in one of the preprocessed folders {[str(f) for f in MEMMAP_SOURCE_FOLDERS]}")
+
+
+def convert_file(path: Union[str, Path], is_label: bool) -> int:
+    """write the uncompressed copy of `path`, the labels as uint8 and the images as float32"""
+    memmap_path = get_memmap_path(path)
+    os.makedirs(memmap_path.parent, exist_ok=True)
+    img = nib.load(str(path))
+    data = np.asarray(img.dataobj)
+    if is_label:
+        nib.save(get_label_image(data, img.affine), str(memmap_path))
+    else:
+        nib.save(nib.Nifti1Image(data.astype(np.float32, copy=False), img.affine), str(memmap_path))
+    return os.path.getsize(memmap_path)
+
+
+def convert_folders(use_cropped_resampled_data: bool, num_workers: int = 8) -> int:
+    """write the uncompressed copies of the image / label pairs of the folder used by `get_subjects`"""
+    if use_cropped_resampled_data:
+        img_folder, label_folder = cropped_resample_img_folder, cropped_resample_label_folder
+    else:
+        img_folder, label_folder = cropped_img_folder, cropped_label_folder
+    img_paths, label_paths = get_paired_paths(img_folder, label_folder)
+    jobs = [(path, False) for path in img_paths] + [(path, True) for path in label_paths]
+    print(f"{ctime()}: writing the uncompressed copies of {len(img_paths)} subjects ...")
+    with Pool(num_workers) as pool:
+        sizes = pool.starmap(convert_file, jobs, chunksize=4)
+    print(f"{ctime()}: save {sum(sizes) / 1024 ** 3:.2f}GB to {memmap_folder}")
+    return len(img_paths)
+
+
+def get_lazy_subjects(subjects: List[torchio.Subject], volume_format: str) -> List[torchio.Subject]:
+    """the same subjects, with lazy images of `volume_format` instead of the NIfTI images"""
+    if volume_format not in VOLUME_FORMATS:
+        raise ValueError(f"unknown volume format {volume_format}, should be one of {VOLUME_FORMATS}")
+    if volume_format == "nifti":
+        return subjects
+    lazy_subjects = []
+    for subject in subjects:
+        img_path, label_path = Path(subject['img'][PATH]), Path(subject['label'][PATH])
+        if volume_format == "chunked":
+            # the chunked volumes are converted from the cropped and resampled folders, see data/chunked_volume.py
+            img = ChunkedImage(get_chunked_path(img_path, cropped_resample_img_folder, chunked_img_folder),
+                               type=torchio.INTENSITY)
+            label = ChunkedImage(get_chunked_path(label_path, cropped_resample_label_folder, chunked_label_folder),
+                                 type=torchio.LABEL)
+        else:
+            img = MemmapImage(get_memmap_path(img_path), type=torchio.INTENSITY)
+            label = MemmapImage(get_memmap_path(label_path), type=torchio.LABEL)
+        lazy_subjects.append(torchio.Subject(img=img, label=label, subject_id=subject.get('subject_id')))
+    print(f"{ctime()}: reading the patches of {len(lazy_subjects)} subjects lazily from {volume_format} volumes")
+    return lazy_subjects
+
+
+def pad_to(data: torch.Tensor, size: Sequence[int]) -> torch.Tensor:
+    """pad the end of the spatial dimensions with 0, when the volume is smaller than the patch"""
+    padding = []
+    for dim, n in zip(reversed(data.shape[1:]), reversed(size)):
+        padding += [0, max(0, n - dim)]
+    return F.pad(data, padding) if any(padding) else data
+
+
+def pad_region(data: torch.Tensor, before: Sequence[int], after: Sequence[int]) -> torch.Tensor:
+    """pad the spatial dimensions with 0, `before` / `after` voxels on every axis"""
+    padding = []
+    for low, high in zip(reversed(before), reversed(after)):
+        padding += [low, high]
+    return F.pad(data, padding) if any(padding) else data
+
+
+class LazyPatchDataset(Dataset):
+    """
+    `samples_per_volume` patches of every subject, each one is read from its region with a `margin` and then
+    augmented and cropped, with the seed of (seed, epoch, subject index, patch index) like `data/seeded.py`,
+    call `set_epoch` every epoch
+    """
+    def __init__(self, subjects: List[torchio.Subject], patch_size: int, samples_per_volume: int,
+                 transform=None, seed: int = DEFAULT_SEED, margin: Optional[int] = None):
+        self.subjects = subjects
+        self.patch_size = (patch_size,) * 3
+        self.samples_per_volume = samples_per_volume
+        self.transform = transform
+        self.seed = seed
+        self.margin = patch_size // 2 if margin is None else margin
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.subjects) * self.samples_per_volume
+
+    def get_location(self, spatial_shape: Sequence[int], sample_seed: int) -> Tuple[List[int], List[int]]:
+        """a uniformly sampled patch, like `UniformSampler`, clipped to the volume if it is smaller"""
+        rng = np.random.RandomState(sample_seed)
+        size = [min(n, dim) for n, dim in zip(self.patch_size, spatial_shape)]
+        index_ini = [int(rng.randint(0, dim - n + 1)) for dim, n in zip(spatial_shape, size)]
+        return index_ini, size
+
+    def __getitem__(self, index: int) -> torchio.Subject:
+        subject_index, patch_index = divmod(index, self.samples_per_volume)
+        subject = self.subjects[subject_index]
+        sample_seed = get_sample_seed(self.seed, self.epoch, subject_index, patch_index)
+        spatial_shape = subject['img'].spatial_shape
+        index_ini, size = self.get_location(spatial_shape, sample_seed)
+        # the region around the patch, clipped to the volume and padded back to the same margin on every side
+        start = [max(0, i - self.margin) for i in index_ini]
+        stop = [min(dim, i + n + self.margin) for i, n, dim in zip(index_ini, size, spatial_shape)]
+        before = [self.margin - (i - low) for i, low in zip(index_ini, start)]
+        after = [self.margin - (high - i - n) for i, n, high in zip(index_ini, size, stop)]
+
+        images = {}
+        for name in ('img', 'label'):
+            data, affine = subject[name].read_region(start, [high - low for low, high in zip(start, stop)])
+            images[name] = torchio.Image(tensor=pad_region(data, before, after),
+                                         affine=get_region_affine(affine, [-n for n in before]),
+                                         type=subject[name][TYPE])
+        region = torchio.Subject(subject_id=subject.get('subject_id'), **images)
+        if self.transform is not None:
+            with seeded_rng(sample_seed):
+                region = self.transform(region)
+        # the patch is the centre of the augmented region
+        slicer = (slice(None),) + tuple(slice(self.margin, self.margin + n) for n in size)
+        images = {}
+        for name in ('img', 'label'):
+            image = region[name]
+            images[name] = torchio.Image(tensor=pad_to(image[DATA][slicer], self.patch_size),
+                                         affine=get_region_affine(image[AFFINE], [self.margin] * 3),
+                                         type=image[TYPE])
+        patch = torchio.Subject(subject_id=subject.get('subject_id'), **images)
+        patch['augmentation_seed'] = sample_seed
+        patch['epoch'] = self.epoch
+        patch['subject_index'] = subject_index
+        patch['patch_index'] = patch_index
+        return patch
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='write the uncompressed copies of the volumes read by --volume_format memmap')
+    parser.add_argument("--convert", action="store_true")
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    args = parser.parse_args()
+
+    if args.convert:
+        convert_folders(args.use_resampled_img, args.num_workers)
@@ -0,0 +1,52 @@
+"""
+default DataLoader settings, derived from the SLURM allocation and the DDP world size
+
+With `distributed_backend='ddp'` lightning starts one process per GPU on every node, and they all share the
+`SLURM_CPUS_PER_TASK` cores of the node, so every process gets its share of the cores for its loading workers.
+"""
+import inspect
+import os
+from typing import Any, Dict, Optional
+
+from torch.utils.data import DataLoader
+
+# `persistent_workers` and `prefetch_factor` were added to the DataLoader in torch 1.7
+DATALOADER_PARAMETERS = set(inspect.signature(DataLoader.__init__).parameters)
+
+
+def get_num_cpus() -> int:
+    cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if cpus is not None:
+        return int(cpus)
+    return os.cpu_count() or 1
+
+
+def get_processes_per_node(gpus: Optional[int]) -> int:
+    # launched with `srun` and one task per GPU (see utils/launcher.py), the cores of a task are already its own
+    tasks_per_node = os.environ.get("SLURM_NTASKS_PER_NODE", "1").split("(")[0]
+    if tasks_per_node.isdigit() and int(tasks_per_node) > 1:
+        return 1
+    return max(1, gpus or 1)
+
+
+def get_default_num_workers(gpus: Optional[int]) -> int:
+    """
+    the number of loading workers of one DDP process, leave one core for the process itself
+    """
+    return max(0, get_num_cpus() // get_processes_per_node(gpus) - 1)
+
+
+def get_loader_kwargs(num_workers: int,
+                      pin_memory: bool = True,
+                      persistent_workers: bool = True,
+                      prefetch_factor: int = 2) -> Dict[str, Any]:
+    """
+    the keyword arguments for `torch.utils.data.DataLoader`,
+    `persistent_workers` and `prefetch_factor` can only be given when there are workers,
+    and are dropped on a torch older than 1.7 which does not have them
+    """
+    kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = prefetch_factor
+    return {key: value for key, value in kwargs.items() if key in DATALOADER_PARAMETERS}
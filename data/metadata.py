@@ -0,0 +1,223 @@
+"""
+header-only scan of the NIfTI volumes: shape, spacing, orientation and dtype
+
+Only the headers are read (the voxels are never decoded), in a thread pool, and the result is cached in a csv file
+keyed by path, size and mtime, so a second scan of the whole ADNI tree only stats the files. The cached paths are
+relative to `DATA_ROOT`, which changes with every job on Compute Canada ($SLURM_TMPDIR/work), and the mtime is kept
+in integer nanoseconds, which the csv stores exactly.
+The scan is used to reject the image / label pairs which do not match before any voxel is loaded, and to report the
+volumes whose shape, spacing, orientation or dtype is an outlier of the dataset.
+
+Run the report with:
+    python -m data.metadata
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from time import ctime
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from .const import DATA_ROOT, metadata_cache_file, metadata_outlier_file
+
+METADATA_COLUMNS = ['path', 'size', 'mtime_ns', 'shape', 'spacing', 'orientation', 'dtype', 'error']
+# the spacing of the image and the label is considered the same below this difference (mm)
+SPACING_TOLERANCE = 1e-3
+
+
+def format_shape(shape: Sequence[int]) -> str:
+    return "x".join(str(s) for s in shape)
+
+
+def parse_shape(shape: str) -> Tuple[int, ...]:
+    return tuple(int(s) for s in shape.split("x")) if isinstance(shape, str) and shape else ()
+
+
+def parse_spacing(spacing: str) -> Tuple[float, ...]:
+    return tuple(float(s) for s in spacing.split("x")) if isinstance(spacing, str) and spacing else ()
+
+
+def squeeze_shape(shape: Sequence[int]) -> Tuple[int, ...]:
+    """the labels are saved as (x, y, z, 1), compare the shapes like `np.squeeze` does"""
+    return tuple(s for s in shape if s != 1)
+
+
+def get_cache_key(path: Union[str, Path], root: Union[str, Path] = DATA_ROOT) -> str:
+    """the path relative to `root` when it is inside, so the cache is still valid when the data is extracted again"""
+    try:
+        return str(Path(path).relative_to(root))
+    except ValueError:
+        return str(path)
+
+
+def read_header_metadata(path: Union[str, Path]) -> Dict[str, Union[str, int, float]]:
+    """read the header of one NIfTI file, the voxels are not loaded"""
+    path = str(path)
+    row = {'path': path, 'size': -1, 'mtime_ns': -1,
+           'shape': "", 'spacing': "", 'orientation': "", 'dtype': "", 'error': ""}
+    try:
+        # a file removed after the listing is reported like an unreadable one
+        stat = os.stat(path)
+        row['size'], row['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        img = nib.load(path)
+        header = img.header
+        row['shape'] = format_shape(header.get_data_shape())
+        row['spacing'] = "x".join(f"{z:.4f}" for z in header.get_zooms()[:3])
+        row['orientation'] = "".join(nib.aff2axcodes(img.affine))
+        row['dtype'] = str(header.get_data_dtype())
+    except Exception as error:
+        # broken or truncated files, they are reported instead of stopping the scan
+        row['error'] = repr(error)
+    return row
+
+
+def scan_metadata(paths: Sequence[Union[str, Path]],
+                  cache_path: Optional[Union[str, Path]] = metadata_cache_file,
+                  num_threads: int = 16,
+                  root: Union[str, Path] = DATA_ROOT) -> pd.DataFrame:
+    """
+    get the header metadata of all the `paths`, only the files which are not in the cache or whose size / mtime
+    changed have their header read, the cache is keyed by the path relative to `root`
+    """
+    paths = [str(path) for path in paths]
+    cached: Dict[str, Dict] = {}
+    if cache_path is not None and Path(cache_path).exists():
+        cached = {row['path']: row for row in pd.read_csv(cache_path, keep_default_na=False).to_dict('records')}
+
+    rows, to_read = {}, []
+    for path in paths:
+        old = cached.get(get_cache_key(path, root))
+        if old is not None and old.get('mtime_ns') not in (None, ""):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and old['size'] == stat.st_size and int(old['mtime_ns']) == stat.st_mtime_ns:
+                rows[path] = dict(old, path=path)
+                continue
+        to_read.append(path)
+
+    if to_read:
+        print(f"{ctime()}: reading the header of {len(to_read)} files ...")
+        with ThreadPool(num_threads) as pool:
+            for row in pool.imap_unordered(read_header_metadata, to_read, chunksize=8):
+                rows[row['path']] = row
+
+    df = pd.DataFrame([rows[path] for path in paths], columns=METADATA_COLUMNS)
+    if cache_path is not None and to_read:
+        cached.update((get_cache_key(path, root), dict(row, path=get_cache_key(path, root)))
+                      for path, row in rows.items())
+        cache_path = Path(cache_path)
+        os.makedirs(cache_path.parent, exist_ok=True)
+        tmp_path = cache_path.parent / f".tmp-{cache_path.name}"
+        pd.DataFrame(list(cached.values()), columns=METADATA_COLUMNS).to_csv(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    return df
+
+
+def check_pair(img_row: Dict, label_row: Dict) -> Optional[str]:
+    """
+    :return: why the image and the label can not be used together, None if they match
+    """
+    for row in (img_row, label_row):
+        if row['error']:
+            return f"can not read {row['path']}: {row['error']}"
+    img_shape, label_shape = squeeze_shape(parse_shape(img_row['shape'])), squeeze_shape(parse_shape(label_row['shape']))
+    if len(img_shape) != 3:
+        return f"the image is not 3D, shape {img_row['shape']}"
+    if img_shape != label_shape:
+        return f"the image shape {img_row['shape']} is not equal to the label shape {label_row['shape']}"
+    img_spacing, label_spacing = parse_spacing(img_row['spacing']), parse_spacing(label_row['spacing'])
+    if not np.allclose(img_spacing, label_spacing, atol=SPACING_TOLERANCE):
+        return f"the image spacing {img_row['spacing']} is not equal to the label spacing {label_row['spacing']}"
+    if img_row['orientation'] != label_row['orientation']:
+        return f"the image orientation {img_row['orientation']} is not equal to the label {label_row['orientation']}"
+    return None
+
+
+def filter_valid_pairs(img_path_list: Sequence[Union[str, Path]],
+                       label_path_list: Sequence[Union[str, Path]],
+                       cache_path: Optional[Union[str, Path]] = metadata_cache_file,
+                       num_threads: int = 16) -> Tuple[List, List]:
+    """
+    keep the image / label pairs whose headers match, without decoding any voxel
+    """
+    df = scan_metadata(list(img_path_list) + list(label_path_list), cache_path, num_threads)
+    records = df.to_dict('records')
+    img_rows, label_rows = records[:len(img_path_list)], records[len(img_path_list):]
+
+    valid_img_path_list, valid_label_path_list = [], []
+    for img_path, label_path, img_row, label_row in zip(img_path_list, label_path_list, img_rows, label_rows):
+        reason = check_pair(img_row, label_row)
+        if reason is None:
+            valid_img_path_list.append(img_path)
+            valid_label_path_list.append(label_path)
+        else:
+            print(f"{ctime()}: skip {Path(img_path).name}, {reason}")
+    print(f"{ctime()}: {len(valid_img_path_list)} of {len(img_path_list)} pairs have matching headers")
+    return valid_img_path_list, valid_label_path_list
+
+
+def find_outliers(df: pd.DataFrame, spacing_tolerance: float = 0.1) -> pd.DataFrame:
+    """
+    compare every volume with the most common orientation / dtype / number of dimensions and the median spacing,
+    :return: one row per outlier volume with the reason
+    """
+    df = df.reset_index(drop=True)
+    readable = df[df['error'] == ""]
+    outliers = [{'path': row['path'], 'reason': f"can not read: {row['error']}"}
+                for row in df[df['error'] != ""].to_dict('records')]
+    if len(readable) == 0:
+        return pd.DataFrame(outliers, columns=['path', 'reason'])
+
+    ndims = readable['shape'].map(lambda shape: len(squeeze_shape(parse_shape(shape))))
+    spacings = np.array([parse_spacing(spacing) for spacing in readable['spacing']])
+    median_spacing = np.median(spacings, axis=0)
+    common_orientation = readable['orientation'].mode()[0]
+    common_dtype = readable['dtype'].mode()[0]
+    common_ndim = ndims.mode()[0]
+
+    for row, ndim, spacing in zip(readable.to_dict('records'), ndims, spacings):
+        reasons = []
+        if ndim != common_ndim:
+            reasons.append(f"shape {row['shape']}")
+        if np.abs(spacing - median_spacing).max() > spacing_tolerance:
+            reasons.append(f"spacing {row['spacing']}, median {format_shape(np.round(median_spacing, 4))}")
+        if row['orientation'] != common_orientation:
+            reasons.append(f"orientation {row['orientation']}, mostly {common_orientation}")
+        if row['dtype'] != common_dtype:
+            reasons.append(f"dtype {row['dtype']}, mostly {common_dtype}")
+        if reasons:
+            outliers.append({'path': row['path'], 'reason': "; ".join(reasons)})
+    return pd.DataFrame(outliers, columns=['path', 'reason'])
+
+
+if __name__ == "__main__":
+    from .get_path import get_originals_with_label
+    from .const import ADNI_LABEL
+
+    parser = ArgumentParser(description='scan the NIfTI headers of the ADNI tree and report the outliers')
+    parser.add_argument("--num_threads", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 16)))
+    parser.add_argument("--spacing_tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    print(f"{ctime()}: starting ...")
+    img_path_list = list(dict.fromkeys(get_originals_with_label()))
+    label_path_list = [Path(ADNI_LABEL) / f"MALPEM-{path.name}.gz" for path in img_path_list]
+
+    img_df = scan_metadata(img_path_list, num_threads=args.num_threads)
+    label_df = scan_metadata(label_path_list, num_threads=args.num_threads)
+    outlier_df = pd.concat([find_outliers(img_df, args.spacing_tolerance),
+                            find_outliers(label_df, args.spacing_tolerance)], ignore_index=True)
+    for img_row, label_row in zip(img_df.to_dict('records'), label_df.to_dict('records')):
+        reason = check_pair(img_row, label_row)
+        if reason is not None:
+            outlier_df = outlier_df.append({'path': img_row['path'], 'reason': reason}, ignore_index=True)
+    outlier_df.to_csv(metadata_outlier_file, index=False)
+
+    print(f"{ctime()}: {len(img_df)} imgs, {len(label_df)} labels, {len(outlier_df)} outliers, "
+          f"save the report to {metadata_outlier_file}")
@@ -0,0 +1,75 @@
+"""
+multi-resolution patches: a full resolution patch and a low resolution context patch around the same centre
+
+More context with a single full resolution patch needs cubically larger patches. Here every patch also gets a
+`context_size`^3 patch of the image downsampled `context_factor` times (averaged over blocks), centred on the same
+voxel, so it covers a `context_factor` times larger field of view for a small part of the memory, e.g. a 96^3
+patch and a 48^3 context at 4x see 192^3 voxels. The context is in the batch under 'context', and the models which
+take it (model/Try/model.Module with `context_channels`) get it as a second input of `forward`.
+"""
+from typing import Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchio import DATA
+from torchio.data.subject import Subject
+
+from .seeded import SeededUniformSampler
+
+CONTEXT_KEY = 'context'
+
+
+def get_context_volume(img: torch.Tensor, factor: int) -> torch.Tensor:
+    """the image (1, X, Y, Z) averaged over `factor`^3 blocks, computed once per subject"""
+    return F.avg_pool3d(img.detach().float().unsqueeze(0), kernel_size=factor, ceil_mode=True)[0]
+
+
+def get_context_patch(context_volume: torch.Tensor, centre: Sequence[int], factor: int,
+                      context_size: int) -> torch.Tensor:
+    """
+    the `context_size`^3 patch (1, c, c, c) of the low resolution volume around the full resolution voxel `centre`,
+    the parts outside of the volume are filled with its minimum (the background)
+    """
+    context = context_volume.new_full((context_volume.shape[0],) + (context_size,) * 3, float(context_volume.min()))
+    source, target = [], []
+    for position, dim in zip(centre, context_volume.shape[1:]):
+        start = int(position) // factor - context_size // 2
+        low, high = max(0, start), min(dim, start + context_size)
+        source.append(slice(low, high))
+        target.append(slice(low - start, high - start))
+    context[(slice(None),) + tuple(target)] = context_volume[(slice(None),) + tuple(source)]
+    return context
+
+
+def get_tile_context(context_volume: torch.Tensor, locations: torch.Tensor, factor: int,
+                     context_size: int) -> torch.Tensor:
+    """the context patches (B, 1, c, c, c) of the grid sampler tiles at `locations` (i0, j0, k0, i1, j1, k1)"""
+    contexts = []
+    for location in locations:
+        location = [int(i) for i in location]
+        centre = [(low + high) // 2 for low, high in zip(location[:3], location[3:])]
+        contexts.append(get_context_patch(context_volume, centre, factor, context_size))
+    return torch.stack(contexts)
+
+
+class MultiResolutionSampler(SeededUniformSampler):
+    """
+    `SeededUniformSampler` whose patches also have the low resolution context around their centre,
+    the low resolution volume is computed once per subject, after its augmentation
+    """
+    def __init__(self, patch_size, context_factor: int = 4, context_size: int = 48):
+        super().__init__(patch_size)
+        self.context_factor = context_factor
+        self.context_size = context_size
+        self.context_volume = None
+
+    def __call__(self, sample: Subject, *args, **kwargs):
+        self.context_volume = get_context_volume(sample['img'][DATA], self.context_factor)
+        yield from super().__call__(sample, *args, **kwargs)
+
+    def extract_patch(self, sample: Subject, index_ini: np.ndarray) -> Subject:
+        patch = super().extract_patch(sample, index_ini)
+        centre = np.asarray(index_ini) + np.asarray(self.patch_size) // 2
+        patch[CONTEXT_KEY] = get_context_patch(self.context_volume, centre, self.context_factor, self.context_size)
+        return patch
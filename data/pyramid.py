@@ -0,0 +1,161 @@
+"""
+a per-subject image pyramid: the 2x, 4x and 8x downsampled images and labels, stored next to the preprocessed ones
+
+The bounding box detection, the coarse inference and the visualization only need a small copy of the subject, so
+they should not read and rescale the full volume every time. The pyramid is built once from the preprocessed
+folders, in the canonical orientation of `ToCanonical`, with
+    the images averaged over `level`^3 blocks (area downsampling),
+    the labels pooled to the most frequent label of every block (the lowest label on ties),
+and the affine scaled to the centre of the blocks. The level of `<folder>/<relative path>` is saved in
+`pyramid_folder/<folder name>/<level>x/<relative path>`, and `get_level` only reads that small file.
+
+Build it after the preprocessing (and `python -m data.labels`) with:
+    python -m data.pyramid [--use_resampled_img] [--levels 2 4 8]
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import torch
+
+from .const import (cropped_img_folder, cropped_label_folder, cropped_resample_img_folder,
+                    cropped_resample_label_folder, pyramid_folder)
+from .labels import NUM_CLASSES, get_label_image, to_label_array
+from .subject_index import get_paired_paths
+
+PYRAMID_LEVELS = (2, 4, 8)
+# the preprocessed folders which can have a pyramid
+PYRAMID_SOURCE_FOLDERS = (cropped_img_folder, cropped_label_folder,
+                          cropped_resample_img_folder, cropped_resample_label_folder)
+
+
+def get_blocks(data: np.ndarray, level: int) -> np.ndarray:
+    """the volume (X, Y, Z) as (x, y, z, `level`^3) blocks, the last partial blocks are padded with their edge"""
+    padding = [(0, -dim % level) for dim in data.shape]
+    if any(pad for _, pad in padding):
+        data = np.pad(data, padding, mode='edge')
+    x, y, z = (dim // level for dim in data.shape)
+    blocks = data.reshape(x, level, y, level, z, level).transpose(0, 2, 4, 1, 3, 5)
+    return blocks.reshape(x, y, z, level ** 3)
+
+
+def downsample_mean(data: np.ndarray, level: int) -> np.ndarray:
+    return get_blocks(data.astype(np.float32, copy=False), level).mean(axis=-1, dtype=np.float32)
+
+
+def downsample_mode(label: np.ndarray, level: int) -> np.ndarray:
+    """the most frequent label of every block, counted one slab of blocks at a time to bound the memory"""
+    blocks = get_blocks(to_label_array(label), level)
+    output = np.empty(blocks.shape[:3], dtype=blocks.dtype)
+    offsets = np.arange(blocks.shape[1] * blocks.shape[2])[:, None] * NUM_CLASSES
+    for i in range(blocks.shape[0]):
+        slab = blocks[i].reshape(-1, blocks.shape[-1])
+        counts = np.bincount((slab + offsets).ravel(), minlength=slab.shape[0] * NUM_CLASSES)
+        output[i] = counts.reshape(-1, NUM_CLASSES).argmax(axis=1).reshape(blocks.shape[1:3])
+    return output
+
+
+def get_level_affine(affine: np.ndarray, level: int) -> np.ndarray:
+    """the voxel i of the level is the centre of the voxels level * i ... level * i + level - 1"""
+    scale = np.diag([level, level, level, 1]).astype(np.float64)
+    scale[:3, 3] = (level - 1) / 2
+    return np.asarray(affine, dtype=np.float64) @ scale
+
+
+def get_level_path(path: Union[str, Path], level: int) -> Path:
+    """the file of the level `level` of the preprocessed volume `path`"""
+    path = Path(path)
+    for folder in PYRAMID_SOURCE_FOLDERS:
+        try:
+            relative = path.relative_to(folder)
+        except ValueError:
+            continue
+        return Path(pyramid_folder) / Path(folder).name / f"{level}x" / relative
+    raise ValueError(f"{path} is not in one of the preprocessed folders {[str(f) for f in PYRAMID_SOURCE_FOLDERS]}")
+
+
+def has_level(path: Union[str, Path], level: int) -> bool:
+    try:
+        return get_level_path(path, level).exists()
+    except ValueError:
+        return False
+
+
+def get_level(path: Union[str, Path], level: int) -> Tuple[torch.Tensor, np.ndarray]:
+    """
+    the level of the preprocessed volume `path`, without reading the full resolution file
+    :return: the volume with a channel dimension (1, x, y, z), and its affine
+    """
+    level_path = get_level_path(path, level)
+    if not level_path.exists():
+        raise FileNotFoundError(f"no {level}x level for {path}, build it with `python -m data.pyramid`")
+    img = nib.load(str(level_path))
+    data = np.asarray(img.dataobj)
+    return torch.from_numpy(data.reshape(data.shape[:3])).unsqueeze(0), img.affine
+
+
+def build_file(path: Union[str, Path], is_label: bool,
+               levels: Sequence[int] = PYRAMID_LEVELS) -> Dict[str, Union[str, int]]:
+    img = nib.as_closest_canonical(nib.load(str(path)))
+    data = np.asarray(img.dataobj)
+    data = data.reshape(data.shape[:3])
+    row = {'path': str(path), 'shape': str(data.shape)}
+    for level in levels:
+        level_path = get_level_path(path, level)
+        os.makedirs(level_path.parent, exist_ok=True)
+        affine = get_level_affine(img.affine, level)
+        if is_label:
+            level_img = get_label_image(downsample_mode(data, level), affine)
+        else:
+            level_img = nib.Nifti1Image(downsample_mean(data, level), affine)
+        nib.save(level_img, str(level_path))
+        row[f'{level}x_size'] = os.path.getsize(level_path)
+    return row
+
+
+def build_folders(use_cropped_resampled_data: bool, levels: Sequence[int] = PYRAMID_LEVELS,
+                  num_workers: int = 8) -> pd.DataFrame:
+    """build the levels of the image / label pairs of the folder used by `get_subjects`"""
+    if use_cropped_resampled_data:
+        img_folder, label_folder = cropped_resample_img_folder, cropped_resample_label_folder
+    else:
+        img_folder, label_folder = cropped_img_folder, cropped_label_folder
+    img_paths, label_paths = get_paired_paths(img_folder, label_folder)
+    jobs = [(path, False, levels) for path in img_paths] + [(path, True, levels) for path in label_paths]
+    print(f"{ctime()}: building the {levels} levels of {len(img_paths)} subjects ...")
+    with Pool(num_workers) as pool:
+        rows = pool.starmap(build_file, jobs, chunksize=4)
+    df = pd.DataFrame(rows)
+    sizes = ", ".join(f"{level}x {df[f'{level}x_size'].sum() / 1024 ** 2:.1f}MB" for level in levels)
+    print(f"{ctime()}: save the pyramids to {pyramid_folder} ({sizes})")
+    return df
+
+
+def get_matching_level(path: Optional[Union[str, Path]], level: int,
+                       spatial_shape: Sequence[int]) -> Optional[torch.Tensor]:
+    """
+    the stored level of the image `path` if it matches the (canonical) volume of `spatial_shape`,
+    None when there is no path, no level, or another shape (e.g. the image was resampled after the pyramid)
+    """
+    if path is None or not has_level(path, level):
+        return None
+    small, _ = get_level(path, level)
+    if tuple(small.shape[1:]) != tuple(-(-dim // level) for dim in spatial_shape):
+        return None
+    return small
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='build the downsampled levels of every preprocessed subject')
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    parser.add_argument("--levels", type=int, nargs="+", default=list(PYRAMID_LEVELS))
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    args = parser.parse_args()
+
+    build_folders(args.use_resampled_img, args.levels, args.num_workers)
@@ -0,0 +1,107 @@
+"""
+validate and repair the NaN / infinite voxels once, when the volumes are preprocessed,
+instead of checking every batch in `Lightning_Unet.prepare_batch`
+
+Run it on the already preprocessed folders with:
+    python -m data.sanitize
+every repaired volume is rewritten in place and recorded in the manifest csv file
+"""
+import os
+from argparse import ArgumentParser
+from glob import glob
+from multiprocessing import Pool
+from pathlib import Path
+from time import ctime
+from typing import Dict, List, Tuple, Union
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from .const import cropped_resample_img_folder, cropped_resample_label_folder, nan_manifest_file
+
+MANIFEST_COLUMNS = ['filename', 'path', 'num_nan', 'num_inf', 'repaired']
+
+
+def sanitize_array(data: np.ndarray) -> Tuple[np.ndarray, int, int]:
+    """
+    replace NaN by 0, and the infinite values by the finite max / min of the volume
+    :return: the repaired array (the same object if nothing needs to be repaired), number of NaN, number of inf
+    """
+    if not np.issubdtype(data.dtype, np.floating):
+        return data, 0, 0
+    nan_mask = np.isnan(data)
+    inf_mask = np.isinf(data)
+    num_nan, num_inf = int(nan_mask.sum()), int(inf_mask.sum())
+    if num_nan == 0 and num_inf == 0:
+        return data, 0, 0
+
+    data = np.array(data, copy=True)
+    data[nan_mask] = 0
+    if num_inf:
+        finite = data[np.isfinite(data)]
+        max_value = finite.max() if finite.size else 0
+        min_value = finite.min() if finite.size else 0
+        data[data == np.inf] = max_value
+        data[data == -np.inf] = min_value
+    return data, num_nan, num_inf
+
+
+def get_manifest_row(path: Union[str, Path], num_nan: int, num_inf: int) -> Dict[str, Union[str, int, bool]]:
+    path = Path(path)
+    return {
+        'filename': path.name,
+        'path': str(path),
+        'num_nan': num_nan,
+        'num_inf': num_inf,
+        'repaired': bool(num_nan or num_inf),
+    }
+
+
+def sanitize_file(path: Union[str, Path], dry_run: bool = False) -> Dict[str, Union[str, int, bool]]:
+    """check one NIfTI file, and rewrite it in place if it needs to be repaired"""
+    path = Path(path)
+    img = nib.load(str(path))
+    data, num_nan, num_inf = sanitize_array(np.asarray(img.dataobj))
+    if (num_nan or num_inf) and not dry_run:
+        repaired = nib.Nifti1Image(data, img.affine, img.header)
+        # keep the suffix so that nibabel still knows whether to gzip it
+        tmp_path = path.parent / f".tmp-{path.name}"
+        nib.save(repaired, str(tmp_path))
+        os.replace(tmp_path, path)
+    return get_manifest_row(path, num_nan, num_inf)
+
+
+def save_manifest(rows: List[Dict[str, Union[str, int, bool]]],
+                  manifest_path: Union[str, Path] = nan_manifest_file) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    df.to_csv(manifest_path, index=False)
+    return df
+
+
+def run_sanitize(folders: List[Union[str, Path]],
+                 manifest_path: Union[str, Path] = nan_manifest_file,
+                 num_workers: int = 8,
+                 dry_run: bool = False) -> pd.DataFrame:
+    paths = []
+    for folder in folders:
+        paths.extend(sorted(glob(f"{str(folder)}/**/*.nii*", recursive=True)))
+    print(f"{ctime()}: checking {len(paths)} files ...")
+
+    with Pool(num_workers) as pool:
+        rows = pool.starmap(sanitize_file, [(path, dry_run) for path in paths], chunksize=16)
+
+    df = save_manifest(rows, manifest_path)
+    print(f"{ctime()}: {int(df['repaired'].sum())} of {len(df)} files need to be repaired, "
+          f"save the manifest to {manifest_path}")
+    return df
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='repair the NaN and infinite voxels of the preprocessed volumes')
+    parser.add_argument("--num_workers", type=int, default=int(os.environ.get("SLURM_CPUS_PER_TASK", 8)))
+    parser.add_argument("--dry_run", action="store_true", help='only write the manifest, do not repair the files')
+    args = parser.parse_args()
+
+    run_sanitize([cropped_resample_img_folder, cropped_resample_label_folder],
+                 num_workers=args.num_workers, dry_run=args.dry_run)
@@ -0,0 +1,137 @@
+"""
+deterministic, replayable augmentation
+
+Every subject is augmented with its own random state, seeded by (seed, epoch, subject index), and every patch is
+sampled with (seed, epoch, subject index, patch index). The random state does not depend on which worker or which
+DDP rank loads the sample, so the augmentation is the same with any number of workers, and one slow or broken
+sample can be replayed exactly with `replay_sample`:
+    python -m data.seeded --epoch 3 --subject_index 17 --patch_index 2
+The seeds are recorded in the batch, under 'augmentation_seed', 'epoch', 'subject_index' and 'patch_index'.
+"""
+import itertools
+import random
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from time import ctime, perf_counter
+from typing import Iterator, List, Optional
+
+import numpy as np
+import torch
+import torchio
+from torchio.data.subject import Subject
+from torchio.data.sampler import UniformSampler
+
+DEFAULT_SEED = 1234567
+
+
+def get_sample_seed(*keys: int) -> int:
+    """a 32 bits seed which only depends on `keys`, e.g. (seed, epoch, subject index, patch index)"""
+    return int(np.random.SeedSequence([int(key) for key in keys]).generate_state(1)[0])
+
+
+@contextmanager
+def seeded_rng(seed: int):
+    """
+    seed the python, numpy and torch (CPU) random generators that the torchio transforms use,
+    and restore their states afterwards, so the rest of the worker (e.g. the shuffling of the Queue) is not affected
+    """
+    python_state, numpy_state = random.getstate(), np.random.get_state()
+    with torch.random.fork_rng(devices=[]):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        try:
+            yield
+        finally:
+            random.setstate(python_state)
+            np.random.set_state(numpy_state)
+
+
+class SeededImagesDataset(torchio.ImagesDataset):
+    """
+    `ImagesDataset` which applies the transform of every subject with the seed of (seed, epoch, subject index),
+    call `set_epoch` at the beginning of every epoch. `subject_indices` are the global indices of `subjects` when
+    they are the shard of one DDP rank (data/sharding.shard_subjects), the seeds do not depend on the sharding
+    """
+    def __init__(self, subjects, transform=None, seed: int = DEFAULT_SEED,
+                 subject_indices: Optional[List[int]] = None, **kwargs):
+        super().__init__(subjects, transform=transform, **kwargs)
+        self.seed = seed
+        self.epoch = 0
+        self.subject_indices = list(range(len(subjects))) if subject_indices is None else list(subject_indices)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __getitem__(self, index: int) -> Subject:
+        subject_index = self.subject_indices[index]
+        sample_seed = get_sample_seed(self.seed, self.epoch, subject_index)
+        with seeded_rng(sample_seed):
+            sample = super().__getitem__(index)
+        sample['augmentation_seed'] = sample_seed
+        sample['epoch'] = self.epoch
+        sample['subject_index'] = subject_index
+        # the random parameters of the transforms, when torchio records them
+        sample['augmentation_params'] = repr(getattr(sample, 'history', []))
+        return sample
+
+
+class SeededUniformSampler(UniformSampler):
+    """`UniformSampler` whose patch locations are seeded with (augmentation seed of the subject, patch index)"""
+    def __call__(self, sample: Subject, *args, **kwargs) -> Iterator[Subject]:
+        patches = super().__call__(sample, *args, **kwargs)
+        sample_seed = int(sample['augmentation_seed'])
+        for patch_index in itertools.count():
+            with seeded_rng(get_sample_seed(sample_seed, patch_index)):
+                try:
+                    patch = next(patches)
+                except StopIteration:
+                    return
+            patch['patch_index'] = patch_index
+            yield patch
+
+
+def replay_sample(dataset: SeededImagesDataset, epoch: int, subject_index: int,
+                  patch_index: Optional[int] = None, patch_size: Optional[int] = None) -> Subject:
+    """
+    :param subject_index: the global index of the subject, which is not its position in a sharded `dataset`
+    :return: exactly the same augmented subject (or patch if `patch_index` is given) as in the training
+    """
+    if subject_index not in dataset.subject_indices:
+        raise ValueError(f"the subject {subject_index} is not in the shard of this dataset")
+    dataset.set_epoch(epoch)
+    sample = dataset[dataset.subject_indices.index(subject_index)]
+    if patch_index is None:
+        return sample
+    patches = SeededUniformSampler(patch_size)(sample)
+    return next(itertools.islice(patches, patch_index, None))
+
+
+if __name__ == "__main__":
+    from .get_subjects import get_subjects, split_subjects
+    from .transform import get_train_transforms
+    from .fingerprint import get_fingerprint
+    from .landmarks import load_landmarks
+
+    parser = ArgumentParser(description='replay the augmentation of one training sample')
+    parser.add_argument("--epoch", type=int, required=True)
+    parser.add_argument("--subject_index", type=int, required=True)
+    parser.add_argument("--patch_index", type=int, default=None)
+    parser.add_argument("--patch_size", type=int, default=96)
+    parser.add_argument("--augmentation_seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--use_resampled_img", action="store_true", help='use the cropped and resampled images')
+    parser.add_argument("--fingerprint", type=str, default=None)
+    parser.add_argument("--landmarks", type=str, default=None)
+    args = parser.parse_args()
+
+    subjects, _, _ = get_subjects(use_cropped_resampled_data=args.use_resampled_img)
+    training_subjects, _ = split_subjects(subjects)
+    transform = get_train_transforms(get_fingerprint(args.use_resampled_img, args.fingerprint),
+                                     load_landmarks(args.landmarks))
+    dataset = SeededImagesDataset(training_subjects, transform=transform, seed=args.augmentation_seed)
+
+    start = perf_counter()
+    sample = replay_sample(dataset, args.epoch, args.subject_index, args.patch_index, args.patch_size)
+    print(f"{ctime()}: replayed {sample.get('subject_id')} in {perf_counter() - start:.2f}s, "
+          f"seed {sample['augmentation_seed']}, shape {tuple(sample['img'][torchio.DATA].shape)}")
+    print(f"augmentation parameters: {sample['augmentation_params']}")
@@ -0,0 +1,109 @@
+"""
+deterministic sharding of the training and validation subjects across the DDP ranks
+"""
+from typing import Iterator, List, Sequence, Tuple
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+def get_rank_and_world_size() -> Tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def get_shard_indices(size: int, rank: int, world_size: int) -> List[int]:
+    """
+    the indices `rank, rank + world_size, ...` of `size` items, padded at the end with repeated items
+    so that every rank has ceil(size / world_size) of them, like `DistributedSampler`
+    """
+    indices = list(range(size))
+    num_samples = -(-size // world_size)
+    total_size = num_samples * world_size
+    if indices:
+        indices = (indices * -(-total_size // size))[:total_size]
+    return indices[rank::world_size]
+
+
+def shard_subjects(subjects: Sequence, rank: int = None, world_size: int = None) -> Tuple[List, List[int]]:
+    """
+    the training subjects of this rank and their index in `subjects`, so that the seeds of the augmentation stay
+    keyed on the global index. The Queue ignores the indices of its sampler, so the ranks are given different
+    subjects instead, the same number each (padded) so they run the same number of steps
+    """
+    if rank is None or world_size is None:
+        rank, world_size = get_rank_and_world_size()
+    indices = get_shard_indices(len(subjects), rank, world_size)
+    return [subjects[i] for i in indices], indices
+
+
+class ShardedSampler(DistributedSampler):
+    """
+    Give the subjects `rank, rank + world_size, rank + 2 * world_size, ...` to every rank, in a fixed order.
+
+    Like `DistributedSampler`, the shards are padded to the same length with repeated subjects: every DDP call of
+    `validation_step` broadcasts the buffers, so all the ranks must run the same number of steps (and a rank always
+    has at least one subject). The padding is at the end of every shard, the first `num_real_samples` steps of a rank
+    are its own subjects and the metrics of the other ones are masked out, so every subject is counted exactly once.
+    Lightning does not replace the sampler of a loader which already has a `DistributedSampler`, so this one is kept
+    as it is.
+    """
+    def __init__(self, dataset: Dataset, num_replicas: int = None, rank: int = None):
+        if num_replicas is None or rank is None:
+            rank, num_replicas = get_rank_and_world_size()
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+        self.num_real_samples = len(range(len(dataset))[self.rank::self.num_replicas])
+        self.indices = get_shard_indices(len(dataset), self.rank, self.num_replicas)
+        self.num_samples = len(self.indices)
+
+    def is_padding(self, batch_idx: int) -> bool:
+        """whether the step `batch_idx` of this rank is a repeated subject"""
+        return batch_idx >= self.num_real_samples
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    a shuffled `DistributedSampler` seeded with (seed, epoch), which can start the epoch after the `start` first
+    indices of this rank, to resume a job which was stopped in the middle of an epoch
+    """
+    def __init__(self, dataset: Dataset, seed: int = 0, epoch: int = 0, start: int = 0, num_replicas: int = None,
+                 rank: int = None):
+        if num_replicas is None or rank is None:
+            rank, num_replicas = get_rank_and_world_size()
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True)
+        self.seed = seed
+        self.epoch = epoch
+        self.start = min(start, self.num_samples)
+
+    def set_epoch(self, epoch: int) -> None:
+        # the indices already trained on are only skipped in the epoch which was resumed
+        if epoch != self.epoch:
+            self.start = 0
+        super().set_epoch(epoch)
+
+    def __iter__(self) -> Iterator[int]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.dataset), generator=generator).tolist()
+        indices = [order[i] for i in get_shard_indices(len(order), self.rank, self.num_replicas)]
+        return iter(indices[self.start:])
+
+    def __len__(self) -> int:
+        return self.num_samples - self.start
+
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    """sum `tensor` over all the ranks with a single collective, a no-op without DDP"""
+    if dist.is_available() and dist.is_initialized():
+        tensor = tensor.clone()
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
@@ -0,0 +1,148 @@
+"""
+a persisted index of the image / label pairs, so that `setup` does not need to glob the whole data folder
+on every rank at every run
+
+The index is a csv file with one row per subject:
+    subject_id, img_path, label_path, shape, spacing, img_size, img_mtime_ns, label_size, label_mtime_ns
+the paths are relative to the image / label folder, because the data is extracted to a new SLURM_TMPDIR in every job,
+and the mtimes are integer nanoseconds, which the csv reads back exactly unlike a float.
+It is refreshed incrementally: only the files which are new or whose size / mtime changed have their header read.
+The images are paired with the labels by subject id instead of by their position in two sorted lists.
+"""
+import os
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from time import ctime
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from .const import subject_index_folder
+from .metadata import read_header_metadata
+from .sharding import get_rank_and_world_size
+
+INDEX_COLUMNS = ['subject_id', 'img_path', 'label_path', 'shape', 'spacing',
+                 'img_size', 'img_mtime_ns', 'label_size', 'label_mtime_ns']
+NIFTI_SUFFIXES = (".nii", ".nii.gz")
+
+
+def get_subject_id(filename: str) -> str:
+    """
+    ADNI_xxx.nii, ADNI_xxx.nii.gz and MALPEM-ADNI_xxx.nii.gz all have the subject id ADNI_xxx
+    """
+    if filename.startswith("MALPEM-"):
+        filename = filename[len("MALPEM-"):]
+    for suffix in (".nii.gz", ".nii"):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def scan_nifti(folder: Union[str, Path]) -> Iterator[Tuple[str, int, float]]:
+    """
+    walk `folder` with `os.scandir`, which gets the file size and mtime without one extra stat per file
+    :return: (path relative to `folder`, size, mtime in nanoseconds) of every NIfTI file
+    """
+    folder = str(folder)
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(NIFTI_SUFFIXES) and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    yield os.path.relpath(entry.path, folder), stat.st_size, stat.st_mtime_ns
+
+
+def read_shape_spacing(path: Union[str, Path]) -> Tuple[str, str]:
+    """only read the header, not the voxels"""
+    row = read_header_metadata(path)
+    return row['shape'], row['spacing']
+
+
+def get_index_path(img_folder: Union[str, Path]) -> Path:
+    return Path(subject_index_folder) / f"subject_index_{Path(img_folder).name}.csv"
+
+
+def build_subject_index(img_folder: Union[str, Path],
+                        label_folder: Union[str, Path],
+                        index_path: Optional[Union[str, Path]] = None,
+                        num_threads: int = 16) -> pd.DataFrame:
+    """
+    build or incrementally refresh the index of `img_folder` and `label_folder`, and save it to `index_path`
+    """
+    index_path = get_index_path(img_folder) if index_path is None else Path(index_path)
+    old_rows: Dict[str, Dict] = {}
+    if index_path.exists():
+        old_rows = {row['subject_id']: row for row in pd.read_csv(index_path).to_dict('records')}
+
+    imgs = {get_subject_id(Path(path).name): (path, size, mtime) for path, size, mtime in scan_nifti(img_folder)}
+    labels = {get_subject_id(Path(path).name): (path, size, mtime) for path, size, mtime in scan_nifti(label_folder)}
+    # keep the order of the sorted image paths, so that the shuffled train / val split does not change
+    paired_ids = sorted(set(imgs) & set(labels), key=lambda subject_id: imgs[subject_id][0])
+    if len(paired_ids) != len(imgs) or len(paired_ids) != len(labels):
+        print(f"{ctime()}: {len(imgs) - len(paired_ids)} imgs and {len(labels) - len(paired_ids)} labels "
+              f"do not have a pair, skip them")
+
+    rows, to_read = [], []
+    for subject_id in paired_ids:
+        img_path, img_size, img_mtime_ns = imgs[subject_id]
+        label_path, label_size, label_mtime_ns = labels[subject_id]
+        row = {
+            'subject_id': subject_id,
+            'img_path': img_path,
+            'label_path': label_path,
+            'img_size': img_size,
+            'img_mtime_ns': img_mtime_ns,
+            'label_size': label_size,
+            'label_mtime_ns': label_mtime_ns,
+        }
+        old = old_rows.get(subject_id)
+        # an index written with float mtimes does not have the `_ns` columns and is read again once
+        if old is not None and all(old.get(key) == row[key] for key in row):
+            row['shape'], row['spacing'] = old['shape'], old['spacing']
+        else:
+            to_read.append(row)
+        rows.append(row)
+
+    if to_read:
+        print(f"{ctime()}: reading the header of {len(to_read)} new or changed imgs ...")
+        with ThreadPool(num_threads) as pool:
+            headers = pool.map(read_shape_spacing, [Path(img_folder) / row['img_path'] for row in to_read])
+        for row, (shape, spacing) in zip(to_read, headers):
+            row['shape'], row['spacing'] = shape, spacing
+
+    df = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    os.makedirs(index_path.parent, exist_ok=True)
+    tmp_path = index_path.parent / f".tmp-{index_path.name}"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+    return df
+
+
+def load_subject_index(img_folder: Union[str, Path],
+                       label_folder: Union[str, Path],
+                       index_path: Optional[Union[str, Path]] = None) -> pd.DataFrame:
+    """
+    only rank zero builds / refreshes the index, the other ranks wait for it and then read it
+    """
+    index_path = get_index_path(img_folder) if index_path is None else Path(index_path)
+    rank, world_size = get_rank_and_world_size()
+    if rank == 0:
+        df = build_subject_index(img_folder, label_folder, index_path)
+    if world_size > 1:
+        import torch.distributed as dist
+        dist.barrier()
+    if rank != 0:
+        df = pd.read_csv(index_path)
+    return df
+
+
+def get_paired_paths(img_folder: Union[str, Path],
+                     label_folder: Union[str, Path]) -> Tuple[List[Path], List[Path]]:
+    df = load_subject_index(img_folder, label_folder)
+    img_path_list = [Path(img_folder) / path for path in df['img_path']]
+    label_path_list = [Path(label_folder) / path for path in df['label_path']]
+    return img_path_list, label_path_list
@@ -18,10 +18,25 @@ from torchio.transforms import (
     Pad,
     Compose,
 )
-from .custom_trans_class import ToSqueeze
+from .custom_trans_class import ToSqueeze, ToLabelDtype, CachedZNormalization, CachedHistogramStandardization
+from .fused_spatial import RandomAffineElastic
+from .kspace import RandomKSpaceArtifacts
 
 
-def get_train_transforms() -> Compose:
+def get_normalization(fingerprint=None, landmarks=None):
+    """
+    the histogram standardization if there are trained landmarks (data/landmarks.py),
+    else read the statistics from the dataset fingerprint when there is one, instead of computing them every sample
+    """
+    if landmarks is not None:
+        return CachedHistogramStandardization(landmarks)
+    if fingerprint is not None:
+        return CachedZNormalization(fingerprint)
+    return ZNormalization(masking_method=ZNormalization.mean)  # Subtract mean and divide by standard deviation.
+
+
+def get_train_transforms(fingerprint=None, landmarks=None) -> Compose:
+    # the random transforms are not given a `seed`, `data/seeded.SeededImagesDataset` seeds every sample instead
     training_transform = Compose([
         ToCanonical(),
         # already do this in the preprocessed part and save the image
@@ -39,14 +54,24 @@ def get_train_transforms() -> Compose:
         # ),
         # so that there are no negative values for RandomMotion
         # this might not work if I don't use the RescaleIntensity above
-        # might be add this:
-        # HistogramStandardization({'mri': landmarks}),
-        ZNormalization(masking_method=ZNormalization.mean),  # Subtract mean and divide by standard deviation.
-        RandomMotion(
-            degrees=10,
-            translation=10,
-            num_transforms=2,
-            p=0.2,
+        # with `landmarks`, the histogram standardization (data/landmarks.py) replaces the z-normalization
+        get_normalization(fingerprint, landmarks),
+        # RandomMotion (p=0.2), RandomSpike (p=0.2) and RandomGhosting (p=0.01) with the same parameters, in one
+        # FFT / inverse FFT, see data/kspace.py. The spike and the ghosting are now applied before the blur and
+        # the bias field
+        RandomKSpaceArtifacts(
+            motion_degrees=10,
+            motion_translation=10,
+            motion_num_transforms=2,
+            motion_p=0.2,
+            spike_num_spikes=1,
+            # Ratio r between the spike intensity and the maximum of the spectrum.
+            # Larger values generate more distorted images.
+            spike_intensity=(1, 3),
+            spike_p=0.2,
+            ghosting_num_ghosts=(2, 10),
+            ghosting_intensity=(0.5, 1),
+            ghosting_p=0.01,
             # seed=seed,
         ),
         RandomBlur(
@@ -54,14 +79,6 @@ def get_train_transforms() -> Compose:
             p=0.2,
             # seed=seed,
         ),
-        RandomSpike(
-            num_spikes=1,
-            # Ratio r between the spike intensity and the maximum of the spectrum.
-            # Larger values generate more distorted images.
-            intensity=(1, 3),
-            p=0.2,
-            # seed=seed,
-        ),
         RandomBiasField(
             coefficients=0.5,
             order=3,
@@ -74,20 +91,16 @@ def get_train_transforms() -> Compose:
         #     p=0.5,
         #     # seed=seed,
         # ),  # this probability might need to tune
-        RandomGhosting(
-            num_ghosts=(2, 10),
-            intensity=(0.5, 1),
-            p=0.01,
-            # seed=seed,
-        ),
+        # the parameters of RandomAffine / RandomElasticDeformation, resampled with one `grid_sample` pass for the
+        # image and the label instead of SimpleITK, see data/fused_spatial.py
         OneOf({
-            RandomAffine(
+            RandomAffineElastic(
                 scales=(0.9, 1.1),
                 degrees=10,
                 translation=5,
                 # seed=seed
             ): 0.8,
-            RandomElasticDeformation(
+            RandomAffineElastic(
                 num_control_points=7,
                 max_displacement=7.5,
                 # seed=seed,
@@ -98,23 +111,26 @@ def get_train_transforms() -> Compose:
             std=(0, 0.25),
             p=0.25,
         ),
+        # after the spatial transforms, which keep the float labels of torchio
+        ToLabelDtype(),
     ])
 
     return training_transform
 
 
-def get_val_transform() -> Compose:
+def get_val_transform(fingerprint=None, landmarks=None) -> Compose:
     validation_transform = Compose([
         ToCanonical(),
         # already do this in the preprocessed part and save the image
         # Resample(1),  # this might need to change
         # RescaleIntensity((0, 1)),
-        ZNormalization(masking_method=ZNormalization.mean),
+        get_normalization(fingerprint, landmarks),
+        ToLabelDtype(),
     ])
     return validation_transform
 
 
-def get_test_transform() -> Compose:  # do not resize in there
+def get_test_transform(fingerprint=None, landmarks=None) -> Compose:  # do not resize in there
     validation_transform = Compose([
         ToCanonical(),
         # already do this in the preprocessed part and save the image
@@ -122,6 +138,7 @@ def get_test_transform() -> Compose:  # do not resize in there
         # CropOrPad(64),
         # RescaleIntensity((0, 1)),
         # ToResize_only_image(),
-        ZNormalization(masking_method=ZNormalization.mean),
+        get_normalization(fingerprint, landmarks),
+        ToLabelDtype(),
     ])
     return validation_transform
@@ -0,0 +1,103 @@
+"""
+cache of the preprocessed validation subjects
+
+The validation subjects never change, so they are decoded and preprocessed (`get_val_transform`) only once. The
+intensities are kept as float16 and the labels as uint8 (0 - 138), in pinned CPU memory so the patches are copied
+to the GPU quickly, up to `max_bytes`; the least recently used subjects are evicted above it.
+
+The cache lives in the main process. The loader workers are started again at every validation epoch and only get
+the ids of the cached subjects, for which they return a placeholder instead of decoding the NIfTI file again.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import torch
+import torchio
+from torch.utils.data import Dataset
+from torchio import DATA
+
+
+def to_storage(img: torch.Tensor, label: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """the compact copy which is cached: float16 intensities and uint8 labels"""
+    return img.detach().to("cpu", torch.float16), label.detach().to("cpu", torch.uint8)
+
+
+class ValidationCache:
+    def __init__(self, max_bytes: int, pin_memory: bool = True):
+        """
+        :param max_bytes: the memory cap of the cache, 0 to disable it
+        :param pin_memory: whether to pin the cached tensors, only with CUDA
+        """
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.entries: "OrderedDict[str, Tuple[torch.Tensor, torch.Tensor]]" = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_nbytes(entry: Tuple[torch.Tensor, torch.Tensor]) -> int:
+        return sum(t.numel() * t.element_size() for t in entry)
+
+    def keys(self) -> List[str]:
+        return list(self.entries.keys())
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, img: torch.Tensor, label: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """cache the compact copy of `img` and `label` if it fits, and return it"""
+        entry = to_storage(img, label)
+        nbytes = self.get_nbytes(entry)
+        if nbytes > self.max_bytes or key in self.entries:
+            return entry
+        while self.num_bytes + nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= self.get_nbytes(evicted)
+        if self.pin_memory:
+            entry = tuple(t.pin_memory() for t in entry)
+        self.entries[key] = entry
+        self.num_bytes += nbytes
+        return entry
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'val_cache/subjects': len(self.entries),
+            'val_cache/gigabytes': self.num_bytes / 1024 ** 3,
+            'val_cache/hit_rate': self.hits / max(1, self.hits + self.misses),
+        }
+
+
+class PreprocessedSubjectsDataset(Dataset):
+    """
+    the validation subjects after `transform`, as compact tensors, or only their id if `cached_ids` has them
+    """
+    def __init__(self, subjects: List[torchio.Subject], transform=None):
+        self.dataset = torchio.ImagesDataset(subjects, transform=transform)
+        self.subject_ids = [subject.get('subject_id') or str(subject['img']['path']) for subject in subjects]
+        self.indices = {subject_id: index for index, subject_id in enumerate(self.subject_ids)}
+        self.cached_ids = set()
+
+    def set_cached_ids(self, cached_ids: Iterable[str]) -> None:
+        """called in the main process, the workers of the next epoch get it"""
+        self.cached_ids = set(cached_ids)
+
+    def __len__(self) -> int:
+        return len(self.subject_ids)
+
+    def load(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        sample = self.dataset[index]
+        return to_storage(sample['img'][DATA], sample['label'][DATA])
+
+    def __getitem__(self, index: int) -> dict:
+        subject_id = self.subject_ids[index]
+        if subject_id in self.cached_ids:
+            return {'subject_id': subject_id, 'cached': True}
+        img, label = self.load(index)
+        return {'subject_id': subject_id, 'cached': False, 'img': img, 'label': label}
@@ -1,14 +1,26 @@
 import pytorch_lightning as pl
 from torchio import DATA, PATH
 from torch.utils.data import DataLoader
-from data.get_subjects import get_subjects
+from data.get_subjects import get_subjects, split_subjects
 from data.const import COMPUTECANADA
 from data.transform import get_train_transforms, get_val_transform, get_test_transform
+from data.loader_config import get_default_num_workers, get_loader_kwargs
+from data.sharding import ShardedSampler, ResumableDistributedSampler, all_reduce_sum, shard_subjects
+from data.fingerprint import get_fingerprint
+from data.landmarks import load_landmarks
+from data.seeded import SeededImagesDataset, SeededUniformSampler
+from data.multi_resolution import MultiResolutionSampler, CONTEXT_KEY, get_context_volume, get_tile_context
+from data.val_cache import ValidationCache, PreprocessedSubjectsDataset
+from data.lazy_patches import LazyPatchDataset, get_lazy_subjects, VOLUME_FORMATS
+from data.pyramid import get_matching_level
+from data.foreground import (get_brain_bbox, fit_bbox_to_patch, crop_subject_to_bbox, pad_from_bbox,
+                             get_foreground_blocks, is_empty_tile)
 from argparse import ArgumentParser
 from model.unet.unet import UNet
 from model.highResNet.highresnet import HighResNet
 from model.Try.model import Module
 from utils.matrix import get_score
+from utils.cascade import downsample_image, get_uncertain_voxels, upsample_labels, crop_location
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 import inspect
 import torch.nn.functional as F
@@ -19,16 +31,19 @@ from monai.losses import DiceLoss
 # from monai.networks.nets import SegResNet, UNet, VNet
 from monai.networks.nets import UNet as monai_UNet
 # from utils.gpu_mem_track import MemTracker
+from utils.mem_track import MemorySnapshotter
+from utils.timing import SpanTimer, timed_method
+from utils.nan_check import AsyncNanChecker
 import torchio
 import torch
 import random
 import os
 from pathlib import Path
 import pandas as pd
-from pytorch_lightning.metrics.functional import to_onehot
 from utils.enums import LossReduction
 
 import gc
+import time
 import datetime
 import pynvml
 import numpy as np
@@ -44,6 +59,11 @@ class Lightning_Unet(pl.LightningModule):
         self.kernel_size = self.hparams.kernel_size
         self.downsampling_type = 'max'
         self.normalization = 'InstanceNorm3d'
+        if self.hparams.context_factor > 0:
+            if self.hparams.model != "NewModel":
+                raise ValueError(f"the low resolution context is only taken by NewModel, not {self.hparams.model}")
+            if self.hparams.volume_format != "nifti":
+                raise ValueError("the low resolution context needs the whole volumes, use --volume_format nifti")
         if self.hparams.model == "Unet" or self.hparams.model == "ResUnet":
             self.unet = UNet(
                 in_channels=1,
@@ -66,7 +86,10 @@ class Lightning_Unet(pl.LightningModule):
             self.unet = Module(
                 in_channels=1,
                 out_channels=139,
-                dimensions=3
+                dimensions=3,
+                # the low resolution context branch, see data/multi_resolution.py
+                context_channels=self.hparams.context_channels if self.hparams.context_factor > 0 else 0,
+                context_factor=self.hparams.context_factor,
             )
 
         # elif self.hparams.model == "SegResnet":
@@ -104,25 +127,55 @@ class Lightning_Unet(pl.LightningModule):
         # Number of patches to extract from each volume. A small number of patches ensures a large variability
         # in the queue, but training will be slower.
         self.samples_per_volume = 5
-        self.num_workers = 0
+        # data loading, by default every DDP process gets its share of the SLURM_CPUS_PER_TASK cores
+        if self.hparams.num_workers is None:
+            self.num_workers = get_default_num_workers(getattr(self.hparams, "gpus", 1))
+        else:
+            self.num_workers = self.hparams.num_workers
+        # a few workers are enough to decode the next validation volumes while the current one is inferred
+        self.val_num_workers = min(self.num_workers, self.hparams.prefetch_factor)
+        self.pin_memory = not self.hparams.no_pin_memory
+        self.persistent_workers = not self.hparams.no_persistent_workers
         if not self.hparams.include_background:
             print("It is not included the background.")
 
+        # cheap allocator snapshots at the named points of every step, flushed to the logger periodically
+        self.mem_tracker = MemorySnapshotter(enabled=self.hparams.track_memory,
+                                             flush_every=self.hparams.memory_flush_every)
+        # named span timing of the data -> forward -> loss -> metric pipeline
+        self.timer = SpanTimer(enabled=self.hparams.timing_log_every > 0,
+                               log_every=self.hparams.timing_log_every,
+                               trace_start_step=self.hparams.trace_start_step,
+                               trace_num_steps=self.hparams.trace_num_steps,
+                               trace_dir=self.hparams.trace_dir)
+        self._last_step_end = None
+        # the NaN are repaired once by data/sanitize.py, here only an optional sampled check is left
+        self.nan_checker = AsyncNanChecker(check_every=self.hparams.nan_check_every)
+        # the validation subjects are preprocessed once and kept as float16 / uint8 in pinned memory
+        self.val_cache = ValidationCache(int(self.hparams.val_cache_gb * 1024 ** 3), pin_memory=self.pin_memory)
+        # the grid tiles which were not inferred because they have no foreground, since the last validation epoch
+        self.num_tiles = 0
+        self.num_skipped_tiles = 0
+        # the tiles of the cascade which kept the coarse labels / were inferred at full resolution
+        self.num_coarse_tiles = 0
+        self.num_fine_tiles = 0
+        # the position in the training epoch, to resume a job stopped in the middle of an epoch: the batches of the
+        # epoch done before the restart, the ones skipped by the loader of this epoch, and the ones done since
+        self.resume_epoch_batches = 0
+        self.epoch_batch_offset = 0
+        self.epoch_batches = 0
+
         if not COMPUTECANADA:
             self.max_queue_length = 10
             self.patch_size = 48
-            self.num_workers = 8
             self.subjects, self.visual_img_path_list, self.visual_label_path_list = get_subjects(
                 use_cropped_resampled_data=True
             )
-            random.seed(42)
-            random.shuffle(self.subjects)  # shuffle it to pick the val set
-            num_subjects = len(self.subjects)
-            num_training_subjects = int(num_subjects * 0.9)  # using only around 25 images
-            self.training_subjects = self.subjects[:num_training_subjects]
-            self.validation_subjects = self.subjects[num_training_subjects:]
-
-    def forward(self, x: Tensor) -> Tensor:
+            self.training_subjects, self.validation_subjects = split_subjects(self.subjects)
+
+    def forward(self, x: Tensor, context: Tensor = None) -> Tensor:
+        if self.hparams.context_factor > 0:
+            return self.unet(x, context)
         return self.unet(x)
 
     # Called at the beginning of fit and test. This is a good hook when you need to build models dynamically or
@@ -130,20 +183,39 @@ class Lightning_Unet(pl.LightningModule):
     def setup(self, stage):
         self.subjects, self.visual_img_path_list, self.visual_label_path_list = get_subjects(
             use_cropped_resampled_data=self.hparams.use_resampled_img)
-        random.seed(42)
-        random.shuffle(self.subjects)  # shuffle it to pick the val set
-        num_subjects = len(self.subjects)
-        num_training_subjects = int(num_subjects * 0.9)  # using only around 25 images
-        self.training_subjects = self.subjects[:num_training_subjects]
-        self.validation_subjects = self.subjects[num_training_subjects:]
+        self.training_subjects, self.validation_subjects = split_subjects(self.subjects)
         self.test_subjects = self.subjects
+        # the validation volumes are tensors, their path finds the stored pyramid levels (data/pyramid.py)
+        self.img_paths = {subject.get('subject_id'): subject['img'][PATH] for subject in self.subjects}
         self.val_times = 0
         self.test_times = 0
         self.df = pd.DataFrame(columns=['filename'])
+        self.timer.rank = self.global_rank
+        # the foreground mean / std of every subject, computed once by data/fingerprint.py
+        self.fingerprint = get_fingerprint(self.hparams.use_resampled_img, self.hparams.fingerprint)
+        # the histogram standardization landmarks of data/landmarks.py, they replace the z-normalization
+        self.landmarks = load_landmarks(self.hparams.landmarks)
 
     def train_dataloader(self) -> DataLoader:
-        training_transform = get_train_transforms()
-        train_imageDataset = torchio.ImagesDataset(self.training_subjects, transform=training_transform)
+        training_transform = get_train_transforms(self.fingerprint, self.landmarks)
+        if self.hparams.volume_format != "nifti":
+            return self.lazy_train_dataloader(training_transform)
+        # every subject / patch is augmented with the seed of (seed, epoch, subject index, patch index),
+        # so the augmentation does not depend on the number of workers and ranks, see data/seeded.py.
+        # The Queue ignores the indices of its sampler, so every DDP rank gets its own shard of the subjects,
+        # which keep their global index for the seeds
+        rank_subjects, subject_indices = shard_subjects(self.training_subjects)
+        # a job resumed in the middle of an epoch skips the subjects of the patches it already trained on
+        skipped_subjects = min(len(rank_subjects) - 1,
+                               self.resume_epoch_batches * self.hparams.batch_size // self.samples_per_volume)
+        if skipped_subjects > 0:
+            print(f"{ctime()}: resume the epoch {self.current_epoch} after {skipped_subjects} subjects")
+            rank_subjects, subject_indices = rank_subjects[skipped_subjects:], subject_indices[skipped_subjects:]
+        self.epoch_batch_offset = max(0, skipped_subjects) * self.samples_per_volume // self.hparams.batch_size
+        train_imageDataset = SeededImagesDataset(rank_subjects, transform=training_transform,
+                                                 seed=self.hparams.augmentation_seed, subject_indices=subject_indices)
+        train_imageDataset.set_epoch(self.current_epoch)
+        self.train_imageDataset = train_imageDataset
 
         patches_training_set = torchio.Queue(
             subjects_dataset=train_imageDataset,
@@ -156,7 +228,7 @@ class Lightning_Unet(pl.LightningModule):
             # but training will be slower.
             samples_per_volume=self.samples_per_volume,
             #  A sampler used to extract patches from the volumes.
-            sampler=torchio.sampler.UniformSampler(self.patch_size),
+            sampler=self.get_sampler(),
             num_workers=self.num_workers,
             # If True, the subjects dataset is shuffled at the beginning of each epoch,
             # i.e. when all patches from all subjects have been processed
@@ -166,14 +238,65 @@ class Lightning_Unet(pl.LightningModule):
             verbose=True,
         )
 
+        # the Queue loads the subjects with its own workers, so the loader on top of it must not have workers.
+        # The subjects are already sharded, so the sampler of one replica keeps lightning from adding a
+        # `DistributedSampler` which would only take 1 / world_size of the patches of this rank
         training_loader = DataLoader(patches_training_set,
-                                     batch_size=self.hparams.batch_size)
+                                     batch_size=self.hparams.batch_size,
+                                     sampler=ShardedSampler(patches_training_set, num_replicas=1, rank=0),
+                                     pin_memory=self.pin_memory)
 
         print(f"{ctime()}: getting number of training subjects {len(training_loader)}")
         return training_loader
 
+    def get_sampler(self) -> SeededUniformSampler:
+        """the full resolution patches, and their low resolution context if the model takes it"""
+        if self.hparams.context_factor > 0:
+            return MultiResolutionSampler(self.patch_size, self.hparams.context_factor, self.hparams.context_size)
+        return SeededUniformSampler(self.patch_size)
+
+    def get_context_volume(self, subject: torchio.Subject):
+        """the low resolution image the context of the tiles is cropped from, None without context"""
+        if self.hparams.context_factor <= 0:
+            return None
+        return get_context_volume(subject['img'][DATA], self.hparams.context_factor)
+
+    def get_tile_context(self, context_volume, locations):
+        if context_volume is None:
+            return None
+        return get_tile_context(context_volume, locations, self.hparams.context_factor,
+                                self.hparams.context_size).to(self.device, non_blocking=True)
+
+    def lazy_train_dataloader(self, training_transform) -> DataLoader:
+        """the patches are read from their region only, without the Queue, see data/lazy_patches.py"""
+        if self.fingerprint is None and self.landmarks is None:
+            print(f"{ctime()}: no fingerprint or landmarks, the lazy patches are normalized with their own statistics")
+        train_patches = LazyPatchDataset(get_lazy_subjects(self.training_subjects, self.hparams.volume_format),
+                                         self.patch_size, self.samples_per_volume, transform=training_transform,
+                                         seed=self.hparams.augmentation_seed, margin=self.hparams.lazy_patch_margin)
+        train_patches.set_epoch(self.current_epoch)
+        self.train_imageDataset = train_patches
+        # a job resumed in the middle of an epoch skips the patches it already trained on
+        sampler = ResumableDistributedSampler(train_patches, seed=self.hparams.augmentation_seed,
+                                              epoch=self.current_epoch,
+                                              start=self.resume_epoch_batches * self.hparams.batch_size)
+        self.epoch_batch_offset = self.resume_epoch_batches
+        # the workers are started again every epoch to get the epoch of `set_epoch`
+        training_loader = DataLoader(train_patches, batch_size=self.hparams.batch_size, sampler=sampler,
+                                     **get_loader_kwargs(self.num_workers, self.pin_memory, False,
+                                                         self.hparams.prefetch_factor))
+        print(f"{ctime()}: getting number of training batches {len(training_loader)}")
+        return training_loader
+
     def val_dataloader(self) -> DataLoader:
-        val_imageDataset = torchio.ImagesDataset(self.validation_subjects)
+        # the workers return the preprocessed subjects, or only the id of the ones already in `self.val_cache`
+        val_imageDataset = PreprocessedSubjectsDataset(self.validation_subjects,
+                                                       transform=get_val_transform(self.fingerprint, self.landmarks))
+        # the loader is built again every epoch (`reload_dataloaders_every_epoch`), so the new dataset gets the ids
+        val_imageDataset.set_cached_ids(self.val_cache.keys())
+        self.val_imageDataset = val_imageDataset
+        # the workers need to be started again every epoch to get the ids of the cached subjects
+        persistent_workers = self.persistent_workers and self.val_cache.max_bytes == 0
 
         # patches_validation_set = torchio.Queue(
         #     subjects_dataset=val_imageDataset,
@@ -187,7 +310,12 @@ class Lightning_Unet(pl.LightningModule):
         # )
 
         # the batch_size here only could be 1 because we only could handle one image to aggregate
-        val_loader = DataLoader(val_imageDataset, batch_size=1)
+        # the workers keep decoding the next subjects while the current one is inferred,
+        # and every DDP rank only infers its own shard of the validation subjects
+        self.val_sampler = ShardedSampler(val_imageDataset)
+        val_loader = DataLoader(val_imageDataset, batch_size=1, sampler=self.val_sampler,
+                                **get_loader_kwargs(self.val_num_workers, self.pin_memory,
+                                                    persistent_workers, self.hparams.prefetch_factor))
         print(f"{ctime()}: getting number of validation subjects {len(val_loader)}")
         return val_loader
 
@@ -206,7 +334,9 @@ class Lightning_Unet(pl.LightningModule):
         # )
 
         # the batch_size here only could be 1 because we only could handle one image to aggregate
-        test_loader = DataLoader(test_imageDataset, batch_size=1)
+        test_loader = DataLoader(test_imageDataset, batch_size=1,
+                                 **get_loader_kwargs(self.val_num_workers, self.pin_memory,
+                                                     self.persistent_workers, self.hparams.prefetch_factor))
         print(f"{ctime()}: getting number of validation subjects {len(test_loader)}")
         return test_loader
 
@@ -220,8 +350,9 @@ class Lightning_Unet(pl.LightningModule):
                 # this also need to fine tune
                 'scheduler': ReduceLROnPlateau(optimizer=optimizer, mode='max', factor=0.5,
                                                patience=10, min_lr=1e-6),
-                'monitor': 'val_checkpoint_on',  # Default: val_loss
-                'reduce_on_plateau': False,  # For ReduceLROnPlateau scheduler, default
+                # the dice reduced over all the ranks in `validation_epoch_end`
+                'monitor': 'val_dice',  # Default: val_loss
+                'reduce_on_plateau': True,
                 # 'interval': 'step',
                 'interval': 'epoch',
                 # need to change here
@@ -231,6 +362,15 @@ class Lightning_Unet(pl.LightningModule):
 
         return [optimizer], [lr_dict]
 
+    def optimizer_step(self, epoch, batch_idx, optimizer, optimizer_idx, *args, **kwargs):
+        # linear warmup of the learning rate over the first optimizer steps, ReduceLROnPlateau takes over after it
+        if self.trainer.global_step < self.hparams.warmup_steps:
+            lr_scale = (self.trainer.global_step + 1) / self.hparams.warmup_steps
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr_scale * self.hparams.learning_rate
+        super().optimizer_step(epoch, batch_idx, optimizer, optimizer_idx, *args, **kwargs)
+
+    @timed_method("prepare_batch")
     def prepare_batch(self, batch):
         inputs, targets = batch["img"][DATA], batch["label"][DATA]
 
@@ -239,17 +379,21 @@ class Lightning_Unet(pl.LightningModule):
         # print(f"img path: {img_path}")
         # print(f"label path: {label_path}")
 
-        if torch.isnan(inputs).any():
-            print("there is nan in input data!")
-            inputs[inputs != inputs] = 0
-        if torch.isnan(targets).any():
-            print("there is nan in targets data!")
-            targets[targets != targets] = 0
+        # no `torch.isnan(...).any()` here, it forces a device sync on every batch
+        with self.timer.span("nan_check", inputs.device):
+            self.nan_checker.check(self.global_step, inputs, targets)
+        self.mem_tracker.snapshot("prepare_batch", self.global_step, inputs.device)
         return inputs, targets
 
     def training_step(self, batch, batch_idx):
+        self.epoch_batches = batch_idx + 1
+        if self._last_step_end is not None:
+            # the time spent waiting for the Queue between the end of the previous step and this one
+            self.timer.add("data_wait", self._last_step_end)
         inputs, targets = self.prepare_batch(batch)
-        pred = self(inputs)
+        with self.timer.span("forward", inputs.device):
+            pred = self(inputs, batch.get(CONTEXT_KEY))
+        self.mem_tracker.snapshot("forward", self.global_step, inputs.device)
         # diceloss = DiceLoss(include_background=True, to_onehot_y=True)
         # loss = diceloss.forward(input=probs, target=targets)
         # dice, iou, _, _ = get_score(batch_preds, batch_targets, include_background=True)
@@ -263,8 +407,10 @@ class Lightning_Unet(pl.LightningModule):
         #     dice_score, _, _, _ = get_score(torch.unsqueeze(prob, 0), torch.unsqueeze(target, 0))
         #     log_all_info(self, input, target, prob, batch_idx, "training", dice_score.item())
         # loss = F.binary_cross_entropy_with_logits(logits, targets)
-        diceloss = DiceLoss(include_background=self.hparams.include_background, to_onehot_y=True)
-        loss = diceloss.forward(input=pred, target=targets)
+        with self.timer.span("loss", inputs.device):
+            diceloss = DiceLoss(include_background=self.hparams.include_background, to_onehot_y=True)
+            loss = diceloss.forward(input=pred, target=targets)
+        self.mem_tracker.snapshot("loss", self.global_step, inputs.device)
         # What is the loos I need to set here? when I am using the batch size?
 
         # gdloss = GeneralizedDiceLoss(include_background=True, to_onehot_y=True)
@@ -289,6 +435,15 @@ class Lightning_Unet(pl.LightningModule):
         #     # 'progress_bar': {'train_loss': loss}
         # }
 
+    def on_after_backward(self):
+        self.mem_tracker.snapshot("backward", self.global_step, self.device)
+        if self.mem_tracker.should_flush(self.global_step):
+            self.mem_tracker.flush(self.logger, self.global_step, self.device)
+
+    def on_batch_end(self):
+        self.timer.end_step(self.global_step, self.logger)
+        self._last_step_end = time.perf_counter()
+
     # It supports only need when using DP or DDP2, I should not need it because I am using ddp
     # but I have some problem with the dice score, So I am just trying ...
     # def training_step_end(self, outputs) -> Dict[str, Union[Tensor, Dict[str, Tensor]]]:
@@ -298,55 +453,168 @@ class Lightning_Unet(pl.LightningModule):
     # dice, iou, _, _ = get_score(batch_preds, batch_targets, include_background=True)
     # dice = dice_score(pred=batch_preds, target=batch_targets, bg=True)
 
-    def compute_from_aggregating(self, input, target, if_path: bool, type_as_tensor=None, whether_to_return_img=False,
-                                 result: pl.EvalResult=None):
-        transform = get_val_transform()
-        if if_path:
-            cur_img_subject = torchio.Subject(
-                img=torchio.Image(input, type=torchio.INTENSITY)
-            )
-            cur_label_subject = torchio.Subject(
-                img=torchio.Image(target, type=torchio.LABEL)
+    def crop_to_brain(self, subject: torchio.Subject, img_path=None):
+        """
+        the subject cropped to the bounding box of the brain, so the grid sampler skips the empty corners,
+        the box is found on the stored pyramid level of `img_path` when there is one and the normalization is
+        affine, the raw level does not give the same mean mask after the histogram standardization of the landmarks
+        :return: the cropped subject, the box (None when disabled) and the full spatial shape
+        """
+        spatial_shape = tuple(subject['img'][DATA].shape[1:])
+        if self.hparams.inference_bbox_downsample <= 0:
+            return subject, None, spatial_shape
+        with self.timer.span("brain_bbox"):
+            small = None
+            if self.landmarks is None:
+                small = get_matching_level(img_path, self.hparams.inference_bbox_downsample, spatial_shape)
+            bbox = get_brain_bbox(subject['img'][DATA], self.hparams.inference_bbox_downsample,
+                                  self.hparams.inference_bbox_margin, small=small)
+            bbox = fit_bbox_to_patch(bbox, spatial_shape, self.patch_size)
+        return crop_subject_to_bbox(subject, bbox), bbox, spatial_shape
+
+    def get_foreground_blocks(self, subject: torchio.Subject):
+        """the foreground blocks of the image to skip the empty tiles, None when the skipping is disabled"""
+        if not self.hparams.skip_empty_tiles:
+            return None
+        return get_foreground_blocks(subject['img'][DATA], self.hparams.empty_tile_threshold,
+                                     self.hparams.empty_tile_margin)
+
+    def skip_empty_tile(self, patches_batch, foreground_blocks, aggregator) -> bool:
+        """
+        give the background label to the tiles of the batch without foreground, without the forward pass
+        :return: whether the batch was skipped
+        """
+        locations = patches_batch[torchio.LOCATION]
+        self.num_tiles += len(locations)
+        if foreground_blocks is None or not all(is_empty_tile(foreground_blocks, location) for location in locations):
+            return False
+        self.num_skipped_tiles += len(locations)
+        input_tensor = patches_batch['img'][torchio.DATA]
+        with self.timer.span("aggregation"):
+            aggregator.add_batch(torch.zeros(input_tensor.shape, dtype=torch.uint8), locations)
+        return True
+
+    def infer_coarse(self, subject: torchio.Subject):
+        """
+        the low resolution pass of the cascade (utils/cascade.py), None when the cascade is disabled
+        :return: the coarse labels upsampled to the full resolution, and the coarse voxels to infer again
+        """
+        if not self.hparams.cascade:
+            return None
+        factor = self.hparams.cascade_downsample
+        img = subject['img'][DATA]
+        with self.timer.span("cascade_coarse"):
+            small = downsample_image(img, factor, self.patch_size)
+            grid_sampler = torchio.inference.GridSampler(
+                torchio.Subject(img=torchio.Image(tensor=small, type=torchio.INTENSITY)),
+                self.patch_size,
+                self.hparams.patch_overlap,
             )
+            aggregator = torchio.inference.GridAggregator(grid_sampler)
+            for patches_batch in torch.utils.data.DataLoader(grid_sampler):
+                input_tensor = patches_batch['img'][torchio.DATA].to(self.device, dtype=torch.float32,
+                                                                     non_blocking=True)
+                confidence, labels = self(input_tensor).max(dim=torchio.CHANNELS_DIMENSION, keepdim=True)
+                aggregator.add_batch(torch.cat([labels.float(), confidence], dim=torchio.CHANNELS_DIMENSION),
+                                     patches_batch[torchio.LOCATION])
+            # without the padding of `downsample_image`
+            coarse_shape = [-(-dim // factor) for dim in img.shape[1:]]
+            output = crop_location(aggregator.get_output_tensor(), [0, 0, 0] + coarse_shape)
+            uncertain = get_uncertain_voxels(output[0], output[1], self.hparams.cascade_confidence)
+        return upsample_labels(output[0], factor, img.shape[1:]), uncertain
+
+    def add_coarse_tile(self, patches_batch, coarse, aggregator) -> bool:
+        """
+        keep the coarse labels of the tiles of the batch without uncertain or boundary voxel
+        :return: whether the batch does not need the full resolution pass
+        """
+        if coarse is None:
+            return False
+        coarse_labels, uncertain = coarse
+        locations = patches_batch[torchio.LOCATION]
+        if any(not is_empty_tile(uncertain, location, self.hparams.cascade_downsample) for location in locations):
+            self.num_fine_tiles += len(locations)
+            return False
+        self.num_coarse_tiles += len(locations)
+        with self.timer.span("aggregation"):
+            aggregator.add_batch(torch.stack([crop_location(coarse_labels, location) for location in locations]),
+                                 locations)
+        return True
 
-            preprocessed_img = transform(cur_img_subject)
-            preprocessed_label = transform(cur_label_subject)
-
+    def compute_from_aggregating(self, input, target, if_path: bool, type_as_tensor=None, whether_to_return_img=False,
+                                 result: pl.EvalResult=None, subject_id=None, preprocessed=False):
+        transform = get_val_transform(self.fingerprint, self.landmarks)
+        if if_path:
+            # the visualization subjects are read from their path, they are cached like the validation subjects
+            cached = self.val_cache.get(str(input))
+            if cached is None:
+                cur_img_subject = torchio.Subject(
+                    img=torchio.Image(input, type=torchio.INTENSITY)
+                )
+                cur_label_subject = torchio.Subject(
+                    img=torchio.Image(target, type=torchio.LABEL)
+                )
+                cached = self.val_cache.put(str(input), transform(cur_img_subject).img.data,
+                                            transform(cur_label_subject).img.data)
+            preprocessed_img = torchio.Subject(img=torchio.Image(tensor=cached[0], type=torchio.INTENSITY))
+            preprocessed_label = torchio.Subject(img=torchio.Image(tensor=cached[1], type=torchio.LABEL))
+
+            cropped_img, bbox, spatial_shape = self.crop_to_brain(preprocessed_img, img_path=input)
             patch_overlap = self.hparams.patch_overlap  # is there any constrain?
             grid_sampler = torchio.inference.GridSampler(
-                preprocessed_img,
+                cropped_img,
                 self.patch_size,
                 patch_overlap,
             )
 
             patch_loader = torch.utils.data.DataLoader(grid_sampler)
             aggregator = torchio.inference.GridAggregator(grid_sampler)
+            foreground_blocks = self.get_foreground_blocks(cropped_img)
+            coarse = self.infer_coarse(cropped_img)
+            context_volume = self.get_context_volume(cropped_img)
 
             for patches_batch in patch_loader:
+                if self.skip_empty_tile(patches_batch, foreground_blocks, aggregator):
+                    continue
+                if self.add_coarse_tile(patches_batch, coarse, aggregator):
+                    continue
                 input_tensor = patches_batch['img'][torchio.DATA]
                 # used to convert tensor to CUDA
                 input_tensor = input_tensor.type_as(type_as_tensor['val_dice'])
                 locations = patches_batch[torchio.LOCATION]
-                preds = self(input_tensor)  # use cuda
-                labels = preds.argmax(dim=torchio.CHANNELS_DIMENSION, keepdim=True)  # use cuda
-                aggregator.add_batch(labels, locations)
-            output_tensor = aggregator.get_output_tensor()  # not using cuda!
+                with self.timer.span("val_forward", input_tensor.device):
+                    preds = self(input_tensor, self.get_tile_context(context_volume, locations))  # use cuda
+                    # the aggregator stores the labels with their dtype, uint8 and not int64
+                    labels = preds.argmax(dim=torchio.CHANNELS_DIMENSION, keepdim=True).to(torch.uint8)  # use cuda
+                with self.timer.span("aggregation"):
+                    aggregator.add_batch(labels, locations)
+            with self.timer.span("aggregation"):
+                output_tensor = aggregator.get_output_tensor()  # not using cuda!
+                if bbox is not None:
+                    # the voxels outside of the brain box are background
+                    output_tensor = pad_from_bbox(output_tensor, bbox, spatial_shape)
+            self.mem_tracker.snapshot("aggregation", self.global_step, self.device)
 
             if if_path or whether_to_return_img:
-                return preprocessed_img.img.data, output_tensor, preprocessed_label.img.data
+                return preprocessed_img.img.data.float(), output_tensor, preprocessed_label.img.data
             else:
                 return output_tensor, preprocessed_label.img.data
 
         else:
             cur_subject = torchio.Subject(
                 img=torchio.Image(tensor=input.squeeze(), type=torchio.INTENSITY),
-                label=torchio.Image(tensor=target.squeeze(), type=torchio.LABEL)
+                label=torchio.Image(tensor=target.squeeze(), type=torchio.LABEL),
+                # the image is built from a tensor, so the subject id is needed to find its cached statistics
+                subject_id=subject_id,
             )
-            preprocessed_subject = transform(cur_subject)
+            # the cached validation subjects are already preprocessed
+            preprocessed_subject = cur_subject if preprocessed else transform(cur_subject)
 
+            cropped_subject, bbox, spatial_shape = self.crop_to_brain(preprocessed_subject,
+                                                                     img_path=self.img_paths.get(subject_id))
             patch_overlap = self.hparams.patch_overlap  # is there any constrain?
             grid_sampler = torchio.inference.GridSampler(
-                preprocessed_subject,
+                cropped_subject,
                 self.patch_size,
                 patch_overlap,
             )
@@ -355,106 +623,231 @@ class Lightning_Unet(pl.LightningModule):
             aggregator = torchio.inference.GridAggregator(grid_sampler)
 
             dice_loss =[]
+            foreground_blocks = self.get_foreground_blocks(cropped_subject)
+            coarse = self.infer_coarse(cropped_subject)
+            context_volume = self.get_context_volume(cropped_subject)
 
             for patches_batch in patch_loader:
+                # the loss is only computed on the tiles inferred at full resolution
+                if self.skip_empty_tile(patches_batch, foreground_blocks, aggregator):
+                    continue
+                if self.add_coarse_tile(patches_batch, coarse, aggregator):
+                    continue
                 input_tensor, target_tensor = patches_batch['img'][torchio.DATA], patches_batch['label'][torchio.DATA]
-                # used to convert tensor to CUDA
-                input_tensor = input_tensor.type_as(input)
+                # used to convert tensor to CUDA, the cached volumes stay on CPU as float16 / uint8
+                input_tensor = input_tensor.to(self.device, dtype=torch.float32, non_blocking=True)
+                target_tensor = target_tensor.to(self.device, non_blocking=True)
                 locations = patches_batch[torchio.LOCATION]
-                preds_tensor = self(input_tensor)  # use cuda
+                with self.timer.span("val_forward", input_tensor.device):
+                    preds_tensor = self(input_tensor, self.get_tile_context(context_volume, locations))  # use cuda
                 # Compute the loss here
-                diceloss = DiceLoss(include_background=self.hparams.include_background, to_onehot_y=True)
-                loss = diceloss.forward(input=preds_tensor, target=target_tensor)
+                with self.timer.span("val_loss", input_tensor.device):
+                    diceloss = DiceLoss(include_background=self.hparams.include_background, to_onehot_y=True)
+                    loss = diceloss.forward(input=preds_tensor, target=target_tensor)
                 dice_loss.append(loss)
-                labels = preds_tensor.argmax(dim=torchio.CHANNELS_DIMENSION, keepdim=True)  # use cuda
-                aggregator.add_batch(labels, locations)
-            output_tensor = aggregator.get_output_tensor()  # not using cuda!!!!
+                labels = preds_tensor.argmax(dim=torchio.CHANNELS_DIMENSION, keepdim=True).to(torch.uint8)  # use cuda
+                with self.timer.span("aggregation"):
+                    aggregator.add_batch(labels, locations)
+            with self.timer.span("aggregation"):
+                output_tensor = aggregator.get_output_tensor()  # not using cuda!!!!
+                if bbox is not None:
+                    output_tensor = pad_from_bbox(output_tensor, bbox, spatial_shape)
+            self.mem_tracker.snapshot("aggregation", self.global_step, self.device)
 
             if whether_to_return_img:
                 return cur_subject['img'].data, output_tensor, cur_subject['label'].data
             else:
+                if not dice_loss:
+                    dice_loss.append(torch.zeros((), device=self.device))
                 return output_tensor, cur_subject['label'].data, torch.stack(dice_loss)
 
+    def transfer_batch_to_device(self, batch, device):
+        """the validation batches are whole volumes, they stay on CPU and only their patches are moved to the GPU"""
+        if isinstance(batch, dict) and 'cached' in batch:
+            return batch
+        return super().transfer_batch_to_device(batch, device)
+
+    def get_validation_subject(self, batch):
+        """the preprocessed image and label of the validation subject, from the cache or from the loader"""
+        subject_id = batch['subject_id'][0]
+        # the subjects decoded by the workers are counted as misses of the cache
+        cached = self.val_cache.get(subject_id)
+        if cached is not None:
+            return cached
+        if batch['cached'][0]:
+            # evicted since the epoch started, load it again in the main process
+            img, label = self.val_imageDataset.load(self.val_imageDataset.indices[subject_id])
+        else:
+            img, label = batch['img'][0], batch['label'][0]
+        return self.val_cache.put(subject_id, img, label)
+
     def validation_step(self, batch, batch_id):
-        input, target = self.prepare_batch(batch)
+        # the volumes stay on CPU, only their patches are moved to the GPU
+        input, target = self.get_validation_subject(batch)
 
         # print(f"input shape: {input.shape}")
         # print(f"target shape: {target.shape}")
 
-        output_tensor, target_tensor, dice_loss = self.compute_from_aggregating(input, target, if_path=False)  # in CPU
+        output_tensor, target_tensor, dice_loss = self.compute_from_aggregating(
+            input, target, if_path=False, subject_id=batch['subject_id'][0], preprocessed=True)  # in CPU
 
         # pred = self(inputs)
         # gdloss = GeneralizedDiceLoss(include_background=True, to_onehot_y=True)
         # loss = gdloss.forward(input=probs, target=targets)
 
-        output_tensor = to_onehot(output_tensor, num_classes=139)
-        output_tensor_cuda = output_tensor.type_as(input)
-        target_tensor_cuda = target_tensor.type_as(input)
+        # the uint8 labels are compared directly, without one hot or float copies of the volumes
+        output_tensor_cuda = output_tensor.to(self.device)
+        target_tensor_cuda = target_tensor.to(self.device)
         del output_tensor, target_tensor, input, target
         # dice, iou, sensitivity, specificity = get_score(output_tensor_cuda, target_tensor_cuda,
         #                                                 include_background=True, reduction=LossReduction.NONE)
-        dice, iou, sensitivity, specificity = get_score(output_tensor_cuda, target_tensor_cuda,
-                                                        include_background=True)
+        with self.timer.span("get_score", output_tensor_cuda.device):
+            dice, iou, sensitivity, specificity = get_score(output_tensor_cuda, target_tensor_cuda,
+                                                            include_background=True)
+        # not sync_dist here, the metrics of all the ranks are reduced once in `validation_epoch_end`
         result = pl.EvalResult(early_stop_on=dice, checkpoint_on=dice)
         result.log('val_loss', dice_loss.mean(), on_step=False, on_epoch=True, logger=True, prog_bar=False,
-                   reduce_fx=torch.mean, sync_dist=True)
+                   reduce_fx=torch.mean)
         result.log('val_dice', dice, on_step=False, on_epoch=True, logger=True, prog_bar=False,
-                   reduce_fx=torch.mean, sync_dist=True)
+                   reduce_fx=torch.mean)
         result.log('val_IoU', iou, on_step=False, on_epoch=True, logger=True, prog_bar=False,
-                   reduce_fx=torch.mean, sync_dist=True)
+                   reduce_fx=torch.mean)
         result.log('val_sensitivity', sensitivity, on_step=False, on_epoch=True, logger=True, prog_bar=False,
-                   reduce_fx=torch.mean, sync_dist=True)
+                   reduce_fx=torch.mean)
         result.log('val_specificity', specificity, on_step=False, on_epoch=True, logger=True, prog_bar=False,
-                   reduce_fx=torch.mean, sync_dist=True)
+                   reduce_fx=torch.mean)
+        # the repeated subjects which pad the shard of this rank are not counted, see data/sharding.py
+        weight = 0. if self.val_sampler.is_padding(batch_id) else 1.
+        result.log('val_weight', torch.tensor(weight, device=dice.device), on_step=False, on_epoch=True,
+                   logger=False, prog_bar=False, reduce_fx=torch.sum)
         return result
 
+    def on_save_checkpoint(self, checkpoint):
+        # lightning already saves the weights, the optimizer and the scheduler, the rest is needed to resume the
+        # data pipeline of a preempted job exactly: the split of the subjects and the random states
+        checkpoint['training_subject_ids'] = [subject.get('subject_id') for subject in self.training_subjects]
+        checkpoint['validation_subject_ids'] = [subject.get('subject_id') for subject in self.validation_subjects]
+        checkpoint['augmentation_seed'] = self.hparams.augmentation_seed
+        # lightning saves `current_epoch + 1`, so a checkpoint written in the middle of an epoch (last.ckpt, or the
+        # validation at half of the epoch) would skip the rest of it: keep the epoch and the batches done instead
+        if 0 < self.epoch_batches < self.trainer.num_training_batches:
+            checkpoint['epoch'] = self.current_epoch
+            checkpoint['epoch_batches'] = self.epoch_batch_offset + self.epoch_batches
+        checkpoint['rng_states'] = {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        }
+
+    def on_load_checkpoint(self, checkpoint):
+        # the loader of the resumed epoch skips these batches, see `train_dataloader`
+        self.resume_epoch_batches = checkpoint.get('epoch_batches', 0)
+        rng_states = checkpoint.get('rng_states')
+        if rng_states is not None:
+            random.setstate(rng_states['python'])
+            np.random.set_state(rng_states['numpy'])
+            torch.set_rng_state(rng_states['torch'])
+            if torch.cuda.is_available() and len(rng_states['cuda']) == torch.cuda.device_count():
+                torch.cuda.set_rng_state_all(rng_states['cuda'])
+        # keep the same split as before the restart, even if subjects were added to the folder in between
+        if 'training_subject_ids' in checkpoint and hasattr(self, 'subjects'):
+            subjects = {subject.get('subject_id'): subject for subject in self.subjects}
+            if all(subject_id in subjects for subject_id in checkpoint['training_subject_ids']
+                   + checkpoint['validation_subject_ids']):
+                self.training_subjects = [subjects[i] for i in checkpoint['training_subject_ids']]
+                self.validation_subjects = [subjects[i] for i in checkpoint['validation_subject_ids']]
+            else:
+                print(f"{ctime()}: some subjects of the checkpoint are missing, use the new split")
+
+    def on_epoch_start(self):
+        self.epoch_batches = 0
+        # the Queue pickles the dataset to its workers when it starts loading the subjects of the epoch
+        if getattr(self, "train_imageDataset", None) is not None:
+            self.train_imageDataset.set_epoch(self.current_epoch)
+
+    def on_epoch_end(self):
+        self.nan_checker.poll(wait=True)
+        # only the resumed epoch skips the batches done before the restart
+        self.resume_epoch_batches = 0
+        self.epoch_batch_offset = 0
+
     # Called at the end of the validation epoch with the outputs of all validation steps.
     def validation_epoch_end(self, validation_step_output_result):
-        # visualization part
-        cur_img_path = self.visual_img_path_list[self.val_times % len(self.visual_img_path_list)]
-        cur_label_path = self.visual_label_path_list[self.val_times % len(self.visual_label_path_list)]
-
-        img, output_tensor, target_tensor = self.compute_from_aggregating(cur_img_path, cur_label_path,
-                                                                          if_path=True,
-                                                                          type_as_tensor=validation_step_output_result)
-        # print(f"validation_epoch_end_output_tensor: {output_tensor.requires_grad}")
-        # print(f"validation_epoch_end_target_tensor: {target_tensor.requires_grad}")
-        output_tensor_cuda = output_tensor.type_as(validation_step_output_result['val_dice'])
-        target_tensor_cuda = target_tensor.type_as(validation_step_output_result['val_dice'])
-        del output_tensor, target_tensor
-        # using CUDA
-        dice, iou, sensitivity, specificity = get_score(pred=output_tensor_cuda, target=target_tensor_cuda,
-                                                        include_background=True)
-
-        log_all_info(self,
-                     img,
-                     target_tensor_cuda,
-                     output_tensor_cuda,
-                     dice,
-                     self.val_times, filename=None)
+        # visualization part, only the logger of rank zero writes to TensorBoard,
+        # so the other ranks do not need to infer the visualization subject at all
+        if self.global_rank == 0:
+            cur_img_path = self.visual_img_path_list[self.val_times % len(self.visual_img_path_list)]
+            cur_label_path = self.visual_label_path_list[self.val_times % len(self.visual_label_path_list)]
+
+            img, output_tensor, target_tensor = self.compute_from_aggregating(
+                cur_img_path, cur_label_path, if_path=True, type_as_tensor=validation_step_output_result)
+            # print(f"validation_epoch_end_output_tensor: {output_tensor.requires_grad}")
+            # print(f"validation_epoch_end_target_tensor: {target_tensor.requires_grad}")
+            output_tensor_cuda = output_tensor.to(self.device)
+            target_tensor_cuda = target_tensor.to(self.device)
+            del output_tensor, target_tensor
+            # using CUDA
+            dice, iou, sensitivity, specificity = get_score(pred=output_tensor_cuda, target=target_tensor_cuda,
+                                                            include_background=True)
+
+            log_all_info(self,
+                         img,
+                         target_tensor_cuda,
+                         output_tensor_cuda,
+                         dice,
+                         self.val_times, filename=None)
         self.val_times += 1
+        # when the loader is not built again, the workers of the next validation epoch skip the subjects cached now
+        self.val_imageDataset.set_cached_ids(self.val_cache.keys())
+        cache_stats = self.val_cache.stats()
+        print(f"{ctime()}: validation cache hit rate {cache_stats['val_cache/hit_rate']:.2f}, "
+              f"{cache_stats['val_cache/subjects']} subjects on rank {self.global_rank}")
+        if self.global_rank == 0 and self.logger is not None:
+            self.logger.log_metrics(cache_stats, step=self.global_step)
+        if self.hparams.skip_empty_tiles and self.num_tiles:
+            print(f"{ctime()}: skipped {self.num_skipped_tiles} of {self.num_tiles} empty tiles "
+                  f"({100 * self.num_skipped_tiles / self.num_tiles:.1f}%) on rank {self.global_rank}")
+            if self.global_rank == 0 and self.logger is not None:
+                self.logger.log_metrics({'val_skipped_tiles': self.num_skipped_tiles / self.num_tiles},
+                                        step=self.global_step)
+        if self.hparams.cascade and self.num_fine_tiles + self.num_coarse_tiles:
+            print(f"{ctime()}: the cascade kept the coarse labels of {self.num_coarse_tiles} tiles, "
+                  f"inferred {self.num_fine_tiles} tiles at full resolution on rank {self.global_rank}")
+        self.num_tiles = 0
+        self.num_skipped_tiles = 0
+        self.num_coarse_tiles = 0
+        self.num_fine_tiles = 0
 
         # From https://forums.pytorchlightning.ai/t/log-unreduced-results-as-histogram-with-evalresult/112/2?u=jueqi
         # The reduce function in-built to the Result class only gets called if the epoch_end methods aren’t overridden
         # So the only way is overriding the epoch_end method and aggregating it yourself
-        validation_step_output_result['val_loss'] = validation_step_output_result['val_loss'].mean()
-        validation_step_output_result['val_dice'] = validation_step_output_result['val_dice'].mean()
-        validation_step_output_result['val_IoU'] = validation_step_output_result['val_IoU'].mean()
-        validation_step_output_result['val_sensitivity'] = validation_step_output_result['val_sensitivity'].mean()
-        validation_step_output_result['val_specificity'] = validation_step_output_result['val_specificity'].mean()
+        # Every rank only has the metrics of its own shard, so the sums and the number of subjects are reduced over
+        # all the ranks with a single all_reduce, which also weights the shards by their size. The repeated subjects
+        # which pad the shards have a weight of 0
+        metric_names = ['val_loss', 'val_dice', 'val_IoU', 'val_sensitivity', 'val_specificity']
+        weights = validation_step_output_result['val_weight'].float().reshape(-1)
+        sums = torch.stack([(validation_step_output_result[name].float().reshape(-1) * weights).sum()
+                            for name in metric_names] + [weights.sum()])
+        sums = all_reduce_sum(sums)
+        for name, value in zip(metric_names, sums[:-1] / sums[-1]):
+            validation_step_output_result[name] = value
+        validation_step_output_result['checkpoint_on'] = validation_step_output_result['val_dice']
+        validation_step_output_result['early_stop_on'] = validation_step_output_result['val_dice']
         return validation_step_output_result
 
     def test_step(self, batch, batch_idx):
         input, target = self.prepare_batch(batch)
         img, output_tensor, target_tensor = self.compute_from_aggregating(input, target, if_path=False,
+                                                                          subject_id=batch.get('subject_id', [None])[0],
                                                                           whether_to_return_img=True)  # in CPU
 
         # pred = self(inputs)
         # gdloss = GeneralizedDiceLoss(include_background=True, to_onehot_y=True)
         # loss = gdloss.forward(input=probs, target=targets)
 
-        output_tensor_cuda = output_tensor.type_as(input)
-        target_tensor_cuda = target_tensor.type_as(input)
+        output_tensor_cuda = output_tensor.to(input.device)
+        target_tensor_cuda = target_tensor.to(input.device)
         del output_tensor, target_tensor, input, target
         # dice, iou, sensitivity, specificity = get_score(output_tensor_cuda, target_tensor_cuda,
         #                                                 include_background=True, reduction=LossReduction.NONE)
@@ -525,4 +918,57 @@ class Lightning_Unet(pl.LightningModule):
         parser.add_argument("--kernel_size", type=int, default=3, help="the kernal size")
         parser.add_argument("--patch_size", type=int, default=96, help="the patch size")
         parser.add_argument("--patch_overlap", type=int, default=10)
+        parser.add_argument("--track_memory", action="store_true",
+                            help='take allocator snapshots at prepare_batch, forward, loss, backward and aggregation')
+        parser.add_argument("--memory_flush_every", type=int, default=50,
+                            help='number of steps between two flushes of the memory snapshots to the logger')
+        parser.add_argument("--timing_log_every", type=int, default=0,
+                            help='log the span timing percentiles every n steps, 0 to disable the timing')
+        parser.add_argument("--trace_start_step", type=int, default=None,
+                            help='first step of the window exported as a chrome trace')
+        parser.add_argument("--trace_num_steps", type=int, default=10, help='number of steps in the chrome trace')
+        parser.add_argument("--trace_dir", type=str, default="./log/trace", help='where to save the chrome trace')
+        parser.add_argument("--nan_check_every", type=int, default=0,
+                            help='asynchronously check one batch for NaN every n steps, 0 to disable the check')
+        parser.add_argument("--num_workers", type=int, default=None,
+                            help='loading workers per process, defaults to SLURM_CPUS_PER_TASK / gpus per node - 1')
+        parser.add_argument("--prefetch_factor", type=int, default=2,
+                            help='number of batches loaded in advance by each worker')
+        parser.add_argument("--no_pin_memory", action="store_true", help='do not pin the memory of the batches')
+        parser.add_argument("--no_persistent_workers", action="store_true",
+                            help='shut down the workers at the end of every epoch')
+        parser.add_argument("--fingerprint", type=str, default=None,
+                            help='the dataset fingerprint json, defaults to the one of the image folder if it exists')
+        parser.add_argument("--landmarks", type=str, default=None,
+                            help='the histogram standardization landmarks json of data/landmarks.py')
+        parser.add_argument("--val_cache_gb", type=float, default=8,
+                            help='memory cap of the preprocessed validation subjects of every process, 0 to disable')
+        parser.add_argument("--warmup_steps", type=int, default=0,
+                            help='number of optimizer steps of the linear learning rate warmup')
+        parser.add_argument("--augmentation_seed", type=int, default=1234567,
+                            help='the base seed of the per sample augmentation, see data/seeded.py')
+        parser.add_argument("--inference_bbox_downsample", type=int, default=4,
+                            help='only infer the brain box, found on an n times downsampled image, 0 to disable')
+        parser.add_argument("--inference_bbox_margin", type=int, default=8,
+                            help='voxels added around the brain bounding box of the inference')
+        parser.add_argument("--skip_empty_tiles", action="store_true",
+                            help='do not infer the grid tiles without foreground, they get the background label')
+        parser.add_argument("--empty_tile_threshold", type=float, default=None,
+                            help='the intensity of the foreground voxels, defaults to the mean of the image')
+        parser.add_argument("--empty_tile_margin", type=int, default=8,
+                            help='voxels around the foreground within which the tiles are never skipped')
+        parser.add_argument("--cascade", action="store_true",
+                            help='infer at low resolution first, then only the uncertain tiles at full resolution')
+        parser.add_argument("--cascade_downsample", type=int, default=2, help='the downsampling of the coarse pass')
+        parser.add_argument("--cascade_confidence", type=float, default=0.9,
+                            help='the coarse voxels with a lower class probability are inferred at full resolution')
+        parser.add_argument("--context_factor", type=int, default=0,
+                            help='add a low resolution context patch, downsampled n times, to every patch, 0 without')
+        parser.add_argument("--context_size", type=int, default=48, help='the size of the context patch')
+        parser.add_argument("--context_channels", type=int, default=16,
+                            help='the features of the context branch of NewModel')
+        parser.add_argument("--volume_format", type=str, default="nifti", choices=VOLUME_FORMATS,
+                            help='read the training patches lazily from memory mapped (memmap) or chunked volumes')
+        parser.add_argument("--lazy_patch_margin", type=int, default=None,
+                            help='the margin read and augmented around the lazy patches, half of the patch by default')
         return parser
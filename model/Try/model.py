@@ -5,6 +5,7 @@
 from typing import Optional
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from model.unet.unet import UNet
 from model.highResNet.dilation import DilationBlock
 from model.highResNet.convolution import ConvolutionalBlock
@@ -27,6 +28,9 @@ class Module(nn.Module):
             padding_mode='constant',
             add_dropout_layer=False,  # Why this is False?
             initialization: Optional[str] = None,
+            # the features of the low resolution context patch (data/multi_resolution.py), 0 without context
+            context_channels: int = 0,
+            context_factor: int = 4,
     ):
         assert dimensions in (2, 3)
         super().__init__()
@@ -35,6 +39,8 @@ class Module(nn.Module):
         self.layers_per_residual_block = layers_per_residual_block
         self.residual_blocks_per_dilation = residual_blocks_per_dilation
         self.dilations = dilations
+        self.context_channels = context_channels
+        self.context_factor = context_factor
 
         # Add first conv layer
         initial_out_channels = 2 ** initial_out_channels_power
@@ -76,7 +82,8 @@ class Module(nn.Module):
         for dilation_idx in range(1, dilations):
             # need to change this
             if dilation_idx == 1:
-                out_channels = in_channels = 32
+                # the mini-Unet and the first dilated block, and the context features
+                out_channels = in_channels = 32 + context_channels
             else:
                 in_channels = dilation_block.out_channels
             dilation = 2 ** dilation_idx
@@ -144,7 +151,51 @@ class Module(nn.Module):
             use_classifier=False,
         )
 
-    def forward(self, x):
+        if context_channels:
+            # the context patch is already downsampled, so a few dilated layers see a large field of view
+            self.context_block = nn.Sequential(
+                ConvolutionalBlock(
+                    in_channels=self.in_channels,
+                    out_channels=context_channels,
+                    dilation=1,
+                    dimensions=dimensions,
+                    batch_norm=batch_norm,
+                    instance_norm=instance_norm,
+                    preactivation=False,
+                    padding_mode=padding_mode,
+                ),
+                DilationBlock(
+                    context_channels,
+                    context_channels,
+                    dilation=2,
+                    dimensions=dimensions,
+                    layers_per_block=layers_per_residual_block,
+                    num_residual_blocks=1,
+                    batch_norm=batch_norm,
+                    instance_norm=instance_norm,
+                    residual=residual,
+                    padding_mode=padding_mode,
+                ),
+            )
+
+    def get_context_features(self, context: Optional[torch.Tensor], x: torch.Tensor) -> torch.Tensor:
+        """
+        the features of the centre of the context patch, which covers the full resolution patch, upsampled to the
+        patch; zeros when there is no context (e.g. the coarse pass of the cascade)
+        """
+        if context is None:
+            return x.new_zeros(x.shape[0], self.context_channels, *x.shape[2:])
+        features = self.context_block(context)
+        centre = []
+        for context_dim, patch_dim in zip(features.shape[2:], x.shape[2:]):
+            # the patch is `context_factor` times smaller in the context voxels
+            size = max(1, min(context_dim, round(patch_dim / self.context_factor)))
+            start = (context_dim - size) // 2
+            centre.append(slice(start, start + size))
+        features = features[(slice(None), slice(None)) + tuple(centre)]
+        return F.interpolate(features, size=tuple(x.shape[2:]), mode='trilinear', align_corners=False)
+
+    def forward(self, x, context: Optional[torch.Tensor] = None):
         first_layer = self.first_conv_block(x)
         # print(f"first layer shape: {first_layer.shape}")
         # mini-Unet and first part of the highResNet
@@ -152,6 +203,8 @@ class Module(nn.Module):
         # print(f"unet output shape: {unet_output.shape}")
         highResNet_first_conv_block = self.first_dilated_block(first_layer)
         x = torch.cat((unet_output, highResNet_first_conv_block), dim=1)
+        if self.context_channels:
+            x = torch.cat((x, self.get_context_features(context, x)), dim=1)
         x = self.block(x)
         return self.softmax(x)
 
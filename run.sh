@@ -2,9 +2,9 @@
 #SBATCH --account=def-jlevman
 #SBATCH --nodes=1
 #SBATCH --gres=gpu:v100l:4  # on Cedar
-#SBATCH --ntasks=1
-#SBATCH --ntasks-per-node=1
-#SBATCH --cpus-per-task=32  #maximum CPU cores per GPU request: 6 on Cedar, 16 on Graham.
+# one task per GPU, lightning then uses the SLURM ranks, increase --nodes to scale out (see utils/launcher.py)
+#SBATCH --ntasks-per-node=4
+#SBATCH --cpus-per-task=8  #maximum CPU cores per GPU request: 6 on Cedar, 16 on Graham.
 #SBATCH --mem=192000M  # memory
 #SBATCH --output=seg138-%j.out  # %N for node name, %j for jobID
 #SBATCH --time=01-00:00      # time (DD-HH:MM)
@@ -32,21 +32,22 @@ CUDA_LAUNCH_BLOCKING=1
 
 echo -e '\n'
 cd $SLURM_TMPDIR
-mkdir work
 # --strip-components prevents making double parent directory
 echo "$(date +"%T"):  Copying data"
 #tar -xf /home/jueqi/scratch/Data/readable_data.tar -C work && echo "$(date +"%T"):  Copied data"
-tar -xf /home/jueqi/projects/def-jlevman/jueqi/Data/cropped_resampled_ADNI.tar -C work && echo "$(date +"%T"):  Copied data"
+# extract once on every node, SLURM_TMPDIR is local to each node
+srun --ntasks=$SLURM_JOB_NUM_NODES --ntasks-per-node=1 bash -c \
+  "mkdir -p $SLURM_TMPDIR/work && tar -xf /home/jueqi/projects/def-jlevman/jueqi/Data/cropped_resampled_ADNI.tar -C $SLURM_TMPDIR/work" \
+  && echo "$(date +"%T"):  Copied data"
 # Now do my computations here on the local disk using the contents of the extracted archive...
 
 cd work
 
 BATCH_SIZE=2
-NODES=1
-GPUS=4
 OUT_CHANNELS_FIRST_LAYER=32
 # LEARNING_RATE=4e-2  # identical in the highResNet Paper
-LEARNING_RATE=0.0004  # the actually learning rate for pytorch-lightning when using ddp is LEARING_RATE / GPUS
+LEARNING_RATE=0.0001  # the learning rate of a global batch of LR_REFERENCE_BATCH_SIZE, scaled linearly
+LR_REFERENCE_BATCH_SIZE=2
 KERNEL_SIZE=5
 DEEPTH=4
 PATCH_SIZE=96
@@ -64,10 +65,10 @@ LOG_DIR=/home/jueqi/projects/def-jlevman/jueqi/seg138_log
 
 # run script
 echo -e '\n\n\n'
-tensorboard --logdir="$LOG_DIR" --host 0.0.0.0 & python3 /home/jueqi/projects/def-jlevman/jueqi/seg138/1/Lit_train.py \
-       --gpus=$GPUS \
+# the nodes and the GPUs per node come from the SLURM job
+tensorboard --logdir="$LOG_DIR" --host 0.0.0.0 & srun python3 /home/jueqi/projects/def-jlevman/jueqi/seg138/1/Lit_train.py \
        --batch_size=$BATCH_SIZE \
-       --nodes=$NODES \
+       --lr_reference_batch_size=$LR_REFERENCE_BATCH_SIZE \
        --name="score and loss, include_background=True, dice loss, one more bottom layer, and enable visulization" \
        --TensorBoardLogger="$LOG_DIR" \
        --model="$MODEL" \
@@ -0,0 +1,125 @@
+"""
+coarse to fine (cascaded) inference
+
+The low resolution pass runs the network on the image downsampled `factor` times (a few % of the tiles), and gives a
+label and a confidence (the largest class probability) to every coarse voxel. The full resolution network then only
+runs on the tiles which have an uncertain coarse voxel (confidence below the threshold) or a boundary voxel (another
+label in its 3^3 neighbourhood), the other tiles keep the upsampled coarse labels. It is enabled with `--cascade`.
+
+Benchmark it against the dense inference on the validation subjects, with the dice to the target of both and the
+dice between them (the parity of the cascade):
+    python -m utils.cascade --checkpoint_file path/to/checkpoint.ckpt --num_subjects 10
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from time import ctime, perf_counter
+from typing import Sequence, Tuple
+
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+
+def downsample_image(img: torch.Tensor, factor: int, min_size: int = 0) -> torch.Tensor:
+    """
+    the image (1, X, Y, Z) averaged over `factor`^3 blocks, padded with its minimum (the background)
+    to at least `min_size` so the grid sampler gets one patch
+    """
+    small = F.avg_pool3d(img.detach().float().unsqueeze(0), kernel_size=factor, ceil_mode=True)[0]
+    padding = []
+    for dim in reversed(small.shape[1:]):
+        padding += [0, max(0, min_size - dim)]
+    if any(padding):
+        small = F.pad(small.unsqueeze(0), padding, value=float(small.min()))[0]
+    return small
+
+
+def get_uncertain_voxels(labels: torch.Tensor, confidence: torch.Tensor, threshold: float) -> torch.Tensor:
+    """
+    the coarse voxels (x, y, z) which the fine pass has to infer again: the uncertain ones,
+    and the boundary ones which have another label in their 3^3 neighbourhood
+    """
+    labels = labels.float()[None, None]
+    boundary = F.max_pool3d(labels, 3, stride=1, padding=1) != -F.max_pool3d(-labels, 3, stride=1, padding=1)
+    return (confidence < threshold) | boundary[0, 0]
+
+
+def upsample_labels(labels: torch.Tensor, factor: int, spatial_shape: Sequence[int]) -> torch.Tensor:
+    """the coarse labels (x, y, z) repeated to the full resolution (1, X, Y, Z) as uint8"""
+    full = labels.to(torch.uint8)
+    for dim in range(3):
+        full = full.repeat_interleave(factor, dim=dim)
+    return full[:spatial_shape[0], :spatial_shape[1], :spatial_shape[2]].unsqueeze(0)
+
+
+def crop_location(volume: torch.Tensor, location: Sequence[int]) -> torch.Tensor:
+    """the tile at `location` (i0, j0, k0, i1, j1, k1) of the volume (C, X, Y, Z)"""
+    i0, j0, k0, i1, j1, k1 = [int(i) for i in location]
+    return volume[:, i0:i1, j0:j1, k0:k1]
+
+
+def time_inference(model, img: torch.Tensor, label: torch.Tensor, subject_id: str,
+                   cascade: bool) -> Tuple[torch.Tensor, torch.Tensor, float]:
+    """the inference of one subject with or without the cascade, the `cascade` hparam of the model is restored"""
+    old_cascade = model.hparams.cascade
+    model.hparams.cascade = cascade
+    try:
+        if model.device.type == "cuda":
+            torch.cuda.synchronize(model.device)
+        start = perf_counter()
+        with torch.no_grad():
+            output, target, _ = model.compute_from_aggregating(img, label, if_path=False, subject_id=subject_id)
+        if model.device.type == "cuda":
+            torch.cuda.synchronize(model.device)
+        seconds = perf_counter() - start
+    finally:
+        model.hparams.cascade = old_cascade
+    return output.to(model.device), target.to(model.device), seconds
+
+
+def run_benchmark(checkpoint_file: str, num_subjects: int = 10) -> pd.DataFrame:
+    import torchio
+    from lit_unet import Lightning_Unet
+    from utils.matrix import get_score
+
+    model = Lightning_Unet.load_from_checkpoint(checkpoint_file)
+    model.setup("test")
+    model.eval()
+    if torch.cuda.is_available():
+        model.cuda()
+    dataset = torchio.ImagesDataset(model.validation_subjects[:num_subjects])
+    rows = []
+    for index in range(len(dataset)):
+        sample = dataset[index]
+        img, label = sample['img'][torchio.DATA], sample['label'][torchio.DATA]
+        subject_id = sample.get('subject_id')
+        dense, target, dense_seconds = time_inference(model, img, label, subject_id, cascade=False)
+        cascaded, _, cascade_seconds = time_inference(model, img, label, subject_id, cascade=True)
+        rows.append({
+            'subject_id': subject_id,
+            'dense_seconds': dense_seconds,
+            'cascade_seconds': cascade_seconds,
+            'dense_dice': get_score(dense, target)[0].item(),
+            'cascade_dice': get_score(cascaded, target)[0].item(),
+            'parity_dice': get_score(cascaded, dense)[0].item(),
+            'fine_tiles': model.num_fine_tiles,
+            'coarse_tiles': model.num_coarse_tiles,
+        })
+        model.num_fine_tiles = model.num_coarse_tiles = 0
+        print(f"{ctime()}: {rows[-1]}")
+    df = pd.DataFrame(rows)
+    print(f"{ctime()}: speedup {df['dense_seconds'].sum() / df['cascade_seconds'].sum():.2f}x, "
+          f"dice {df['dense_dice'].mean():.4f} (dense) / {df['cascade_dice'].mean():.4f} (cascade), "
+          f"parity dice {df['parity_dice'].mean():.4f}")
+    return df
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='benchmark the cascaded inference against the dense inference')
+    parser.add_argument("--checkpoint_file", type=str, required=True)
+    parser.add_argument("--num_subjects", type=int, default=10)
+    parser.add_argument("--output", type=str, default="./cascade_benchmark.csv")
+    args = parser.parse_args()
+
+    df = run_benchmark(args.checkpoint_file, args.num_subjects)
+    df.to_csv(Path(args.output), index=False)
@@ -0,0 +1,118 @@
+"""
+asynchronous, resumable checkpoints
+
+`ModelCheckpoint` writes the checkpoint with `torch.save` on the training thread. Here the checkpoint is only copied to
+CPU memory on the training thread, and written by a background thread to a temporary file which then replaces the
+checkpoint, so a job killed in the middle of a write never leaves a broken checkpoint behind.
+`StepCheckpoint` also writes `last.ckpt` every n steps, so a preempted SLURM job loses at most n steps, and
+`find_latest_checkpoint` finds the checkpoint to resume from when the job is restarted.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from glob import glob
+from pathlib import Path
+from time import ctime
+from typing import Any, Optional, Union
+
+import torch
+from pytorch_lightning.callbacks import Callback, ModelCheckpoint
+
+LAST_CHECKPOINT_NAME = "last.ckpt"
+
+
+def to_cpu(obj: Any) -> Any:
+    """a CPU copy of every tensor in `obj`, so the training can go on changing the parameters while it is written"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def dump_checkpoint(trainer, weights_only: bool = False) -> dict:
+    """the checkpoint dict of the trainer, which `trainer.save_checkpoint` would write"""
+    if hasattr(trainer, "checkpoint_connector"):
+        return trainer.checkpoint_connector.dump_checkpoint(weights_only)
+    return trainer.dump_checkpoint(weights_only)
+
+
+class AsyncCheckpointWriter:
+    """write the checkpoints one by one in a background thread"""
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending: Optional[Future] = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _write(checkpoint: dict, filepath: str) -> None:
+        filepath = Path(filepath)
+        tmp_path = filepath.parent / f".tmp-{filepath.name}"
+        torch.save(checkpoint, str(tmp_path))
+        os.replace(tmp_path, filepath)
+
+    def submit(self, checkpoint: dict, filepath: Union[str, Path]) -> None:
+        with self.lock:
+            # wait for the previous write, at most one CPU copy of the checkpoint is kept in memory
+            self.wait()
+            self.pending = self.executor.submit(self._write, to_cpu(checkpoint), str(filepath))
+
+    def wait(self) -> None:
+        """wait for the pending write, and raise its error if it failed"""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+
+class AsyncModelCheckpoint(ModelCheckpoint):
+    """`ModelCheckpoint` which writes the top k checkpoints with an `AsyncCheckpointWriter`"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer = AsyncCheckpointWriter()
+
+    def _save_model(self, filepath: str, trainer, pl_module) -> None:
+        if trainer.is_global_zero:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.writer.submit(dump_checkpoint(trainer, self.save_weights_only), filepath)
+
+    def _del_model(self, filepath: str) -> None:
+        # the checkpoint to delete might still be written
+        self.writer.wait()
+        super()._del_model(filepath)
+
+    def on_train_end(self, trainer, pl_module) -> None:
+        self.writer.wait()
+
+
+class StepCheckpoint(Callback):
+    """write `last.ckpt` every `every_n_steps` training steps, to resume a preempted job"""
+    def __init__(self, dirpath: Union[str, Path], every_n_steps: int = 1000):
+        self.dirpath = Path(dirpath)
+        self.every_n_steps = every_n_steps
+        self.writer = AsyncCheckpointWriter()
+        self.last_saved_step = None
+
+    def on_batch_end(self, trainer, pl_module) -> None:
+        if self.every_n_steps <= 0 or not trainer.is_global_zero:
+            return
+        step = trainer.global_step
+        # with gradient accumulation several batches have the same global step
+        if step > 0 and step % self.every_n_steps == 0 and step != self.last_saved_step:
+            self.last_saved_step = step
+            os.makedirs(self.dirpath, exist_ok=True)
+            self.writer.submit(dump_checkpoint(trainer), self.dirpath / LAST_CHECKPOINT_NAME)
+
+    def on_train_end(self, trainer, pl_module) -> None:
+        self.writer.wait()
+
+
+def find_latest_checkpoint(dirpath: Union[str, Path]) -> Optional[str]:
+    """the most recently written checkpoint in `dirpath`, None if there is not any"""
+    checkpoints = [path for path in glob(f"{str(dirpath)}/*.ckpt") if not Path(path).name.startswith(".tmp-")]
+    if not checkpoints:
+        return None
+    latest = max(checkpoints, key=os.path.getmtime)
+    print(f"{ctime()}: resume from the latest checkpoint {latest}")
+    return latest
@@ -0,0 +1,84 @@
+"""
+split an effective batch size into a micro batch and a number of gradient accumulation steps
+
+The micro batch (the `batch_size` of every forward pass) is the largest one whose activations fit in the memory
+budget of the GPU, and the gradients of `accumulate_grad_batches` micro batches are accumulated so that
+    micro batch * accumulate_grad_batches * world size == effective batch size
+
+The memory of one patch comes from the activations counted by `LayerProfiler`, not from the peak of the allocator,
+so every DDP rank gets exactly the same micro batch and number of accumulation steps.
+"""
+import os
+from math import ceil
+from time import ctime
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from .layer_profiler import LayerProfiler
+
+# the activations are kept for the backward pass, and their gradients are about as large again
+ACTIVATION_FACTOR = 2
+# the weights, their gradients and the two states of Adam
+PARAM_COPIES = 4
+
+
+def get_local_device() -> torch.device:
+    """the GPU of this process, before lightning has set it"""
+    if not torch.cuda.is_available():
+        return torch.device("cpu")
+    local_rank = int(os.environ.get("LOCAL_RANK", os.environ.get("SLURM_LOCALID", 0)))
+    return torch.device("cuda", local_rank % torch.cuda.device_count())
+
+
+def measure_sample_bytes(model: nn.Module, patch_size: int, device: torch.device) -> Tuple[int, int]:
+    """
+    :return: the memory needed by one patch in the forward / backward pass, and the size of the parameters
+    """
+    was_on = next(model.parameters()).device
+    model.to(device)
+    profiler = LayerProfiler(model)
+    profiler.profile(torch.randn(1, 1, patch_size, patch_size, patch_size, device=device), backward=True)
+    model.to(was_on)
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    return ACTIVATION_FACTOR * profiler.summary['activation_bytes'], profiler.summary['param_bytes']
+
+
+def get_memory_budget(device: torch.device, param_bytes: int, budget_gb: Optional[float] = None) -> int:
+    """the memory left for the activations, 90% of the GPU (the rest for the allocator) without the parameters"""
+    if budget_gb is not None:
+        return int(budget_gb * 1024 ** 3)
+    if device.type != "cuda":
+        raise ValueError("give --memory_budget_gb when training without GPU")
+    total = torch.cuda.get_device_properties(device).total_memory
+    return int(total * 0.9) - PARAM_COPIES * param_bytes
+
+
+def choose_micro_batch(effective_batch_size: int, world_size: int, sample_bytes: int,
+                       budget_bytes: int) -> Tuple[int, int]:
+    """
+    :return: the micro batch size and the number of accumulation steps of every process, the micro batch divides
+             the batch of the process so no sample is dropped or repeated
+    """
+    per_process = max(1, ceil(effective_batch_size / world_size))
+    max_micro_batch = max(1, budget_bytes // max(1, sample_bytes))
+    micro_batch = max(d for d in range(1, per_process + 1) if per_process % d == 0 and d <= max_micro_batch)
+    return micro_batch, per_process // micro_batch
+
+
+def plan_effective_batch(model: nn.Module, hparams) -> Tuple[int, int]:
+    """the micro batch size and accumulation steps for `hparams.effective_batch_size`"""
+    device = get_local_device()
+    if hparams.sample_memory_gb is not None:
+        sample_bytes = int(hparams.sample_memory_gb * 1024 ** 3)
+        param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    else:
+        sample_bytes, param_bytes = measure_sample_bytes(model, hparams.patch_size, device)
+    budget_bytes = get_memory_budget(device, param_bytes, hparams.memory_budget_gb)
+    micro_batch, accumulate_grad_batches = choose_micro_batch(hparams.effective_batch_size, hparams.world_size,
+                                                              sample_bytes, budget_bytes)
+    print(f"{ctime()}: {sample_bytes / 1024 ** 3:.2f}GB per patch, {budget_bytes / 1024 ** 3:.2f}GB budget, "
+          f"micro batch {micro_batch} x {accumulate_grad_batches} accumulation steps x {hparams.world_size} processes")
+    return micro_batch, accumulate_grad_batches
@@ -1,6 +1,7 @@
 import gc
 import datetime
 import pynvml
+from collections import Counter
 
 import torch
 import numpy as np
@@ -24,6 +25,9 @@ class MemTracker(object):
         self.verbose = verbose
         self.begin = True
         self.device = device
+        # only init nvml once, instead of init and shutdown in every `track`
+        pynvml.nvmlInit()
+        self.handle = pynvml.nvmlDeviceGetHandleByIndex(self.device)
 
         self.func_name = frame.f_code.co_name
         self.filename = frame.f_globals["__file__"]
@@ -49,10 +53,10 @@ class MemTracker(object):
     def track(self):
         """
         Track the GPU memory usage
+        This walks all the python objects, so it is for debugging only, use `mem_track.MemorySnapshotter`
+        inside the training loop
         """
-        pynvml.nvmlInit()
-        handle = pynvml.nvmlDeviceGetHandleByIndex(self.device)
-        meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        meminfo = pynvml.nvmlDeviceGetMemoryInfo(self.handle)
         self.curr_line = self.frame.f_lineno
         where_str = self.module_name + ' ' + self.func_name + ':' + ' line ' + str(self.curr_line)
 
@@ -64,9 +68,10 @@ class MemTracker(object):
                 self.begin = False
 
             if self.print_detail is True:
-                ts_list = [tensor.size() for tensor in self.get_tensors()]
-                new_tensor_sizes = {(type(x), tuple(x.size()), ts_list.count(x.size()), np.prod(np.array(x.size()))*4/1000**2)
-                                    for x in self.get_tensors()}
+                # walk the objects only once, and count the sizes with a Counter instead of `list.count`
+                ts_counter = Counter((type(x), tuple(x.size()), x.element_size()) for x in self.get_tensors())
+                new_tensor_sizes = {(t, s, n, np.prod(np.array(s)) * e / 1000**2)
+                                    for (t, s, e), n in ts_counter.items()}
                 for t, s, n, m in new_tensor_sizes - self.last_tensor_sizes:
                     f.write(f'+ | {str(n)} * Size:{str(s):<20} | Memory: {str(m*n)[:6]} M | {str(t):<20}\n')
                 for t, s, n, m in self.last_tensor_sizes - new_tensor_sizes:
@@ -76,5 +81,9 @@ class MemTracker(object):
             f.write(f"\nAt {where_str:<50}"
                     f"Total Used Memory:{meminfo.used/1000**2:<7.1f}Mb\n\n")
 
-        pynvml.nvmlShutdown()
+    def __del__(self):
+        try:
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
+            pass
 
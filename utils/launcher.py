@@ -0,0 +1,148 @@
+"""
+SLURM aware launch configuration for `Lit_train.py`
+
+The number of nodes and the GPUs per node are read from the SLURM environment (lightning reads the rank of every
+process from SLURM_PROCID), so the same script runs on 1 or n nodes without editing `--nodes` / `--gpus`. The learning rate is scaled linearly with the
+global batch size (the batch size of all the processes together), and without GPUs the processes use the
+`ddp_cpu` backend with gloo, so the multi-process code can be tried locally with e.g.:
+    python Lit_train.py --gpus 0 --num_processes 2 --fast_dev_run
+
+`ScalingEfficiency` logs the throughput of every step, and the scaling efficiency against the step time of a
+single process run.
+"""
+import json
+import os
+import re
+import time
+from pathlib import Path
+from time import ctime
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+from pytorch_lightning.callbacks import Callback
+
+
+def get_env_int(*names: str, default: Optional[int] = None) -> Optional[int]:
+    """the first of the environment variables `names` which is set, e.g. SLURM_GPUS_ON_NODE is not set everywhere"""
+    for name in names:
+        value = os.environ.get(name)
+        if value:
+            # SLURM_TASKS_PER_NODE looks like "4(x2)"
+            match = re.match(r"\d+", value)
+            if match:
+                return int(match.group())
+    return default
+
+
+def get_master_addr(nodelist: str) -> str:
+    """the first host of a SLURM node list, e.g. "cdr[905-906,910]" -> "cdr905" """
+    match = re.match(r"([^\[,]+)(\[([^\]]+)\])?", nodelist)
+    if match is None:
+        return "127.0.0.1"
+    prefix, ranges = match.group(1), match.group(3)
+    if ranges is None:
+        return prefix
+    first = ranges.split(",")[0].split("-")[0]
+    return f"{prefix}{first}"
+
+
+def get_slurm_config() -> Dict[str, int]:
+    """the number of nodes and the GPUs per node of the SLURM job, empty outside of SLURM"""
+    if "SLURM_JOB_ID" not in os.environ:
+        return {}
+    config = {'nodes': get_env_int("SLURM_JOB_NUM_NODES", "SLURM_NNODES", default=1)}
+    gpus = get_env_int("SLURM_GPUS_ON_NODE", "SLURM_GPUS_PER_NODE")
+    if gpus is None and os.environ.get("CUDA_VISIBLE_DEVICES"):
+        gpus = len(os.environ["CUDA_VISIBLE_DEVICES"].split(","))
+    if gpus is not None:
+        config['gpus'] = gpus
+    return config
+
+
+def set_distributed_env(nodes: int, use_gpu: bool) -> None:
+    """the variables used by torch.distributed, without overriding the ones which are already set"""
+    if "SLURM_JOB_NODELIST" in os.environ:
+        os.environ.setdefault("MASTER_ADDR", get_master_addr(os.environ["SLURM_JOB_NODELIST"]))
+        # every job gets its own port, so two jobs on the same node do not collide
+        os.environ.setdefault("MASTER_PORT", str(10000 + int(os.environ.get("SLURM_JOB_ID", 0)) % 20000))
+    if use_gpu:
+        os.environ.setdefault("NCCL_SOCKET_IFNAME", "^docker0,lo")
+        if nodes > 1:
+            # InfiniBand between the nodes, if there is one
+            os.environ.setdefault("NCCL_IB_DISABLE", "0")
+    else:
+        os.environ.setdefault("PL_TORCH_DISTRIBUTED_BACKEND", "gloo")
+
+
+def configure_launch(hparams) -> Dict[str, Union[int, float, str]]:
+    """
+    fill `hparams.nodes`, `hparams.gpus`, `hparams.batch_size` and `hparams.learning_rate` from the SLURM job and the
+    scaling options, and return the keyword arguments of the `Trainer`
+    """
+    slurm_config = get_slurm_config()
+    hparams.nodes = slurm_config.get('nodes', hparams.nodes)
+    hparams.gpus = slurm_config.get('gpus', hparams.gpus)
+    use_gpu = hparams.gpus > 0
+    processes_per_node = hparams.gpus if use_gpu else hparams.num_processes
+    world_size = hparams.nodes * processes_per_node
+
+    # a fixed global batch is split between the processes
+    if hparams.global_batch_size is not None:
+        hparams.batch_size = max(1, hparams.global_batch_size // world_size)
+    # linear scaling rule: `learning_rate` is the one of a global batch of `lr_reference_batch_size`,
+    # with gradient accumulation the global batch is the effective batch size
+    global_batch_size = hparams.effective_batch_size or hparams.batch_size * world_size
+    if hparams.lr_reference_batch_size is not None:
+        hparams.learning_rate = hparams.learning_rate * global_batch_size / hparams.lr_reference_batch_size
+    hparams.world_size = world_size
+
+    set_distributed_env(hparams.nodes, use_gpu)
+    print(f"{ctime()}: {hparams.nodes} nodes x {processes_per_node} processes, batch size {hparams.batch_size} "
+          f"per process ({hparams.batch_size * world_size} in total), learning rate {hparams.learning_rate}")
+    if use_gpu:
+        return {'gpus': hparams.gpus, 'num_nodes': hparams.nodes, 'distributed_backend': 'ddp'}
+    return {'num_processes': hparams.num_processes, 'num_nodes': hparams.nodes, 'distributed_backend': 'ddp_cpu'}
+
+
+class ScalingEfficiency(Callback):
+    """
+    log the step time and the samples per second of all the processes together, and the scaling efficiency:
+    the throughput divided by `world_size` times the throughput of one process, which is read from `reference_path`.
+    A run with one process writes its own median step time to `reference_path` at the end of the training.
+    """
+    def __init__(self, batch_size: int, world_size: int, reference_path: Optional[Union[str, Path]] = None,
+                 log_every: int = 50):
+        self.batch_size = batch_size
+        self.world_size = world_size
+        self.reference_path = Path(reference_path) if reference_path is not None else None
+        self.log_every = log_every
+        self.step_times: List[float] = []
+        self.start = None
+        self.reference_throughput = None
+        if self.reference_path is not None and self.reference_path.exists() and world_size > 1:
+            with open(self.reference_path) as f:
+                reference = json.load(f)
+            self.reference_throughput = reference['batch_size'] / reference['step_time']
+
+    def on_batch_start(self, trainer, pl_module) -> None:
+        self.start = time.perf_counter()
+
+    def on_batch_end(self, trainer, pl_module) -> None:
+        if self.start is None:
+            return
+        self.step_times.append(time.perf_counter() - self.start)
+        self.start = None
+        if len(self.step_times) % self.log_every != 0 or not trainer.is_global_zero or trainer.logger is None:
+            return
+        step_time = float(np.median(self.step_times[-self.log_every:]))
+        throughput = self.batch_size * self.world_size / step_time
+        metrics = {'scaling/step_time': step_time, 'scaling/samples_per_second': throughput}
+        if self.reference_throughput is not None:
+            metrics['scaling/efficiency'] = throughput / (self.world_size * self.reference_throughput)
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+    def on_train_end(self, trainer, pl_module) -> None:
+        if self.world_size == 1 and self.reference_path is not None and self.step_times:
+            os.makedirs(self.reference_path.parent, exist_ok=True)
+            with open(self.reference_path, "w") as f:
+                json.dump({'step_time': float(np.median(self.step_times)), 'batch_size': self.batch_size}, f)
@@ -0,0 +1,360 @@
+"""
+hook based per-layer profiler, records the activation size, parameter size, FLOPs and wall time of every module
+during a real forward / backward pass on one patch.
+
+Unlike `modelsize_estimate.modelsize`, which feeds the output of one module to the next one in `model.modules()`
+order, the hooks are triggered by the model's own `forward`, so the skip connections of the UNet Encoder/Decoder
+and the concatenation of the mini-UNet and the dilated branch in `model.Try.model.Module` are measured correctly.
+Those concatenations are functional `torch.cat` calls, not modules, so `torch.cat` is wrapped during the forward
+and its output is counted in the module which called it.
+"""
+import json
+import subprocess
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import torch
+import torch.nn as nn
+
+CONV_CLASSES = (nn.Conv1d, nn.Conv2d, nn.Conv3d)
+CONV_TRANSPOSE_CLASSES = (nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)
+NORM_CLASSES = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d,
+                nn.InstanceNorm1d, nn.InstanceNorm2d, nn.InstanceNorm3d,
+                nn.GroupNorm)
+POOL_CLASSES = (nn.MaxPool1d, nn.MaxPool2d, nn.MaxPool3d,
+                nn.AvgPool1d, nn.AvgPool2d, nn.AvgPool3d)
+
+
+def tensor_bytes(obj) -> int:
+    """
+    number of bytes of all the tensors in `obj`, which could be a tensor, or a (nested) tuple / list of them
+    """
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (tuple, list)):
+        return sum(tensor_bytes(o) for o in obj)
+    return 0
+
+
+def first_tensor(obj) -> Optional[torch.Tensor]:
+    if torch.is_tensor(obj):
+        return obj
+    if isinstance(obj, (tuple, list)):
+        for o in obj:
+            tensor = first_tensor(o)
+            if tensor is not None:
+                return tensor
+    return None
+
+
+def count_flops(module: nn.Module, inputs, output) -> int:
+    """
+    count the floating point operations (one multiply-add is 2 FLOPs) of a leaf module's forward pass,
+    layers which are not listed here are counted as 0
+    """
+    x = first_tensor(inputs)
+    y = first_tensor(output)
+    if x is None or y is None:
+        return 0
+
+    if isinstance(module, CONV_CLASSES):
+        kernel_ops = int(torch.tensor(module.kernel_size).prod().item()) * module.in_channels // module.groups
+        flops = 2 * y.numel() * kernel_ops
+        if module.bias is not None:
+            flops += y.numel()
+        return flops
+    if isinstance(module, CONV_TRANSPOSE_CLASSES):
+        kernel_ops = int(torch.tensor(module.kernel_size).prod().item()) * module.out_channels // module.groups
+        flops = 2 * x.numel() * kernel_ops
+        if module.bias is not None:
+            flops += y.numel()
+        return flops
+    if isinstance(module, nn.Linear):
+        flops = 2 * x.numel() * module.out_features
+        if module.bias is not None:
+            flops += y.numel()
+        return flops
+    if isinstance(module, NORM_CLASSES):
+        # subtract mean, divide std, and the affine scale and shift
+        return 4 * y.numel()
+    if isinstance(module, (nn.ReLU, nn.LeakyReLU, nn.PReLU)):
+        return y.numel()
+    if isinstance(module, (nn.Softmax, nn.LogSoftmax)):
+        # exp, sum and divide
+        return 3 * y.numel()
+    if isinstance(module, POOL_CLASSES):
+        return x.numel()
+    if isinstance(module, nn.Upsample):
+        # trilinear interpolation needs 8 neighbours per output voxel
+        return 8 * y.numel() if module.mode == 'trilinear' else y.numel()
+    return 0
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=Path(__file__).resolve().parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LayerProfiler:
+    """
+    Register forward hooks on every module of `model` and record, for each of them:
+        - activation_bytes: bytes of the tensors kept for the backward pass (the sum of the leaf outputs below it)
+        - param_bytes: bytes of the parameters owned by the module (recursively)
+        - flops: forward FLOPs (the sum of the leaf FLOPs below it)
+        - time_ms: wall time of the module's forward, measured between its pre and post hooks
+        - backward_ms: wall time of the module's backward, from the gradient of its output to the gradient of its
+          input (to the end of the backward pass for the first module). When the input is also used by another
+          module (e.g. a skip connection), its gradient is ready after both, so the time includes that module too
+
+    Usage:
+        profiler = LayerProfiler(model)
+        profiler.profile(torch.zeros(1, 1, 96, 96, 96))
+        profiler.print_table()
+        profiler.save_json("profile.json")
+    """
+    def __init__(self, model: nn.Module, max_depth: Optional[int] = None):
+        self.model = model
+        self.max_depth = max_depth
+        self.records: Dict[str, Dict[str, Union[int, float, str]]] = OrderedDict()
+        self.summary: Dict[str, Union[int, float, str, List[int], None]] = {}
+        self._handles = []
+        self._start_times = {}
+        self._backward_starts: Dict[str, List[float]] = {}
+        # the names of the modules whose forward is running, the innermost last
+        self._stack: List[str] = []
+        self._on_cuda = False
+
+    def _register(self):
+        for name, module in self.model.named_modules():
+            name = name if name else self.model._get_name()
+            is_leaf = len(list(module.children())) == 0
+            self.records[name] = OrderedDict(
+                type=module._get_name(),
+                depth=0 if module is self.model else name.count(".") + 1,
+                is_leaf=is_leaf,
+                param_bytes=sum(p.numel() * p.element_size() for p in module.parameters()),
+                activation_bytes=0,
+                flops=0,
+                time_ms=0.0,
+                backward_ms=0.0,
+                calls=0,
+            )
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name, is_leaf)))
+
+    def _remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _sync(self):
+        if self._on_cuda:
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._stack.append(name)
+            self._sync()
+            self._start_times[name] = time.perf_counter()
+        return hook
+
+    def _post_hook(self, name, is_leaf):
+        def hook(module, inputs, output):
+            self._sync()
+            record = self.records[name]
+            record['time_ms'] += (time.perf_counter() - self._start_times.pop(name)) * 1000
+            record['calls'] += 1
+            self._stack.pop()
+            out, x = first_tensor(output), first_tensor(inputs)
+            if out is not None and out.requires_grad:
+                out.register_hook(self._backward_start_hook(name))
+                if x is not None and x.requires_grad:
+                    x.register_hook(self._backward_end_hook(name))
+            if is_leaf:
+                # in-place activations do not allocate a new tensor
+                activation_bytes = 0 if getattr(module, 'inplace', False) else tensor_bytes(output)
+                flops = count_flops(module, inputs, output)
+                record['activation_bytes'] += activation_bytes
+                record['flops'] += flops
+                self._add_to_parents(name, activation_bytes, flops)
+        return hook
+
+    def _backward_start_hook(self, name):
+        def hook(grad):
+            self._sync()
+            self._backward_starts.setdefault(name, []).append(time.perf_counter())
+        return hook
+
+    def _backward_end_hook(self, name):
+        def hook(grad):
+            starts = self._backward_starts.get(name)
+            if starts:
+                self._sync()
+                self.records[name]['backward_ms'] += (time.perf_counter() - starts.pop()) * 1000
+        return hook
+
+    def _cat(self, cat):
+        """`torch.cat` which counts its output in the activations of the running module"""
+        def wrapper(tensors, *args, **kwargs):
+            output = cat(tensors, *args, **kwargs)
+            if self._stack:
+                name = self._stack[-1]
+                activation_bytes = tensor_bytes(output)
+                self.records[name]['activation_bytes'] += activation_bytes
+                self._add_to_parents(name, activation_bytes, 0)
+            return output
+        return wrapper
+
+    def _add_to_parents(self, name, activation_bytes, flops):
+        root = self.model._get_name()
+        parts = name.split(".")
+        parents = [".".join(parts[:i]) for i in range(1, len(parts))]
+        if name != root:
+            parents.append(root)
+        for parent in parents:
+            self.records[parent]['activation_bytes'] += activation_bytes
+            self.records[parent]['flops'] += flops
+
+    def profile(self, input: torch.Tensor, backward: bool = True) -> Dict[str, Dict[str, Union[int, float, str]]]:
+        """
+        run one forward (and backward) pass on `input` and collect the statistics
+        :param input: a patch with the shape of (N, C, H, W, D), on the same device as the model
+        :param backward: whether to also run the backward pass, to get the backward time and the peak memory
+        """
+        self.records = OrderedDict()
+        self._backward_starts = {}
+        self._stack = []
+        self._on_cuda = input.is_cuda
+        self._register()
+        cat = torch.cat
+        torch.cat = self._cat(cat)
+        was_training = self.model.training
+        self.model.train(backward)
+
+        if self._on_cuda:
+            torch.cuda.reset_peak_memory_stats(input.device)
+        try:
+            self._sync()
+            start = time.perf_counter()
+            with torch.set_grad_enabled(backward):
+                output = self.model(input)
+            self._sync()
+            forward_ms = (time.perf_counter() - start) * 1000
+        finally:
+            torch.cat = cat
+            self._remove()
+
+        backward_ms = None
+        if backward:
+            start = time.perf_counter()
+            first_tensor(output).float().mean().backward()
+            self._sync()
+            end = time.perf_counter()
+            backward_ms = (end - start) * 1000
+            # the modules whose input does not need a gradient (the first one) end with the backward pass
+            for name, starts in self._backward_starts.items():
+                self.records[name]['backward_ms'] += sum(end - s for s in starts) * 1000
+            self._backward_starts = {}
+            self.model.zero_grad()
+        self.model.train(was_training)
+
+        root = self.records[self.model._get_name()]
+        self.summary = OrderedDict(
+            model=self.model._get_name(),
+            input_shape=list(input.shape),
+            device=str(input.device),
+            commit=get_git_commit(),
+            param_bytes=root['param_bytes'],
+            activation_bytes=root['activation_bytes'],
+            flops=root['flops'],
+            forward_ms=forward_ms,
+            backward_ms=backward_ms,
+            peak_allocated_bytes=torch.cuda.max_memory_allocated(input.device) if self._on_cuda else None,
+        )
+        return self.records
+
+    def rows(self, sort_by: Optional[str] = None) -> List[Dict[str, Union[int, float, str]]]:
+        rows = [dict(name=name, **record) for name, record in self.records.items()
+                if self.max_depth is None or record['depth'] <= self.max_depth]
+        if sort_by is not None:
+            rows = sorted(rows, key=lambda row: row[sort_by], reverse=True)
+        return rows
+
+    def table(self, sort_by: Optional[str] = None) -> str:
+        header = (f"{'name':<60} {'type':<20} {'params(MB)':>11} {'act(MB)':>10} {'GFLOPs':>10} {'time(ms)':>10} "
+                  f"{'bwd(ms)':>10}")
+        lines = [header, "-" * len(header)]
+        for row in self.rows(sort_by):
+            name = "  " * row['depth'] + row['name']
+            lines.append(f"{name[:60]:<60} {row['type'][:20]:<20} "
+                         f"{row['param_bytes'] / 1000 ** 2:>11.3f} "
+                         f"{row['activation_bytes'] / 1000 ** 2:>10.2f} "
+                         f"{row['flops'] / 1000 ** 3:>10.3f} "
+                         f"{row['time_ms']:>10.2f} "
+                         f"{row['backward_ms']:>10.2f}")
+        lines.append("-" * len(header))
+        for key, value in self.summary.items():
+            lines.append(f"{key}: {value}")
+        return "\n".join(lines)
+
+    def print_table(self, sort_by: Optional[str] = None) -> None:
+        print(self.table(sort_by))
+
+    def save_json(self, path: Union[str, Path]) -> None:
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary, "layers": self.rows()}, f, indent=2)
+
+
+def get_model(name: str, out_classes: int = 139) -> nn.Module:
+    from model.unet.unet import UNet
+    from model.highResNet.highresnet import HighResNet
+    from model.Try.model import Module
+
+    if name == "Unet" or name == "ResUnet":
+        return UNet(
+            in_channels=1,
+            out_classes=out_classes,
+            num_encoding_blocks=4,
+            out_channels_first_layer=32,
+            kernal_size=5,
+            normalization='InstanceNorm3d',
+            module_type=name,
+            downsampling_type='max',
+            dropout=0,
+        )
+    elif name == "highResNet":
+        return HighResNet(in_channels=1, out_channels=out_classes, dimensions=3)
+    elif name == "NewModel":
+        return Module(in_channels=1, out_channels=out_classes, dimensions=3)
+    raise ValueError(f"Unknown model: {name}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='per-layer memory and FLOP profiler')
+    parser.add_argument("--model", type=str, default="NewModel", help='Unet, ResUnet, highResNet or NewModel')
+    parser.add_argument("--patch_size", type=int, default=96)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--max_depth", type=int, default=None, help='only show the modules up to this depth')
+    parser.add_argument("--sort_by", type=str, default=None, help='activation_bytes, flops, time_ms, ...')
+    parser.add_argument("--output", type=str, default="layer_profile.json", help='where to save the json file')
+    parser.add_argument("--cpu", action="store_true", help='profile on CPU even if CUDA is available')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+    model = get_model(args.model).to(device)
+    patch = torch.randn(args.batch_size, 1, args.patch_size, args.patch_size, args.patch_size, device=device)
+
+    profiler = LayerProfiler(model, max_depth=args.max_depth)
+    # the first pass warms up cudnn, only the second one is recorded
+    profiler.profile(patch)
+    profiler.profile(patch)
+    profiler.print_table(sort_by=args.sort_by)
+    profiler.save_json(args.output)
+    print(f"save the profile to {args.output}")
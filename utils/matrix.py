@@ -1,7 +1,7 @@
 # Some code is borrowed from https://github.com/Project-MONAI/MONAI/blob/master/monai/losses/dice.py
 
 import torch
-from pytorch_lightning.metrics.functional import stat_scores_multiple_classes, iou
+from pytorch_lightning.metrics.functional import iou
 from pytorch_lightning.utilities import rank_zero_warn, FLOAT16_EPSILON
 import scipy.spatial
 from typing import Union
@@ -11,14 +11,41 @@ CHANNELS_DIMENSION = 1
 SPATIAL_DIMENSIONS = 2, 3, 4
 
 
+def get_stat_scores(pred: torch.Tensor, target: torch.Tensor):
+    """
+    the true positives, false positives, true negatives and false negatives of every class, like
+    `stat_scores_multiple_classes`, but from one confusion matrix (a single `bincount`) of the integer labels
+    instead of comparing float tensors class by class
+    Args:
+        pred: the labels, or the one hot / probabilities with the classes in the dimension 1
+        target: the labels, e.g. uint8
+    """
+    if pred.ndim == target.ndim + 1:
+        pred = pred.argmax(dim=CHANNELS_DIMENSION)
+    if pred.is_floating_point():
+        pred = pred.round()
+    if target.is_floating_point():
+        target = target.round()
+    pred, target = pred.long().flatten(), target.long().flatten()
+    # the classes up to the largest label of the prediction and the target, like `stat_scores_multiple_classes`
+    num_classes = int(max(pred.max().item(), target.max().item())) + 1
+    confusion = torch.bincount(target * num_classes + pred, minlength=num_classes ** 2)
+    confusion = confusion.reshape(num_classes, num_classes).float()
+    tps = confusion.diagonal()
+    fps = confusion.sum(dim=0) - tps
+    fns = confusion.sum(dim=1) - tps
+    tns = pred.numel() - tps - fps - fns
+    return tps, fps, tns, fns
+
+
 def get_score(pred,
               target,
               include_background: bool = True,
               reduction: Union[LossReduction, str] = LossReduction.MEAN) -> torch.tensor:
     """
     Args:
-        pred: predict tensor
-        target: target tensor
+        pred: predict tensor, the labels or the one hot / probabilities in the dimension 1
+        target: target tensor, the labels (uint8)
         include_background: whether to compute the background class
         reduction: {``"none"``, ``"mean"``, ``"sum"``}
                 Specifies the reduction to apply to the output. Defaults to ``"mean"``.
@@ -30,10 +57,7 @@ def get_score(pred,
     Raises:
             ValueError: When ``self.reduction`` is not one of ["mean", "sum", "none"].
     """
-    num_classes = pred.shape[1]
-    # assert num_classes == 139
-
-    tps, fps, tns, fns, sups = stat_scores_multiple_classes(pred, target)
+    tps, fps, tns, fns = get_stat_scores(pred, target)
     if not include_background:
         tps = tps[1:]
         fps = fps[1:]
@@ -0,0 +1,105 @@
+"""
+low overhead memory instrumentation, used inside the training loop
+
+`gpu_mem_track.MemTracker` walks `gc.get_objects()` to list every tensor, which is useful to find a leak but far too
+slow to call every step. Here a snapshot only reads the counters of the CUDA caching allocator (no device sync) or,
+on CPU, `tracemalloc` and the process RSS. The snapshots are kept in memory and only written to the TensorBoard
+logger every `flush_every` steps.
+"""
+import os
+import tracemalloc
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+MB = 1000 ** 2
+
+
+def get_rss_bytes() -> Optional[int]:
+    """resident set size of the current process, read from /proc (only on linux)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemorySnapshotter:
+    """
+    Take memory snapshots at named points of a step, e.g. `prepare_batch`, `forward`, `loss`, `backward`
+    and `aggregation`.
+
+    Args:
+        enabled: if False, every method returns immediately, so the call sites do not need to check it
+        flush_every: number of steps between two flushes to the logger
+        use_tracemalloc: trace the python allocations when not running on GPU, defaults to True on CPU
+    """
+    def __init__(self, enabled: bool = True, flush_every: int = 50, use_tracemalloc: Optional[bool] = None):
+        self.enabled = enabled
+        self.flush_every = max(1, flush_every)
+        self.buffer: List[Tuple[int, str, Dict[str, float]]] = []
+        self.use_tracemalloc = use_tracemalloc
+        self._last_flush_step = None
+
+    def _start_tracemalloc(self):
+        if self.use_tracemalloc is None:
+            self.use_tracemalloc = not torch.cuda.is_available()
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def snapshot(self, name: str, step: int, device: Optional[torch.device] = None) -> None:
+        if not self.enabled:
+            return
+        self._start_tracemalloc()
+
+        stats = OrderedDict()
+        if device is not None and device.type == "cuda":
+            # these are host side counters of the caching allocator, reading them does not sync the device
+            stats['allocated_mb'] = torch.cuda.memory_allocated(device) / MB
+            stats['reserved_mb'] = torch.cuda.memory_reserved(device) / MB
+            stats['peak_allocated_mb'] = torch.cuda.max_memory_allocated(device) / MB
+        if self.use_tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            stats['traced_mb'] = current / MB
+            stats['traced_peak_mb'] = peak / MB
+        rss = get_rss_bytes()
+        if rss is not None:
+            stats['rss_mb'] = rss / MB
+        self.buffer.append((step, name, stats))
+
+    def should_flush(self, step: int) -> bool:
+        return self.enabled and step % self.flush_every == 0 and step != self._last_flush_step
+
+    def summarize(self) -> Dict[str, Dict[str, float]]:
+        """the maximum of every statistic at every named point since the last flush"""
+        summary = OrderedDict()
+        for _, name, stats in self.buffer:
+            point = summary.setdefault(name, OrderedDict())
+            for key, value in stats.items():
+                point[key] = max(point.get(key, value), value)
+        return summary
+
+    def flush(self, logger, step: int, device: Optional[torch.device] = None) -> None:
+        """
+        write the buffered snapshots to a TensorBoard `logger` and clear the buffer
+        :param logger: the pytorch-lightning TensorBoardLogger, could be None
+        """
+        if not self.enabled:
+            return
+        if logger is not None:
+            for name, stats in self.summarize().items():
+                for key, value in stats.items():
+                    logger.experiment.add_scalar(f"memory/{name}/{key}", value, global_step=step)
+        self.buffer = []
+        self._last_flush_step = step
+        # so that the next window reports its own peak
+        if device is not None and device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        # `reset_peak` only exists since python 3.9
+        if self.use_tracemalloc and tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def stop(self) -> None:
+        if self.use_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
@@ -0,0 +1,48 @@
+"""
+sampled, asynchronous NaN check for the training batches
+
+The volumes are repaired once by `data.sanitize`, so the batches are only checked every `check_every` steps as a
+safety net. The result is copied to pinned host memory with `non_blocking=True` and only read once its CUDA event has
+completed, so the check never blocks the training loop on a device sync.
+"""
+from typing import List, Tuple
+
+import torch
+
+
+class AsyncNanChecker:
+    def __init__(self, check_every: int = 0):
+        """
+        :param check_every: check one batch every `check_every` steps, 0 to disable the check
+        """
+        self.check_every = check_every
+        self.pending: List[Tuple[int, torch.Tensor, object]] = []
+        self.num_bad_steps = 0
+
+    def check(self, step: int, *tensors: torch.Tensor) -> None:
+        if self.check_every <= 0 or step % self.check_every != 0:
+            return
+        self.poll()
+        flags = torch.stack([torch.isnan(t).any() for t in tensors if t.is_floating_point()])
+        if flags.is_cuda:
+            host_flags = torch.empty(flags.shape, dtype=flags.dtype, pin_memory=True)
+            host_flags.copy_(flags, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self.pending.append((step, host_flags, event))
+        else:
+            self.pending.append((step, flags, None))
+
+    def poll(self, wait: bool = False) -> None:
+        """report the finished checks, if `wait` is True wait for all of them (e.g. at the end of an epoch)"""
+        still_pending = []
+        for step, host_flags, event in self.pending:
+            if event is not None and not event.query():
+                if not wait:
+                    still_pending.append((step, host_flags, event))
+                    continue
+                event.synchronize()
+            if host_flags.any():
+                self.num_bad_steps += 1
+                print(f"there is nan in the batch of step {step}! run `python -m data.sanitize` to repair the data")
+        self.pending = still_pending
@@ -33,6 +33,8 @@ import nibabel as nib
 from time import ctime
 from tqdm import tqdm
 from data.get_subjects import get_subjects
+from data.sanitize import sanitize_array, get_manifest_row, save_manifest
+from data.labels import get_label_image
 from torch.utils.data import DataLoader
 
 from torchio import DATA, AFFINE
@@ -49,7 +51,7 @@ def get_numpy_affine(batch):
     return img_np, label_np, img_affine, label_affine
 
 
-def run_resample(batch, img_folder, label_folder) -> int:
+def run_resample(batch, img_folder, label_folder, manifest=None) -> int:
     # get the file name
     _, filename = os.path.split(batch["img"]['path'][0])
     filename, _ = os.path.splitext(filename)
@@ -64,10 +66,17 @@ def run_resample(batch, img_folder, label_folder) -> int:
         print(f"the image: {filename} \n shape {img.shape} is not equal to the label shape {label.shape}")
         return 0
 
+    # repair the NaN and infinite voxels here once, so that the training does not need to check every batch
+    img, img_nan, img_inf = sanitize_array(img)
+    label, label_nan, label_inf = sanitize_array(label)
+
     resample_img_file = nib.Nifti1Image(img, img_affine)
     nib.save(resample_img_file, img_folder / Path(f"{filename}.nii"))
-    resample_label_file = nib.Nifti1Image(label, label_affine)
+    resample_label_file = get_label_image(label, label_affine)
     nib.save(resample_label_file, label_folder / Path(f"{filename}.nii.gz"))
+    if manifest is not None:
+        manifest.append(get_manifest_row(img_folder / Path(f"{filename}.nii"), img_nan, img_inf))
+        manifest.append(get_manifest_row(label_folder / Path(f"{filename}.nii.gz"), label_nan, label_inf))
     return 1
 
 
@@ -99,8 +108,10 @@ if __name__ == "__main__":
     loader = DataLoader(image_dataset,
                         batch_size=1)  # always one because using different label size
 
+    manifest = []
     for batch in tqdm(loader):
-        idx += run_resample(batch, cropped_resample_img_folder, cropped_resample_label_folder)
+        idx += run_resample(batch, cropped_resample_img_folder, cropped_resample_label_folder, manifest)
+    save_manifest(manifest)
 
     print(f"{ctime()}: ending ...")
     print(f"Totally get {idx} imgs!")
@@ -15,6 +15,8 @@ import os
 from data.const import ADNI_DATASET_DIR_1, squeezed_img_folder, squeezed_label_folder
 from data.transform import get_train_transforms
 from data.get_path import get_path
+from data.metadata import scan_metadata, check_pair
+from data.labels import get_label_image
 
 # def _prepare_data(batch):
 #     inputs, targets = batch["img"][DATA], batch["label"][DATA]
@@ -51,7 +53,15 @@ if __name__ == "__main__":
     mri_list = [mri for mri in get_path(ADNI_DATASET_DIR_1)]
     print(f"totally get {len(mri_list)} MRI files!")
 
-    for mri in tqdm(mri_list):
+    # check the shapes from the headers first, so the broken and mismatched pairs are never decoded
+    img_rows = scan_metadata([mri.img_path for mri in mri_list]).to_dict('records')
+    label_rows = scan_metadata([mri.label_path for mri in mri_list]).to_dict('records')
+
+    for mri, img_row, label_row in tqdm(zip(mri_list, img_rows, label_rows), total=len(mri_list)):
+        reason = check_pair(img_row, label_row)
+        if reason is not None:
+            print(f"{mri.img_path}: {reason}")
+            continue
         try:
             data_np, seg_np, img_affine, label_affine = read_data(mri)
         except OSError:
@@ -70,7 +80,7 @@ if __name__ == "__main__":
 
         img_file = nib.Nifti1Image(data_np, img_affine)
         nib.save(img_file, squeezed_img_folder / Path(f"{filename}.nii"))
-        label_file = nib.Nifti1Image(seg_np, label_affine)
+        label_file = get_label_image(seg_np, label_affine)
         nib.save(label_file, squeezed_label_folder / Path(f"{filename}.nii.gz"))
 
         # print(f"{ctime()}: Successfully save file {filename} file!")
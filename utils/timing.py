@@ -0,0 +1,181 @@
+"""
+named span timing for the data -> forward -> loss -> metric pipeline
+
+Every span is measured on the host with `time.perf_counter`. When the span runs on a CUDA device, a pair of
+`torch.cuda.Event`s is recorded as well and only resolved when the spans are flushed, so timing does not add a device
+sync to every step. The durations are aggregated into percentiles per span name and logged every `log_every` steps,
+and the spans of a sampled window of steps can be exported as a Chrome trace (open it in chrome://tracing).
+"""
+import functools
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import torch
+
+PERCENTILES = (50, 90, 99)
+
+
+class SpanTimer:
+    """
+    Args:
+        enabled: if False, `span` is a no-op context manager
+        log_every: number of steps between two flushes to the logger
+        trace_start_step: first step of the window exported as a Chrome trace, None to disable the trace
+        trace_num_steps: number of steps in the traced window
+        trace_dir: where to write the Chrome trace file
+        rank: the DDP rank, used as the pid in the trace and in the file name
+    """
+    def __init__(
+            self,
+            enabled: bool = True,
+            log_every: int = 100,
+            trace_start_step: Optional[int] = None,
+            trace_num_steps: int = 10,
+            trace_dir: Union[str, Path] = "./log/trace",
+            rank: int = 0,
+    ):
+        self.enabled = enabled
+        self.log_every = max(1, log_every)
+        self.trace_start_step = trace_start_step
+        self.trace_num_steps = trace_num_steps
+        self.trace_dir = Path(trace_dir)
+        self.rank = rank
+        self.step = 0
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.pending = []  # (name, start event, end event, host start, step)
+        self.trace_events = []
+        self._origin = time.perf_counter()
+        self._trace_written = False
+        self._last_flush_step = None
+
+    def _in_trace_window(self) -> bool:
+        return (self.trace_start_step is not None and not self._trace_written and
+                self.trace_start_step <= self.step < self.trace_start_step + self.trace_num_steps)
+
+    def _add_trace_event(self, name: str, start: float, duration_ms: float, tid: str, step: Optional[int] = None):
+        """`step` is the step of the span, the cuda spans are only resolved at a later step"""
+        self.trace_events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": duration_ms * 1e3,
+            "pid": self.rank,
+            "tid": tid,
+            "args": {"step": self.step if step is None else step},
+        })
+
+    def add(self, name: str, start: float, end: Optional[float] = None) -> None:
+        """record a host span which has been measured by the caller, e.g. the wait between two steps"""
+        if not self.enabled:
+            return
+        end = time.perf_counter() if end is None else end
+        duration_ms = (end - start) * 1000
+        self.durations[name].append(duration_ms)
+        if self._in_trace_window():
+            self._add_trace_event(name, start, duration_ms, "host")
+
+    @contextmanager
+    def span(self, name: str, device: Optional[torch.device] = None):
+        if not self.enabled:
+            yield
+            return
+        use_cuda = device is not None and device.type == "cuda"
+        if use_cuda:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if use_cuda:
+                end_event.record()
+                self.pending.append((name, start_event, end_event, start, self.step))
+            else:
+                self.add(name, start)
+
+    def timed(self, name: str):
+        """decorator version of `span` for plain functions"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _resolve_pending(self) -> None:
+        for name, start_event, end_event, start, step in self.pending:
+            end_event.synchronize()
+            duration_ms = start_event.elapsed_time(end_event)
+            self.durations[name].append(duration_ms)
+            if (self.trace_start_step is not None and not self._trace_written and
+                    self.trace_start_step <= step < self.trace_start_step + self.trace_num_steps):
+                self._add_trace_event(name, start, duration_ms, "cuda", step)
+        self.pending = []
+
+    def summarize(self) -> Dict[str, Dict[str, float]]:
+        self._resolve_pending()
+        summary = OrderedDict()
+        for name, durations in sorted(self.durations.items()):
+            values = np.asarray(durations)
+            stats = OrderedDict(count=len(values), mean_ms=float(values.mean()))
+            for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                stats[f"p{q}_ms"] = float(value)
+            summary[name] = stats
+        return summary
+
+    def end_step(self, step: int, logger=None) -> None:
+        """
+        mark the end of a training step, flush every `log_every` steps, and write the trace once its window is over
+        :param logger: the pytorch-lightning TensorBoardLogger, could be None
+        """
+        if not self.enabled:
+            return
+        self.step = step + 1
+        if step % self.log_every == 0 and step != self._last_flush_step:
+            self.flush(logger, step)
+        if (self.trace_start_step is not None and not self._trace_written and
+                self.step >= self.trace_start_step + self.trace_num_steps):
+            self._resolve_pending()
+            self.export_chrome_trace()
+
+    def flush(self, logger, step: int) -> None:
+        if logger is not None:
+            for name, stats in self.summarize().items():
+                for key, value in stats.items():
+                    if key != "count":
+                        logger.experiment.add_scalar(f"timing/{name}/{key}", value, global_step=step)
+        else:
+            self._resolve_pending()
+        self.durations = defaultdict(list)
+        self._last_flush_step = step
+
+    def export_chrome_trace(self, path: Optional[Union[str, Path]] = None) -> Path:
+        if path is None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            end_step = self.trace_start_step + self.trace_num_steps - 1
+            path = self.trace_dir / f"trace_rank{self.rank}_steps{self.trace_start_step}-{end_step}.json"
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+        self.trace_events = []
+        self._trace_written = True
+        print(f"save the chrome trace to {path}")
+        return Path(path)
+
+
+def timed_method(name: str):
+    """decorator for the methods of a class owning a `SpanTimer` in `self.timer`"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timer.span(name, getattr(self, "device", None)):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator